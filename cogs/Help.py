@@ -1,6 +1,12 @@
+import logging
+
 import discord
 from discord.ext import bridge, commands
 
+from store import guild_config
+
+logger = logging.getLogger(__name__)
+
 
 class Help(commands.Cog):
     """Sends this help message"""
@@ -8,7 +14,6 @@ class Help(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.cmds = {}
-        self.prefix = self.bot.command_prefix
         for cmd in self.bot.walk_commands():
             self.cmds[cmd.name] = cmd
         self.bot.remove_command("help")
@@ -18,9 +23,10 @@ class Help(commands.Cog):
         description="Displays help about the commands and functions in Librarian of Stoa.",
         help="Displays help about the commands and functions in Librarian of Stoa.",
     )
-    @discord.option("command", description="Name of command.")
+    @bridge.bridge_option("command", description="Name of command.")
     async def help(self, ctx, command=""):
         """Shows all commands of the bot"""
+        prefix = guild_config(self.bot, ctx.guild)["prefix"]
 
         owner_name = "Jullan#5868"
 
@@ -41,7 +47,7 @@ class Help(commands.Cog):
 
             emb.add_field(
                 name="List of Commands",
-                value=f"Use `{self.prefix}help <module/command>` to see information about a particular module/command. Using a command without giving it a number will send a random passage or chapter from that book.",
+                value=f"Use `{prefix}help <module/command>` to see information about a particular module/command. Using a command without giving it a number will send a random passage or chapter from that book.",
             )
             # List all unhidden commands
             for cmd_name, cmd in self.cmds.items():
@@ -55,7 +61,7 @@ class Help(commands.Cog):
                             + ", ".join([f"`{a}`" for a in cmd.aliases])
                         )
                     emb.add_field(
-                        name=f"`{self.prefix}{cmd_name} {' '.join('<' + a[0] + '>' for a in cmd.clean_params.items())}`",
+                        name=f"`{prefix}{cmd_name} {' '.join('<' + a[0] + '>' for a in cmd.clean_params.items())}`",
                         value=value,
                         inline=False,
                     )
@@ -70,7 +76,7 @@ class Help(commands.Cog):
             # Iterating trough cogs
             if command in self.cmds.keys():
                 cmd = self.cmds[command]
-                title = f"`{self.prefix}{cmd.name} {' '.join('<' + a[0] + '>' for a in cmd.clean_params.items())}`"
+                title = f"`{prefix}{cmd.name} {' '.join('<' + a[0] + '>' for a in cmd.clean_params.items())}`"
                 description = cmd.help if cmd.help else cmd.description
                 emb = discord.Embed(
                     title=title, description=description, color=discord.Color.green()
@@ -78,7 +84,7 @@ class Help(commands.Cog):
                 if cmd.aliases:
                     aliases = "\nAliases: " + ", ".join(cmd.aliases)
                     emb.set_footer(text=aliases)
-                print(f"'{cmd.description}' and '{cmd.help}'")
+                logger.debug(f"'{cmd.description}' and '{cmd.help}'")
 
             # If command not found
             # yes, for-loops have an else statement, it's called when no 'break' was issued
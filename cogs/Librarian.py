@@ -1,15 +1,77 @@
 import asyncio
-import json
+import collections
+import logging
+import os
 import random
-import re
+import time
 
 import discord
 from discord.ext import bridge, commands
 
-from utilities import int2roman, split_within, uniform_random_choice_from_dict
-
-MAX_EMBED_LENGTH = 4096
-MULTIPAGE_TIMEOUT = 900  # Timeout period for page flipping with reacts
+from corpus import shared_corpus
+from executors import export_markdown
+from librarian import BOOKS, WORKS, LibraryError, NotFound, paginate
+from librarian.library import LENGTH_BOUND, NUMBER_DOT
+from scheduler import PAGE_FLIP, Overloaded, priority
+from store import PopularityStore, guild_config
+from utilities import (
+    SHORT_QUOTE_LENGTH,
+    LRUCache,
+    NGramIndex,
+    SharedFile,
+    SingleFlight,
+    numbered,
+)
+
+# Rendered passages kept, whose embeds are copied for every reply
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "512"))
+# Discord's limits on the embeds of one message: how many, and their total length
+MAX_EMBEDS = 10
+MAX_EMBEDS_LENGTH = 6000
+COLORS = {
+    "meditations": 0xFF0000,  # Red
+    "enchiridion": 0x00FF00,  # Green
+    "letters": 0x0000FF,  # Blue
+    "happylife": 0x00FFFF,
+    "shortness": 0x00FFFF,
+    "discourses": 0x00FF00,  # Green
+    "anger": 0x00FFFF,
+    "musonius": 0xFFEEFF,  # white (?)
+}
+# Long passages of these are pages to flip through, unless all of them are asked for
+PAGED = ["letters", "musonius", "discourses"]
+THUMBNAILS = ["meditations", "enchiridion", "discourses"]  # On passages of one page
+TRANSLATIONS = {  # Wording of the link to other translations
+    "meditations": "Other translations",
+    "enchiridion": "Compare translations",
+}
+
+logger = logging.getLogger(__name__)
+
+
+def pack_embeds(embeds: list) -> list:
+    # Groups embeds, in order, into as few messages as Discord's limits allow
+    messages, length = [], 0
+    for embed in embeds:
+        if (
+            not messages
+            or len(messages[-1]) == MAX_EMBEDS
+            or length + len(embed) > MAX_EMBEDS_LENGTH
+        ):
+            messages.append([])
+            length = 0
+        messages[-1].append(embed)
+        length += len(embed)
+    return messages
+
+
+def reference_autocomplete(book: str):
+    # Suggests the valid references of a book from the tries built when the corpus was loaded
+    def autocomplete(ctx: discord.AutocompleteContext):
+        value = NUMBER_DOT.sub(r"\1:", (ctx.value or "").strip())
+        return ctx.cog.completions[book].search(value)
+
+    return autocomplete
 
 
 class Librarian(commands.Cog, name="Librarian"):
@@ -17,27 +79,149 @@ class Librarian(commands.Cog, name="Librarian"):
 
     def __init__(self, bot):
         self.bot = bot
-        self.multipage_timeout = MULTIPAGE_TIMEOUT
-
-        def load_json(filename: str):
-            with open(filename, "r", encoding="utf-8") as f:
-                js = json.load(f)
-            return js
-
-        books = [
-            "meditations",  # Meditations
-            "enchiridion",  # Enchiridion
-            "letters",  # Letters
-            "happylife",  # Happy Life
-            "shortness",  # Shortness of life
-            "discourses",  # The Discourses
-            "anger",  # Of Anger
-            "musonius",  # Lectures, Fragments by Musonius Rufus
-            "media",  # Author information and wikisource links
-            "toc",  # Table of Contents for some books
-        ]
 
-        self.lib = {b: load_json(f"books/{b}.json") for b in books}
+        # Shared with any other instance, e.g. one loaded again with add_cog
+        self.corpus = shared_corpus()
+        self.lib, self.corpus_manifest = self.corpus.lib, self.corpus.manifest
+        self.completions = self.corpus.completions
+        self.lengths = self.corpus.lengths
+        self.offload = self.corpus.offload
+        self.command_index, self.command_names = None, None
+        self.flights = SingleFlight()
+        self.menus = collections.Counter()  # Kind -> replies waiting for reactions
+        # Of this instance, as a reloaded cog may render differently
+        self.renders = LRUCache(RENDER_CACHE_SIZE)
+        self.popularity = PopularityStore()
+        self.prewarming = None
+        if bot.is_ready():  # Loaded again later on, e.g. with add_cog
+            bot.loop.create_task(self.warm_up())
+
+    def cog_unload(self):
+        if self.prewarming:
+            self.prewarming.cancel()
+        self.bot.loop.create_task(self.popularity.close())
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        await self.warm_up()
+
+    async def warm_up(self):
+        # Renders the passages requested most before, in the background, so the
+        # first requests for them after a start are served from the cache
+        await self.popularity.open()
+        if self.prewarming is None:
+            self.prewarming = asyncio.create_task(self.prewarm())
+
+    async def prewarm(self):
+        priority.set(PAGE_FLIP)  # Behind everything that was asked for
+        warmed = 0
+        for (book, reference), _ in self.popularity.popular():
+            try:
+                self.corpus.resolve(book, reference)  # Still in the corpus
+                await self.rendered(book, reference)
+            except LibraryError:
+                continue
+            except Overloaded:
+                break
+            warmed += 1
+        logger.info(f"Prewarmed {warmed} popular passages")
+
+    def build_command_index(self) -> NGramIndex:
+        # Over the names and aliases of the commands, and the titles of the books
+        index = NGramIndex()
+        for command in self.bot.commands:
+            if command.hidden:
+                continue
+            for name in [command.name, *command.aliases]:
+                index.insert(name, command.name)
+        for book, title in WORKS.items():
+            index.insert(title, book)
+            for word in title.split():
+                if len(word) > 3:
+                    index.insert(word, book)
+        return index
+
+    def similar_commands(self, name: str, guild=None) -> list:
+        # Rebuilt only when commands were added or removed, e.g. with add_cog
+        names = set(self.bot.all_commands)
+        if names != self.command_names:
+            self.command_index, self.command_names = self.build_command_index(), names
+        disabled = guild_config(self.bot, guild)["disabled"]
+        return [c for c in self.command_index.search(name) if c not in disabled]
+
+    def did_you_mean(self, ctx, book: str, reference: str, command: str = "") -> str:
+        # Closing words of a reply to a reference that doesn't exist, naming the
+        # closest ones that do
+        refs = self.corpus.suggest(book, reference)
+        if not refs:
+            return ""
+        prefix = "/" if isinstance(ctx, bridge.BridgeApplicationContext) else ctx.prefix
+        command = command or book
+        return f" Did you mean {' or '.join(f'`{prefix}{command} {r}`' for r in refs)}?"
+
+    @commands.Cog.listener()
+    async def on_command_error(self, ctx, error):
+        # Mistyped commands get the closest ones suggested, with what came after them.
+        # Anything not close to a command (".lol", "...") is still ignored.
+        if not isinstance(error, commands.CommandNotFound) or not ctx.invoked_with:
+            return
+        names = self.similar_commands(ctx.invoked_with, ctx.guild)
+        if not names:
+            return
+        rest = ctx.message.content[len(ctx.prefix) + len(ctx.invoked_with) :].strip()
+        rest = f" {rest}" if rest else ""
+        await ctx.respond(
+            f"{ctx.author.mention}, there is no command `{ctx.prefix}{ctx.invoked_with}`. Did you mean {' or '.join(f'`{ctx.prefix}{n}{rest}`' for n in names)}?"
+        )
+
+    async def cog_check(self, ctx):
+        # Servers can turn off books
+        book = ctx.command.name
+        if book in guild_config(self.bot, ctx.guild)["disabled"]:
+            await ctx.respond(
+                f"{ctx.author.mention}, {WORKS[book]} is turned off on this server."
+            )
+            return False
+        return True
+
+    def enabled_books(self, guild) -> list:
+        disabled = guild_config(self.bot, guild)["disabled"]
+        return [b for b in BOOKS if b not in disabled]
+
+    async def rendered(self, book: str, reference: str, post_all: bool = False):
+        # Renders a passage on a worker thread, unless it was rendered recently.
+        # Identical requests that arrive while it's being rendered share that one
+        # rendering.
+        key = (book, reference, post_all)
+        embeds = self.renders.get(key)
+        if embeds is None:
+            embeds = await self.flights.do(
+                ("render", *key), self.offload.io, self.render, *key
+            )
+            self.renders.put(key, embeds)
+        return embeds
+
+    async def render_reference(self, book: str, reference: str):
+        # Renders a reference from the indexes, e.g. "19:3" of the letters, without
+        # going through a command
+        return await self.rendered(book, reference)
+
+    async def send(self, ctx, book: str, reference: str, post_all: bool = False):
+        # Renders a passage and posts it
+        embeds, paged = await self.rendered(book, reference, post_all)
+        # Pages get their own footers, so every message gets its own copies
+        embeds = [e.copy() for e in embeds]
+        if paged:
+            await self.multi_page(ctx, embeds)
+        else:
+            await self.deletables(ctx, embeds)
+
+    async def build_export(self, book: str, keys: list):
+        path = await self.offload.cpu(export_markdown, book, keys, WORKS[book])
+        # The open file outlives its name, and is removed once it's closed
+        fp = open(path, "rb")
+        os.unlink(path)
+        return SharedFile(fp)
 
     @staticmethod
     def generate_embed(title, passage, author_data, passage_url, color):
@@ -53,13 +237,17 @@ class Librarian(commands.Cog, name="Librarian"):
         return embed
 
     async def multi_page(self, ctx, embeds):
+        timeout = guild_config(self.bot, ctx.guild)["timeout"]
         pages = len(embeds)
         cur_page = 0
         for i, em in enumerate(embeds):
             pg = i + 1
             em.set_footer(text=f"Page {pg} of {pages}")
+        if self.bot.ws is None:
+            return await self.deletables(ctx, embeds)
 
         message = await ctx.respond(embed=embeds[0])
+        ctx.replied = time.perf_counter()  # The command's latency ends here
 
         # TODO: Make buttons use API button system.
         # Botched workaround to fetch the original message object
@@ -81,55 +269,79 @@ class Librarian(commands.Cog, name="Librarian"):
                 and str(reaction.emoji) in valid_emoji
             )
 
-        while True:
-            try:
-                # wait for a reaction to be added
-                # times out after MULTIPAGE_TIMEOUT seconds
-                reaction, user = await self.bot.wait_for(
-                    "reaction_add", timeout=self.multipage_timeout, check=check
-                )
+        self.menus["pages"] += 1
+        try:
+            while True:
+                try:
+                    # wait for a reaction to be added
+                    # times out after the guild's timeout
+                    reaction, user = await self.bot.wait_for(
+                        "reaction_add", timeout=timeout, check=check
+                    )
 
-                if str(reaction.emoji) == "▶️":
-                    # Next page
-                    if (
-                        cur_page == pages - 1
-                    ):  # If current page is the last page, wrap around to the first page
-                        cur_page = 0
-                    else:  # Else just flip to the next
-                        cur_page += 1
-                    await message.edit(embed=embeds[cur_page])
-                    await message.remove_reaction(reaction, user)
-
-                elif str(reaction.emoji) == "◀️":
-                    # Previous page
-                    if (
-                        cur_page == 0
-                    ):  # If current page is the first page, wrap around to the last page
-                        cur_page = pages - 1
-                    else:  # Else just flip back to the previous
-                        cur_page -= 1
-                    await message.edit(embed=embeds[cur_page])
-                    await message.remove_reaction(reaction, user)
-
-                elif str(reaction.emoji) == "🗑️":
-                    # Bot messages can be deleted by reacting with the waste basket emoji
-                    await message.delete()
+                    # Sampled, there are far too many to write each one
+                    logger.info(
+                        "page flip",
+                        extra={
+                            "event": "page_flip",
+                            "command": ctx.command.qualified_name,
+                            "guild": ctx.guild.id if ctx.guild else None,
+                        },
+                    )
+                    if str(reaction.emoji) == "▶️":
+                        # Next page, wrapping around from the last to the first
+                        page = cur_page + 1 if cur_page < pages - 1 else 0
+                        if await self.flip(message, embeds[page], reaction, user):
+                            cur_page = page
+
+                    elif str(reaction.emoji) == "◀️":
+                        # Previous page, wrapping around from the first to the last
+                        page = cur_page - 1 if cur_page > 0 else pages - 1
+                        if await self.flip(message, embeds[page], reaction, user):
+                            cur_page = page
+
+                    elif str(reaction.emoji) == "🗑️":
+                        # Bot messages can be deleted by reacting with the waste basket emoji
+                        await message.delete()
+                        break
+
+                except (asyncio.TimeoutError, discord.errors.Forbidden):
+                    # End the loop if user doesn't react before the timeout
+                    # Remove bot's reactions first in case there are missing perms
+                    await asyncio.gather(
+                        *(
+                            message.remove_reaction(r, self.bot.user)
+                            for r in valid_emoji
+                        )
+                    )
+                    await message.clear_reactions()
                     break
+        finally:
+            self.menus["pages"] -= 1
 
-            except (asyncio.TimeoutError, discord.errors.Forbidden):
-                # End the loop if user doesn't react after MULTIPAGE_TIMEOUT seconds
-                for r in valid_emoji:
-                    # Remove bot's reactions first in case there are missing perms
-                    await message.remove_reaction(r, self.bot.user)
-                await message.clear_reactions()
-                break
+    async def flip(self, message, embed, reaction, user) -> bool:
+        # Page flips queue behind the other work, and are dropped while the bot is
+        # swamped. The reaction then stays, so the flip can be tried again.
+        try:
+            async with self.offload.admit("io", PAGE_FLIP):
+                await asyncio.gather(
+                    message.edit(embed=embed), message.remove_reaction(reaction, user)
+                )
+        except Overloaded:
+            return False
+        return True
 
     async def deletables(self, ctx, embeds):
         # Makes messages deletable by reacting wastebasket on them
         # Check mark reacts make reactions go away (but one may still delete them!)
+        # The embeds are sent in as few messages as they fit in.
         messages = []
-        for e in embeds:
-            messages.append(await ctx.respond(embed=e))
+        for group in pack_embeds(embeds):
+            messages.append(await ctx.respond(embeds=group))
+        ctx.replied = time.perf_counter()  # The command's latency ends here
+        if self.bot.ws is None:
+            # Served over HTTP without a gateway connection, no reactions ever come in
+            return
 
         # TODO: Make buttons use API button system.
         # Botched workaround to fetch the original message object
@@ -153,331 +365,158 @@ class Librarian(commands.Cog, name="Librarian"):
                 and str(reaction.emoji) in valid_emoji
             )
 
-        while True:
-            try:
-                # wait for a reaction to be added
-                # times out after MULTIPAGE_TIMEOUT seconds
-                reaction, user = await self.bot.wait_for(
-                    "reaction_add", timeout=60, check=check
-                )
+        self.menus["deletables"] += 1
+        try:
+            while True:
+                try:
+                    # wait for a reaction to be added
+                    # times out after 60 seconds
+                    reaction, user = await self.bot.wait_for(
+                        "reaction_add", timeout=60, check=check
+                    )
 
-                if str(reaction.emoji) == "✅":
+                    if str(reaction.emoji) == "✅":
+                        await last_message.clear_reactions()
+                    elif str(reaction.emoji) == "🗑️":
+                        await asyncio.gather(*(m.delete() for m in messages))
+                        break
+                    else:
+                        # remove reactions if the user tries to go forward on the last page or
+                        # backwards on the first page
+                        await last_message.remove_reaction(reaction, user)
+                except (asyncio.TimeoutError, discord.errors.Forbidden):
+                    # end the loop if user doesn't react after 60 seconds
+                    await asyncio.gather(
+                        *(
+                            last_message.remove_reaction(r, self.bot.user)
+                            for r in valid_emoji
+                        )
+                    )
                     await last_message.clear_reactions()
-                elif str(reaction.emoji) == "🗑️":
-                    for m in messages:
-                        await m.delete()
                     break
-                else:
-                    # remove reactions if the user tries to go forward on the last page or
-                    # backwards on the first page
-                    await last_message.remove_reaction(reaction, user)
-            except (asyncio.TimeoutError, discord.errors.Forbidden):
-                # end the loop if user doesn't react after MULTIPAGE_TIMEOUT seconds
-                for r in valid_emoji:
-                    await last_message.remove_reaction(r, self.bot.user)
-                await last_message.clear_reactions()
-                break
+        finally:
+            self.menus["deletables"] -= 1
+
+    def render(self, book: str, reference: str, post_all: bool):
+        # Embeds of a passage, and whether they're pages to flip through. Otherwise
+        # the first one has its title and the others continue it.
+        passage = self.corpus.passage(book, reference)
+        text = passage.text
+        if passage.translations:
+            text += f"\n\n[{TRANSLATIONS[book]}]({passage.translations})"
+        pages = paginate(text, book)
+        author = self.lib["media"][passage.author]
+        color = COLORS[book]
+
+        if len(pages) > 1 and book in PAGED and not post_all:
+            embeds = [
+                self.generate_embed(passage.title, p, author, passage.url, color)
+                for p in pages
+            ]
+            return embeds, True
+        embed = self.generate_embed(passage.title, pages[0], author, passage.url, color)
+        if book in THUMBNAILS:
+            embed.set_thumbnail(url=author["thumbnail"])
+        embeds = [embed] + [
+            discord.Embed(description=p, color=color) for p in pages[1:]
+        ]
+        return embeds, False
 
-    @bridge.bridge_command(
-        name="meditations",
-        help=f"[*The Meditations*](https://en.wikisource.org/wiki/The_Meditations_of_the_Emperor_Marcus_Antoninus) by Marcus Aurelius (Farquharson's translation). Example: .mediations 5:23",
-        description="The Meditations by Marcus Aurelius (Farquharson's translation). Example: .mediations 5:23",
-    )
-    @discord.option("bk_ch", description="Book number and chapter number. E.g. 2.1")
-    async def meditations(self, ctx, bk_ch: str = ""):
-        bk, cha = None, None
+    async def lookup(self, ctx, book: str, text: str, post_all: str = ""):
+        # What every book command does: posts the passage its text refers to
+        if text.strip() == "toc" and book in self.lib["toc"]:  # Table of contents
+            return await self.table_of_contents.slash_variant(ctx, book)
         try:
-            if not bk_ch:
-                bk, cha = uniform_random_choice_from_dict(self.lib["meditations"])
-            else:
-                bk, cha = re.split("[:\.]", bk_ch, maxsplit=1)
-        except ValueError:
-            return await ctx.respond(
-                f"{ctx.author.mention}, invalid formatting. The correct syntax is `<BOOK>:<CHAPTER>`, e.g., `5:23` for Book 5, Chapter 23."
-            )
-
-        if not (bk in self.lib["meditations"]):
-            return await ctx.respond(
-                f"{ctx.author.mention}, there is no Book `{bk}` of Meditations."
-            )
-
-        if not (cha in self.lib["meditations"][bk]):
-            return await ctx.respond(
-                f"{ctx.author.mention}, there is no chapter `{cha}` in Book `{bk}` of Meditations."
+            reference = self.corpus.resolve(book, text)
+        except LibraryError as e:
+            suggestion = (
+                self.did_you_mean(ctx, book, text) if isinstance(e, NotFound) else ""
             )
+            return await ctx.respond(f"{ctx.author.mention}, {e}{suggestion}")
 
-        title = f"Meditations {bk}.{cha}"
-        passage = self.lib["meditations"][bk][cha].rstrip()
-        aurelius = self.lib["media"]["aurelius"]  # author data
-        passage_url = f"{aurelius['meditations']}/Book_{bk}"
-        color = 0xFF0000  # Red
-
-        # Add link to comparison of translations
-        passage = (
-            passage
-            + f"\n\n[Other translations](https://www.stoicsource.com/aurelius/meditations/{bk}.{int(cha):02d}/haines)"
-        )
-
-        to_send = split_within(passage, MAX_EMBED_LENGTH, ["\n", ". "], keep_delim=True)
-
-        embed = self.generate_embed(title, to_send[0], aurelius, passage_url, color)
-        embed.set_thumbnail(url=aurelius["thumbnail"])
+        if post_all == "file" and ":" not in reference:  # A whole letter or lecture
+            return await self.export.slash_variant(ctx, book, reference)
+        self.popularity.record(book, reference)
+        await self.send(ctx, book, reference, post_all == "all")
 
-        embeds = []
-        embeds.append(embed)
-        if len(to_send) > 1:
-            # Mediations doesn't have any passages over 2 embeds long
-            embeds.append(discord.Embed(description=to_send[1], color=color))
-        await self.deletables(ctx, embeds)
+    @bridge.bridge_command(
+        name="meditations",
+        help=f"[*The Meditations*](https://en.wikisource.org/wiki/The_Meditations_of_the_Emperor_Marcus_Antoninus) by Marcus Aurelius (Farquharson's translation). Example: .meditations 5:23",
+        description="The Meditations by Marcus Aurelius (Farquharson's translation). Example: .meditations 5:23",
+    )
+    @bridge.bridge_option(
+        "bk_ch",
+        description="Book number and chapter number. E.g. 2.1",
+        autocomplete=reference_autocomplete("meditations"),
+    )
+    async def meditations(self, ctx, bk_ch: str = ""):
+        await self.lookup(ctx, "meditations", bk_ch)
 
     @bridge.bridge_command(
         name="enchiridion",
         help="[*Enchiridion*](https://en.wikisource.org/wiki/Epictetus,_the_Discourses_as_reported_by_Arrian,_the_Manual,_and_Fragments/Manual) by Epictetus (Oldfather's translation). Example: .enchiridion 34",
         description="Enchiridion by Epictetus (Oldfather's translation). Example: .enchiridion 34",
     )
-    @discord.option("chapter", description="Chapter number. Range: 1 - 53")
+    @bridge.bridge_option(
+        "chapter",
+        description="Chapter number. Range: 1 - 53",
+        autocomplete=reference_autocomplete("enchiridion"),
+    )
     async def enchiridion(self, ctx, chapter: str = ""):
-        if not chapter:
-            chapter = str(
-                random.randrange(1, 54)
-            )  # Choose a random chapter of the 53 chapters
-        elif not (chapter in self.lib["enchiridion"]):
-            return await ctx.respond(
-                f"{ctx.author.mention}, there is no chapter `{chapter}` in The Enchiridion."
-            )
-
-        title = f"Enchiridion {chapter}"
-        passage = self.lib["enchiridion"][chapter].rstrip()
-        epictetus = self.lib["media"]["epictetus"]
-        passage_url = epictetus["enchiridion"]
-        color = 0x00FF00  # Green
-
-        # Add link to comparison of translations
-        passage = (
-            passage
-            + f"\n\n[Compare translations](https://enchiridion.tasuki.org/display:Code:ec,twh,pem,sw/section:{chapter})"
-        )
-
-        to_send = split_within(passage, MAX_EMBED_LENGTH, ["\n", ". "], keep_delim=True)
-
-        embed = self.generate_embed(title, to_send[0], epictetus, passage_url, color)
-        embed.set_thumbnail(url=epictetus["thumbnail"])
-
-        embeds = []
-        embeds.append(embed)
-        if len(to_send) > 1:
-            # Enchiridion doesn't have any passages over 2 embeds long
-            embeds.append(discord.Embed(description=to_send[1], color=color))
-        await self.deletables(ctx, embeds)
+        await self.lookup(ctx, "enchiridion", chapter)
 
     @bridge.bridge_command(
         name="letters",
         aliases=["letter"],
-        help="[*Moral letters to Lucilius*](https://en.wikisource.org/wiki/Moral_letters_to_Lucilius) by Seneca (Gummere's translation). Example: `.letters 99:3-6` gives §3-6 from Letter 99. `.letters 19 all` spews out all pages of letter 19 at once.",
+        help="[*Moral letters to Lucilius*](https://en.wikisource.org/wiki/Moral_letters_to_Lucilius) by Seneca (Gummere's translation). Example: `.letters 99:3-6` gives §3-6 from Letter 99. `.letters 19 all` spews out all pages of letter 19 at once, `.letters 19 file` sends it as a file.",
         description="Moral letters to Lucilius by Seneca (Gummere's translation). Example: .letters 99:3-6",
     )
-    @discord.option(
+    @bridge.bridge_option(
         "bk_ch",
         description="Letter number and paragraph number. Also supports ranges of paragraphs, e.g., 2.1-3",
+        autocomplete=reference_autocomplete("letters"),
     )
     async def letters(self, ctx, bk_ch: str = "", post_all: str = ""):
-        bk, cha = None, None
-        if any([s in bk_ch for s in [":", "."]]):
-            bk, cha = re.split("[:\.]", bk_ch, maxsplit=1)
-        elif bk_ch == "toc":  # Shows table of contents
-            return await self.table_of_contents(ctx, "letters")
-        else:
-            bk = bk_ch
-
-        if not bk:
-            bk = str(
-                random.randrange(1, 125)
-            )  # Choose a random letter of the 124 letters
-        elif not (bk in self.lib["letters"]):
-            return await ctx.respond(
-                f"{ctx.author.mention}, there is no letter `{bk}` of the Moral letters."
-            )
-
-        passage = None
-        seneca = self.lib["media"]["seneca"]
-        if cha:
-            if "-" in cha:
-                cha1, cha2 = cha.split("-", maxsplit=1)
-                if not 0 < int(cha1) < int(cha2) or not (
-                    cha1 in self.lib["letters"][bk] and cha2 in self.lib["letters"][bk]
-                ):
-                    return await ctx.respond(
-                        f"{ctx.author.mention}, `{cha1}-{cha2}` is not a valid range."
-                    )
-                passage = " ".join(
-                    [
-                        self.lib["letters"][bk][str(ch)]
-                        for ch in range(int(cha1), int(cha2) + 1)
-                    ]
-                ).rstrip()
-            else:
-                if not (int(cha) > 0 and cha in self.lib["letters"][bk]):
-                    return await ctx.respond(
-                        f"{ctx.author.mention}, there is no paragraph `{cha}` in letter `{bk}` of the Moral letters."
-                    )
-                passage = self.lib["letters"][bk][cha].rstrip()
-        else:
-            letter_passages = list(self.lib["letters"][bk].values())[1:]
-            passage = "".join(letter_passages)
-        title = f"Moral letters to Lucilius: Letter {bk}"
-
-        if cha:
-            title += f", §{cha}"
-        else:
-            title += f"\n{self.lib['letters'][bk]['0']}"
-
-        passage_url = f"{seneca['letters']}/Letter_{bk}"
-        color = 0x0000FF  # Red
-        if len(passage) > MAX_EMBED_LENGTH and not cha:
-            to_send = split_within(
-                passage, MAX_EMBED_LENGTH, ["\n", ". "], keep_delim=True
-            )
-
-            # Post every embed if "all" parameter is passed, else do flippable embed pages
-            if post_all == "all":
-                embeds = [
-                    self.generate_embed(title, to_send[0], seneca, passage_url, color)
-                ]
-                for t in to_send[1:]:
-                    embeds.append(discord.Embed(description=t, color=color))
-                await self.deletables(ctx, embeds)
-            else:
-                embeds = [
-                    self.generate_embed(title, t, seneca, passage_url, color)
-                    for t in to_send
-                ]
-                await self.multi_page(ctx, embeds)
-            return
-
-        embed = self.generate_embed(title, passage, seneca, passage_url, color)
-        # embed.set_thumbnail(url=seneca["thumbnail"])
-        embeds = [embed]
-        await self.deletables(ctx, embeds)
+        await self.lookup(ctx, "letters", bk_ch, post_all)
 
     @bridge.bridge_command(
         name="happylife",
         help="[*Of a Happy Life*](https://en.wikisource.org/wiki/Of_a_Happy_Life) by Seneca (Stewart's translation). Example: .happylife 12",
         description="Of a Happy Life by Seneca (Stewart's translation). Example: .happylife 12",
     )
-    @discord.option("chapter", description="Chapter number. Range: 1 - 28")
+    @bridge.bridge_option(
+        "chapter",
+        description="Chapter number. Range: 1 - 28",
+        autocomplete=reference_autocomplete("happylife"),
+    )
     async def happylife(self, ctx, chapter: str = ""):
-        if not chapter:
-            chapter = str(
-                random.randrange(1, 29)
-            )  # Choose a random chapter of the 28 chapters
-        elif not (chapter in self.lib["happylife"]):
-            return await ctx.respond(
-                f"{ctx.author.mention}, there is no chapter `{chapter}` in `Of a Happy Life`."
-            )
-
-        roman_num = int2roman(int(chapter))
-        title = f"Of a Happy Life: Book {roman_num}"
-        passage = self.lib["happylife"][chapter]
-        seneca = self.lib["media"]["seneca"]
-        passage_url = f"{seneca['happylife']}/Book_{roman_num}"
-
-        color = 0x00FFFF  # Red
-        to_send = split_within(passage, MAX_EMBED_LENGTH, [". "], keep_delim=True)
-
-        embed = self.generate_embed(title, to_send[0], seneca, passage_url, color)
-
-        embeds = []
-        embeds.append(embed)
-        if len(to_send) > 1:
-            # Happy Life doesn't have any passages over 2 embeds long
-            embeds.append(discord.Embed(description=to_send[1], color=color))
-        await self.deletables(ctx, embeds)
+        await self.lookup(ctx, "happylife", chapter)
 
     @bridge.bridge_command(
         name="shortness",
         help="[*On the shortness of life*](https://en.wikisource.org/wiki/On_the_shortness_of_life) by Seneca (Basore's translation). Example: .shortness 13",
         description="On the shortness of life by Seneca (Basore's translation). Example: .shortness 13",
     )
-    @discord.option("chapter", description="Chapter number. Range: 1 - 20")
+    @bridge.bridge_option(
+        "chapter",
+        description="Chapter number. Range: 1 - 20",
+        autocomplete=reference_autocomplete("shortness"),
+    )
     async def shortness(self, ctx, chapter: str = ""):
-        if not chapter:
-            chapter = str(
-                random.randrange(1, 21)
-            )  # Choose a random chapter of the 20 chapters
-        elif not (chapter in self.lib["shortness"]):
-            return await ctx.respond(
-                f"{ctx.author.mention}, there is no chapter `{chapter}` in `On the shortness of life`."
-            )
-
-        roman_num = int2roman(int(chapter))
-        title = f"On the shortness of life: Chapter {roman_num}"
-        passage = self.lib["shortness"][chapter]
-        seneca = self.lib["media"]["seneca"]
-        passage_url = f"{seneca['shortness']}/Chapter_{roman_num}"
-
-        color = 0x00FFFF  # Red
-        to_send = split_within(passage, MAX_EMBED_LENGTH, [". "], keep_delim=True)
-
-        embed = self.generate_embed(title, to_send[0], seneca, passage_url, color)
-
-        embeds = []
-        embeds.append(embed)
-        if len(to_send) > 1:
-            # Shortness of life doesn't have any passages over 2 embeds long
-            embeds.append(discord.Embed(description=to_send[1], color=color))
-        await self.deletables(ctx, embeds)
+        await self.lookup(ctx, "shortness", chapter)
 
     @bridge.bridge_command(
         name="discourses",
         help="[*The Discourses*](https://en.wikisource.org/wiki/Epictetus,_the_Discourses_as_reported_by_Arrian,_the_Manual,_and_Fragments) by Epictetus (Oldfather's translation). Example: .discourses 1:21",
         description="The Discourses by Epictetus (Oldfather's translation). Example: .discourses 1:21",
     )
-    @discord.option("bk_ch", description="Book number and chapter number. E.g. 2.1")
+    @bridge.bridge_option(
+        "bk_ch",
+        description="Book number and chapter number. E.g. 2.1",
+        autocomplete=reference_autocomplete("discourses"),
+    )
     async def discourses(self, ctx, bk_ch: str = ""):
-        bk, cha = None, None
-        try:
-            if not bk_ch:
-                bk, cha = uniform_random_choice_from_dict(self.lib["discourses"])
-            elif bk_ch == "toc":  # Shows table of contents
-                return await self.table_of_contents(ctx, "discourses")
-            else:
-                bk, cha = re.split("[:\.]", bk_ch, maxsplit=1)
-        except ValueError:
-            return await ctx.respond(
-                f"{ctx.author.mention}, invalid formatting. The correct syntax is `<BOOK>:<CHAPTER>`, e.g., `1:21` for Book 1, Chapter 21."
-            )
-
-        if not (bk in self.lib["discourses"]):
-            return await ctx.respond(
-                f"{ctx.author.mention}, there is no Book `{bk}` in *The Discourses* (or it may have been lost to time 😢)."
-            )
-
-        if not (cha in self.lib["discourses"][bk]):
-            return await ctx.respond(
-                f"{ctx.author.mention}, there is no chapter `{cha}` in Book `{bk}` of *The Discourses*."
-            )
-
-        title, passage = self.lib["discourses"][bk][cha].split("\n", maxsplit=1)
-        title = f"The Discourses – Book {int2roman(int(bk))}, Chapter {cha}\n{title}"
-        passage = passage.lstrip()
-        epictetus = self.lib["media"]["epictetus"]  # author data
-        passage_url = f"{epictetus['discourses']}/Book_{bk}/Chapter_{cha}"
-        color = 0x00FF00  # Green
-
-        if len(passage) > MAX_EMBED_LENGTH:
-            to_send = split_within(
-                passage, MAX_EMBED_LENGTH, ["\n", ". "], keep_delim=True
-            )
-            embeds = [
-                self.generate_embed(title, t, epictetus, passage_url, color)
-                for t in to_send
-            ]
-            await self.multi_page(ctx, embeds)
-            return
-
-        embed = self.generate_embed(title, passage, epictetus, passage_url, color)
-        embed.set_thumbnail(url=epictetus["thumbnail"])
-        await self.deletables(ctx, [embed])
+        await self.lookup(ctx, "discourses", bk_ch)
 
     @bridge.bridge_command(
         name="anger",
@@ -485,162 +524,168 @@ class Librarian(commands.Cog, name="Librarian"):
         help="[*Of Anger*](https://en.wikisource.org/wiki/Of_Anger) by Seneca (Stewart's translation). Example: .anger 2:10",
         description="Of Anger* by Seneca (Stewart's translation). Example: .anger 2:10",
     )
-    @discord.option("bk_ch", description="Book number and chapter number. E.g. 2.1")
+    @bridge.bridge_option(
+        "bk_ch",
+        description="Book number and chapter number. E.g. 2.1",
+        autocomplete=reference_autocomplete("anger"),
+    )
     async def anger(self, ctx, bk_ch: str = ""):
-        bk, cha = None, None
-        try:
-            if not bk_ch:
-                bk, cha = uniform_random_choice_from_dict(self.lib["discourses"])
-            else:
-                bk, cha = re.split("[:\.]", bk_ch, maxsplit=1)
-        except ValueError:
-            return await ctx.respond(
-                f"{ctx.author.mention}, invalid formatting. The correct syntax is `<BOOK>:<CHAPTER>`, e.g., `1:21` for Book 1, Chapter 21."
-            )
-
-        if not (bk in self.lib["discourses"]):
-            return await ctx.respond(
-                f"{ctx.author.mention}, there is no Book `{bk}` in *Of Anger*."
-            )
-
-        if not (cha in self.lib["discourses"][bk]):
-            return await ctx.respond(
-                f"{ctx.author.mention}, there is no chapter `{cha}` in Book `{bk}` in *Of Anger*."
-            )
-
-        roman_num = int2roman(int(bk))
-        title = f"Of Anger: Book {roman_num} Chapter {cha}"
-        passage = self.lib["anger"][bk][cha]
-        seneca = self.lib["media"]["seneca"]
-        passage_url = f"{seneca['anger']}/Book_{roman_num}#{int2roman(int(cha))}."
-
-        color = 0x00FFFF
-        to_send = split_within(passage, MAX_EMBED_LENGTH, ["\n", ". "], keep_delim=True)
-
-        embed = self.generate_embed(title, to_send[0], seneca, passage_url, color)
-
-        embeds = []
-        embeds.append(embed)
-        if len(to_send) > 1:
-            # Of Anger doesn't have any passages over 2 embeds long
-            embeds.append(discord.Embed(description=to_send[1], color=color))
-        await self.deletables(ctx, embeds)
+        await self.lookup(ctx, "anger", bk_ch)
 
     @bridge.bridge_command(
         name="musonius",
         aliases=["lectures", "lecture", "fragment"],
-        help="[*Lectures and Fragments*](https://sites.google.com/site/thestoiclife/the_teachers/musonius-rufus?authuser=0) by Musonius Rufus (Cora E. Lutz's translation). Example: `.musonius 4:3-6` gives §3-6 from Lecture 4. `.musonius 19 all` spews out all pages of Lecture 19 at once.",
+        help="[*Lectures and Fragments*](https://sites.google.com/site/thestoiclife/the_teachers/musonius-rufus?authuser=0) by Musonius Rufus (Cora E. Lutz's translation). Example: `.musonius 4:3-6` gives §3-6 from Lecture 4. `.musonius 19 all` spews out all pages of Lecture 19 at once, `.musonius 19 file` sends it as a file.",
         description="Lectures and Fragments by Musonius Rufus (Cora E. Lutz's translation). Example: .musonius 4:3-6",
     )
-    @discord.option(
+    @bridge.bridge_option(
         "lec_para",
         description="Chapter number and paragraph number. Also supports ranges of paragraphs, e.g., 2.1-3",
+        autocomplete=reference_autocomplete("musonius"),
     )
     async def musonius(self, ctx, lec_para: str = "", post_all: str = ""):
-        lec, para = None, None
-        if any([s in lec_para for s in [":", "."]]):
-            lec, para = re.split("[:\.]", lec_para, maxsplit=1)
-        else:
-            lec = lec_para
+        await self.lookup(ctx, "musonius", lec_para, post_all)
 
-        if not lec_para:
-            lec = str(
-                random.randrange(1, 54)
-            )  # Choose a random text of the 53 lectures  / fragments
-        elif not (lec in self.lib["musonius"]):
+    @bridge.bridge_command(
+        name="random",
+        description="Posts a random passage or chapter from any of the available books.",
+        help="Posts a random passage or chapter from any of the available books. `.random short` posts a short quote instead, `.random <200` one of at most 200 characters.",
+    )
+    @bridge.bridge_option(
+        "length",
+        description="`short` for a short quote, or e.g. `short 200` for at most 200 characters",
+    )
+    async def random(self, ctx, length: str = ""):
+        if length:
+            match = LENGTH_BOUND.match(length.strip())
+            if not match:
+                return await ctx.respond(
+                    f"{ctx.author.mention}, `{length}` is not a length. Try `short` or e.g. `short 200`."
+                )
+            return await self.quote.slash_variant(
+                ctx, match[1] or str(SHORT_QUOTE_LENGTH)
+            )
+
+        # Put every function in the library that's turned on in to a list
+        functions = [getattr(self, book) for book in self.enabled_books(ctx.guild)]
+        if not functions:
             return await ctx.respond(
-                f"{ctx.author.mention}, there is no Lecture no. `{lec}` in Musonius' lectures / fragments."
+                f"{ctx.author.mention}, every book is turned off on this server."
             )
+        func = random.choice(functions)
+        logger.info(f"Choosing a random chapter/passage from {func.slash_variant.name}")
+        await func.slash_variant(ctx)
 
-        passage = None
-        musonius = self.lib["media"]["musonius"]
-        if para:
-            if "-" in para:
-                para1, para2 = para.split("-", maxsplit=1)
-                if not 0 < int(para1) < int(para2) or not (
-                    para1 in self.lib["musonius"][lec]
-                    and para2 in self.lib["musonius"][lec]
-                ):
-                    return await ctx.respond(
-                        f"{ctx.author.mention}, `{para1}-{para2}` is not a valid range."
-                    )
-                passage = " ".join(
-                    [
-                        self.lib["musonius"][lec][str(ch)]
-                        for ch in range(int(para1), int(para2) + 1)
-                    ]
-                ).rstrip()
-            else:
-                if not (int(para) > 0 and para in self.lib["musonius"][lec]):
-                    return await ctx.respond(
-                        f"{ctx.author.mention}, there is no paragraph `{para}` in lecture `{lec}` of Musonius' Lectures."
-                    )
-                passage = self.lib["musonius"][lec][para].rstrip()
-        else:
-            lecture_passages = list(self.lib["musonius"][lec].values())[1:]
-            passage = "".join(lecture_passages)
-        title = f"{self.lib['musonius'][lec]['0']}"
-
-        if para:
-            title += f"\n§{para}"
-
-        # Handle links
-        passage_url = (
-            f"{musonius['url']}/lectures/{int(lec):02}"
-            if int(lec) <= 21
-            else f"{musonius['url']}/fragments/{int(lec):02}"
+    async def render_sentence(self, book: str, ref: str, n: int):
+        # A sentence in the embed of the passage it's from
+        embeds, _ = await self.render_reference(book, ref)
+        embed = embeds[0].copy()
+        embed.description = self.corpus.sentence(book, ref, n)
+        embed.set_footer(
+            text=f"Sentence {n} of {len(self.lib['sentences'][book][ref])} · {ref}#{n}"
         )
+        return embed
 
-        # Add additional string for fragmented texts
-        if lec in ["13", "18"]:
-            passage_url = passage_url + "-0"
-
-        color = 0xFFEEFF  # white (?)
-        if len(passage) > MAX_EMBED_LENGTH and not para:
-            to_send = split_within(
-                passage, MAX_EMBED_LENGTH, ["\n", ". "], keep_delim=True
+    @bridge.bridge_command(
+        name="quote",
+        description="Posts a random one-sentence quote, or the sentence asked for. Example: .quote letters 19:3#2",
+        help=f"Posts a random sentence of at most the given number of characters (default {SHORT_QUOTE_LENGTH}) from any of the available books, e.g. `.quote 200`. `.quote letters` quotes a random sentence of the letters, `.quote letters 19:3#2` the second sentence of Letter 19, §3.",
+    )
+    @bridge.bridge_option(
+        "source",
+        description=f"A book, or the longest quote in characters. Default: {SHORT_QUOTE_LENGTH}",
+    )
+    @bridge.bridge_option(
+        "reference", description="Passage, and which of its sentences, e.g. 19:3#2"
+    )
+    async def quote(self, ctx, source: str = "", reference: str = ""):
+        source = source.strip().lower()
+        if source in BOOKS:
+            if source not in self.enabled_books(ctx.guild):
+                return await ctx.respond(
+                    f"{ctx.author.mention}, {WORKS[source]} is turned off on this server."
+                )
+            if reference:
+                return await self.quote_sentence(ctx, source, reference)
+            books, max_length = [source], SHORT_QUOTE_LENGTH
+        elif not source or source.isdigit():
+            books = self.enabled_books(ctx.guild)
+            max_length = int(source or SHORT_QUOTE_LENGTH)
+        else:
+            return await ctx.respond(
+                f"{ctx.author.mention}, `{source}` is neither a book nor a length. Try `.quote 200` or `.quote letters`."
             )
 
-            # Post every embed if "all" parameter is passed, else do flippable embed pages
-            if post_all == "all":
-                embeds = [
-                    self.generate_embed(title, to_send[0], musonius, passage_url, color)
-                ]
-                for t in to_send[1:]:
-                    embeds.append(discord.Embed(description=t, color=color))
-                await self.deletables(ctx, embeds)
-            else:
-                embeds = [
-                    self.generate_embed(title, t, musonius, passage_url, color)
-                    for t in to_send
-                ]
-                await self.multi_page(ctx, embeds)
-            return
-
-        embed = self.generate_embed(title, passage, musonius, passage_url, color)
-        embeds = [embed]
-        await self.deletables(ctx, embeds)
+        choice = self.corpus.random_sentence(max_length, books)
+        if choice is None:
+            return await ctx.respond(
+                f"{ctx.author.mention}, there is no quote of at most {max_length} characters."
+            )
+        book, reference = choice
+        logger.info(f"Choosing a quote of at most {max_length} characters from {book}")
+        ref, n = reference.split("#")
+        await self.deletables(ctx, [await self.render_sentence(book, ref, int(n))])
+
+    async def quote_sentence(self, ctx, book: str, reference: str):
+        # Quotes sentence n of a passage given as "<reference>#<n>", or a random one
+        # of its sentences if there's no n
+        try:
+            ref, n = self.corpus.resolve_sentence(book, reference)
+        except LibraryError as e:
+            suggestion = ""
+            if isinstance(e, NotFound):
+                ref = reference.partition("#")[0]
+                suggestion = self.did_you_mean(ctx, book, ref, f"quote {book}")
+            return await ctx.respond(f"{ctx.author.mention}, {e}{suggestion}")
+        await self.deletables(ctx, [await self.render_sentence(book, ref, n)])
 
     @bridge.bridge_command(
-        name="random",
-        description="Posts a random passage or chapter from any of the available books.",
-        help="Posts a random passage or chapter from any of the available books.",
+        name="export",
+        aliases=["download"],
+        description="Sends a whole book, or a range of it, as a markdown file. Example: .export letters 19-25",
+        help="Sends a whole book, or a range of its letters, lectures or books, as one markdown file. Example: `.export discourses 2` for Book 2 of the Discourses, `.export letters 19-25`, `.export enchiridion` for all of it.",
     )
-    async def random(self, ctx):
-        # Put every function in the library in to a list
-        functions = [
-            self.enchiridion,
-            self.discourses,
-            self.meditations,
-            self.shortness,
-            self.happylife,
-            self.letters,
-            self.anger,
-            self.musonius,
-        ]
-        func = random.choice(functions)
-        print(f"Choosing a random chapter/passage from {func.slash_variant.name}")
-        await func.slash_variant(ctx)
+    @bridge.bridge_option("book", description="Name of the book", choices=BOOKS)
+    @bridge.bridge_option(
+        "part",
+        description="Letter, lecture, book or chapter number, or a range of them, e.g. 19-25. Default: everything",
+    )
+    async def export(self, ctx, book: str, part: str = ""):
+        if book not in BOOKS:
+            return await ctx.respond(
+                f"{ctx.author.mention}, there is no book `{book}`. Choose from {', '.join(f'`{b}`' for b in BOOKS)}."
+            )
+        if book not in self.enabled_books(ctx.guild):
+            return await ctx.respond(
+                f"{ctx.author.mention}, {WORKS[book]} is turned off on this server."
+            )
+
+        keys = numbered(self.lib[book])
+        if part:
+            first, last = (part.split("-", maxsplit=1) + [part])[:2]
+            if not (first in self.lib[book] and last in self.lib[book]):
+                return await ctx.respond(
+                    f"{ctx.author.mention}, there is no `{part}` in {WORKS[book]}."
+                )
+            if int(first) > int(last):
+                return await ctx.respond(
+                    f"{ctx.author.mention}, `{part}` is not a valid range."
+                )
+            keys = keys[keys.index(first) : keys.index(last) + 1]
+
+        # Writing out a whole work takes a while, so it's done in a worker process, and
+        # once for everyone asking for the same export at the same time
+        shared = await self.flights.do(
+            ("export", book, keys[0], keys[-1]), self.build_export, book, keys
+        )
+        filename = f"{book}-{part}.md" if part else f"{book}.md"
+        # Those share the file, and upload it one at a time. The last of them to
+        # have sent it closes it, even if sending failed.
+        async with shared as fp:
+            await ctx.respond(
+                f"{ctx.author.mention}, here is {WORKS[book]}{f' {part}' if part else ''}.",
+                file=discord.File(fp, filename=filename),
+            )
 
     @bridge.bridge_command(
         name="toc",
@@ -648,9 +693,10 @@ class Librarian(commands.Cog, name="Librarian"):
         description="Shows table of contents (if any) of a given book. Example: .toc letters",
         help="Shows table of contents (if any) of a given book. Example: .toc letters",
     )
-    @discord.option(
+    @bridge.bridge_option(
         "title",
         description="Title of the book you want the table of contents for. Can be u",
+        autocomplete=reference_autocomplete("toc"),
     )
     async def table_of_contents(self, ctx, title: str):
         try:
@@ -680,4 +726,4 @@ class Librarian(commands.Cog, name="Librarian"):
 
 def setup(bot):
     bot.add_cog(Librarian(bot))
-    print("Librarian cog up and ready!")
+    logger.info("Librarian cog up and ready!")
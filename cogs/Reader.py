@@ -0,0 +1,171 @@
+import logging
+
+import discord
+from discord.ext import bridge, commands
+
+from corpus import shared_corpus
+from librarian import BOOKS, WORKS, LibraryError
+from store import ReadingStore, guild_config
+
+logger = logging.getLogger(__name__)
+
+
+class Reader(commands.Cog, name="Reader"):
+    """Keeps your place in the books, with bookmarks"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.store = ReadingStore()
+        self.corpus = shared_corpus()
+
+    def cog_unload(self):
+        self.bot.loop.create_task(self.store.close())
+
+    def resolve(self, book: str, reference: str) -> str:
+        # The reading unit a reference falls in, e.g. "19.3" in the letters is in
+        # letter "19". Takes whatever the book's command does, and raises the same
+        # LibraryError for what it doesn't.
+        reference = self.corpus.resolve(book, reference)
+        if reference in self.corpus.order(book)[1]:
+            return reference
+        return reference.split(":")[0]  # Paragraphs of a letter or lecture
+
+    def following(self, book: str, reference: str = None):
+        # The reading unit after a reference, the first one if there is none, or
+        # None at the end of the book
+        order, index = self.corpus.order(book)
+        if reference not in index:
+            return order[0]
+        i = index[reference] + 1
+        return order[i] if i < len(order) else None
+
+    async def post(self, ctx, book: str, reference: str):
+        librarian = self.bot.get_cog("Librarian")
+        if librarian is None:  # Unloaded, and with it the book commands
+            return await ctx.respond(
+                f"{ctx.author.mention}, the books are unavailable right now. Please try again later."
+            )
+        self.store.set_position(ctx.author.id, book, reference)
+        await getattr(librarian, book).slash_variant(ctx, reference)
+
+    @bridge.bridge_command(
+        name="next",
+        description="Posts the next passage of the book you're reading. Example: .next letters",
+        help="Posts the next letter, lecture or chapter of what you're reading. `.next` continues the book you read last, `.next letters` continues the letters, and `.next letters 19` (re)starts them from Letter 19.",
+    )
+    @bridge.bridge_option(
+        "book",
+        description="Book to continue. Default: the one you read last",
+        choices=BOOKS,
+    )
+    @bridge.bridge_option(
+        "reference", description="Where to start from, e.g. 19 or 2:1"
+    )
+    async def next_passage(self, ctx, book: str = "", reference: str = ""):
+        await self.store.open()
+        user = ctx.author.id
+
+        if book and book not in BOOKS:
+            return await ctx.respond(
+                f"{ctx.author.mention}, there is no book `{book}`. Choose from {', '.join(f'`{b}`' for b in BOOKS)}."
+            )
+
+        if not book:
+            last = await self.store.position(user)
+            if last is None:
+                return await ctx.respond(
+                    f"{ctx.author.mention}, you haven't started reading anything yet. Try `.next letters`."
+                )
+            book, current = last
+            ref = self.following(book, current)
+        elif reference:
+            try:
+                ref = self.resolve(book, reference)
+            except LibraryError as e:
+                return await ctx.respond(f"{ctx.author.mention}, {e}")
+        else:
+            ref = self.following(book, await self.store.position(user, book))
+
+        if book in guild_config(self.bot, ctx.guild)["disabled"]:
+            return await ctx.respond(
+                f"{ctx.author.mention}, {WORKS[book]} is turned off on this server."
+            )
+        if ref is None:
+            return await ctx.respond(
+                f"{ctx.author.mention}, you've finished {WORKS[book]}! Start over with `.next {book} {self.corpus.order(book)[0][0]}`."
+            )
+        await self.post(ctx, book, ref)
+
+    @bridge.bridge_command(
+        name="bookmark",
+        aliases=["bookmarks"],
+        description="Saves, lists and opens bookmarks of where you are in the books.",
+        help="`.bookmark` lists your bookmarks, `.bookmark save joy` bookmarks where you are as `joy`, `.bookmark open joy` takes you back there and `.bookmark delete joy` removes it.",
+    )
+    @bridge.bridge_option(
+        "action",
+        description="What to do. Default: list",
+        choices=["list", "save", "open", "delete"],
+    )
+    @bridge.bridge_option("name", description="Name of the bookmark")
+    async def bookmark(self, ctx, action: str = "list", name: str = ""):
+        await self.store.open()
+        user = ctx.author.id
+
+        if action == "save":
+            last = await self.store.position(user)
+            if last is None:
+                return await ctx.respond(
+                    f"{ctx.author.mention}, there is nothing to bookmark yet. Start reading with `.next`."
+                )
+            book, ref = last
+            name = name or f"{book} {ref}"
+            await self.store.add_bookmark(user, name, book, ref)
+            return await ctx.respond(
+                f"{ctx.author.mention}, bookmarked {WORKS[book]} {ref} as `{name}`."
+            )
+
+        if action in ["open", "delete"] and not name:
+            return await ctx.respond(
+                f"{ctx.author.mention}, which bookmark? E.g. `.bookmark {action} joy`."
+            )
+
+        if action == "delete":
+            if not await self.store.delete_bookmark(user, name):
+                return await ctx.respond(
+                    f"{ctx.author.mention}, you have no bookmark `{name}`."
+                )
+            return await ctx.respond(
+                f"{ctx.author.mention}, deleted bookmark `{name}`."
+            )
+
+        bookmarks = await self.store.bookmarks(user)
+        if action == "open":
+            if name not in bookmarks:
+                return await ctx.respond(
+                    f"{ctx.author.mention}, you have no bookmark `{name}`."
+                )
+            book, ref = bookmarks[name]
+            if book in guild_config(self.bot, ctx.guild)["disabled"]:
+                return await ctx.respond(
+                    f"{ctx.author.mention}, {WORKS[book]} is turned off on this server."
+                )
+            return await self.post(ctx, book, ref)
+
+        if not bookmarks:
+            return await ctx.respond(
+                f"{ctx.author.mention}, you have no bookmarks. Save one with `.bookmark save`."
+            )
+        embed = discord.Embed(
+            title="Bookmarks",
+            description="\n".join(
+                f"`{n}` – {WORKS[book]} {ref}" for n, (book, ref) in bookmarks.items()
+            ),
+            color=discord.Color.orange(),
+        )
+        await ctx.respond(embed=embed)
+
+
+def setup(bot):
+    bot.add_cog(Reader(bot))
+    logger.info("Reader cog up and ready!")
@@ -0,0 +1,150 @@
+import datetime
+import logging
+import random
+
+import discord
+from discord.ext import bridge, commands, tasks
+
+from librarian import BOOKS, WORKS
+from store import GuildConfigStore
+from utilities import SHORT_QUOTE_LENGTH
+
+logger = logging.getLogger(__name__)
+
+# When the quote of the day is posted
+QOTD_TIME = datetime.time(hour=9, tzinfo=datetime.timezone.utc)
+SETTINGS = ["show", "prefix", "timeout", "enable", "disable", "qotd"]
+
+
+class Settings(commands.Cog, name="Settings"):
+    """Lets server managers configure the bot for their server"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.store = GuildConfigStore()
+
+    def cog_unload(self):
+        self.quote_of_the_day.cancel()
+        self.bot.loop.create_task(self.store.close())
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        await self.store.open()
+        if not self.quote_of_the_day.is_running():
+            self.quote_of_the_day.start()
+
+    def describe(self, config: dict) -> str:
+        disabled = config["disabled"]
+        channel = config["qotd_channel"]
+        return "\n".join(
+            [
+                f"**Prefix:** `{config['prefix']}`",
+                f"**Books:** {', '.join(f'~~{b}~~' if b in disabled else b for b in BOOKS)}",
+                f"**Page flipping timeout:** {config['timeout']} s",
+                f"**Quote of the day:** {f'<#{channel}>' if channel else 'off'}",
+            ]
+        )
+
+    @bridge.bridge_command(
+        name="config",
+        aliases=["settings"],
+        description="Configures the bot for this server. Example: .config prefix !",
+        help="Configures the bot for this server (needs Manage Server). `.config` shows the settings, `.config prefix !` changes the prefix, `.config disable letters` and `.config enable letters` turn a book's command off and on, `.config timeout 300` sets how long paged replies can be flipped through, and `.config qotd #channel` (or `off`) posts a quote of the day there.",
+    )
+    @commands.guild_only()
+    @commands.check_any(
+        commands.is_owner(), commands.has_guild_permissions(manage_guild=True)
+    )
+    @bridge.bridge_option(
+        "setting", description="What to change. Default: show", choices=SETTINGS
+    )
+    @bridge.bridge_option("value", description="New value")
+    async def config(self, ctx, setting: str = "show", value: str = ""):
+        await self.store.open()
+        guild = ctx.guild.id
+
+        if setting not in SETTINGS:
+            return await ctx.respond(
+                f"{ctx.author.mention}, there is no setting `{setting}`. Choose from {', '.join(f'`{s}`' for s in SETTINGS)}."
+            )
+        if setting != "show" and not value:
+            return await ctx.respond(
+                f"{ctx.author.mention}, what should `{setting}` be? See `help config`."
+            )
+
+        if setting == "prefix":
+            if len(value) > 5 or any(c.isspace() for c in value):
+                return await ctx.respond(
+                    f"{ctx.author.mention}, a prefix is at most 5 characters without spaces."
+                )
+            self.store.set(guild, "prefix", value)
+        elif setting == "timeout":
+            if not value.isdigit() or not 10 <= int(value) <= 3600:
+                return await ctx.respond(
+                    f"{ctx.author.mention}, the timeout is a number of seconds from 10 to 3600."
+                )
+            self.store.set(guild, "timeout", int(value))
+        elif setting in ["enable", "disable"]:
+            if value not in BOOKS:
+                return await ctx.respond(
+                    f"{ctx.author.mention}, there is no book `{value}`. Choose from {', '.join(f'`{b}`' for b in BOOKS)}."
+                )
+            disabled = set(self.store.get(guild)["disabled"])
+            if setting == "enable":
+                disabled.discard(value)
+            else:
+                disabled.add(value)
+            self.store.set(guild, "disabled", sorted(disabled))
+        elif setting == "qotd":
+            if value == "off":
+                self.store.set(guild, "qotd_channel", None)
+            else:
+                channel_id = value.strip("<#>")
+                channel = channel_id.isdigit() and ctx.guild.get_channel(
+                    int(channel_id)
+                )
+                if not isinstance(channel, discord.TextChannel):
+                    return await ctx.respond(
+                        f"{ctx.author.mention}, `{value}` is not a text channel of this server."
+                    )
+                self.store.set(guild, "qotd_channel", channel.id)
+
+        embed = discord.Embed(
+            title=f"Settings of {ctx.guild.name}",
+            description=self.describe(self.store.get(guild)),
+            color=discord.Color.orange(),
+        )
+        await ctx.respond(embed=embed)
+
+    @tasks.loop(time=QOTD_TIME)
+    async def quote_of_the_day(self):
+        librarian = self.bot.get_cog("Librarian")
+        if librarian is None:  # Unloaded, its passages can't be rendered
+            logger.warning(
+                "Skipped the quote of the day: the Librarian cog is unloaded"
+            )
+            return
+        for guild, config in list(self.store.configs.items()):
+            channel = self.bot.get_channel(config["qotd_channel"] or 0)
+            if channel is None:
+                continue
+            books = [b for b in BOOKS if b not in config["disabled"]]
+            weights = [librarian.lengths.count(SHORT_QUOTE_LENGTH, b) for b in books]
+            if not any(weights):
+                continue
+            book = random.choices(books, weights)[0]
+            reference = librarian.lengths.choice(SHORT_QUOTE_LENGTH, book)
+            embeds, _ = await librarian.render_reference(book, reference)
+            try:
+                await channel.send(
+                    content=f"**Quote of the day** from {WORKS[book]}", embeds=embeds
+                )
+            except discord.HTTPException as e:
+                logger.warning(
+                    f"Couldn't post the quote of the day: {e}", extra={"guild": guild}
+                )
+
+
+def setup(bot):
+    bot.add_cog(Settings(bot))
+    logger.info("Settings cog up and ready!")
@@ -0,0 +1,73 @@
+import discord
+
+from executors import Offload
+from librarian import BOOKS, Library
+from utilities import PrefixTrie, iter_references
+
+_shared = None  # The process' corpus, see shared_corpus()
+
+
+class Corpus(Library):
+    # The library with what the bot adds to it: the tries autocompletion searches,
+    # and the worker pools that were forked with a copy of it. Cogs hold it by
+    # reference, so reloading a cog's code neither reloads the books nor keeps a
+    # second copy of them around.
+
+    def __init__(self):
+        super().__init__()
+        self.completions = self.build_completions()
+        self.offload = Offload(self.lib)
+
+    def build_completions(self) -> dict:
+        # Prefix tries over the references and titles of every book, built once per
+        # corpus so that autocompletion never has to scan the library
+        toc = self.lib["toc"]
+        titles = {
+            "discourses": {
+                f"{bk}:{ch}": title
+                for bk, chapters in enumerate(
+                    toc["discourses"]["contents"].values(), start=1
+                )
+                for ch, title in enumerate(chapters, start=1)
+            }
+        }
+
+        completions = {}
+        for book in BOOKS:
+            trie = PrefixTrie()
+            titled = []
+            for ref in iter_references(self.lib[book]):
+                chapter = self.lib[book].get(ref)
+                if isinstance(chapter, dict):
+                    title = chapter.get("0")  # Letters and lectures
+                else:
+                    title = titles.get(book, {}).get(ref)
+                name = f"{ref} – {title}"[:100] if title else ref
+                choice = discord.OptionChoice(name=name, value=ref)
+                trie.insert(ref, choice)
+                if title:
+                    titled.append((title, choice))
+
+            # Titles can be searched from their beginning, and from any later word
+            # that says something ("on", "of" and "a" don't), after the references
+            for title, choice in titled:
+                words = title.lower().split()
+                for i, word in enumerate(words):
+                    if i == 0 or len(word) > 2:
+                        trie.insert(" ".join(words[i:]), choice)
+            completions[book] = trie
+
+        completions["toc"] = PrefixTrie()
+        for title in toc:
+            completions["toc"].insert(title, title)
+        return completions
+
+
+def shared_corpus() -> Corpus:
+    # Loaded by the first cog that asks for it. Extensions are imported afresh every
+    # time they're loaded, but this module only once, so the corpus lives as long as
+    # the process and every instance of a cog gets the same one.
+    global _shared
+    if _shared is None:
+        _shared = Corpus()
+    return _shared
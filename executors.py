@@ -0,0 +1,121 @@
+import asyncio
+import collections
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from scheduler import PRIORITIES, PriorityGate, priority
+from utilities import iter_markdown
+
+# Pool sizes, how many jobs each pool takes (queued or running) before callers have
+# to wait for a slot, and how many may wait before the least urgent are shed
+PROCESSES = int(os.getenv("OFFLOAD_PROCESSES", "2"))
+THREADS = int(os.getenv("OFFLOAD_THREADS", "4"))
+MAX_PENDING = int(os.getenv("OFFLOAD_MAX_PENDING", "64"))
+MAX_WAITING = int(os.getenv("OFFLOAD_MAX_WAITING", "64"))
+KINDS = ["cpu", "io"]
+
+_corpus = None  # The library, in the worker processes
+
+
+def _share_corpus(lib: dict):
+    global _corpus
+    _corpus = lib
+
+
+def corpus() -> dict:
+    # The library, for jobs running in a worker process
+    return _corpus
+
+
+def _started():
+    return os.getpid()
+
+
+def export_markdown(book: str, keys: list, title: str) -> str:
+    # Writes (part of) a book as markdown into a temporary file, chunk by chunk, and
+    # returns its path
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", suffix=".md", delete=False
+    ) as f:
+        for chunk in iter_markdown(corpus(), book, keys, title):
+            f.write(chunk)
+    return f.name
+
+
+class Offload:
+    # Runs blocking work away from the event loop: CPU-bound jobs in a pool of
+    # processes, blocking I/O (and short jobs that need the bot's objects) in a pool
+    # of threads. Slots go to the most urgent callers first (see scheduler.py). Keeps
+    # count of the jobs pending, waiting for a slot, done, shed, and the most that
+    # were pending at once, per pool.
+
+    def __init__(
+        self,
+        lib: dict,
+        processes: int = PROCESSES,
+        threads: int = THREADS,
+        max_pending: int = MAX_PENDING,
+        max_waiting: int = MAX_WAITING,
+    ):
+        # The workers are forked right away, before the bot starts any threads of
+        # its own, and inherit the library rather than get it pickled with each job
+        self.processes = ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_share_corpus,
+            initargs=(lib,),
+        )
+        self.processes.submit(_started)
+        self.threads = ThreadPoolExecutor(threads, thread_name_prefix="offload")
+        self.executors = {"cpu": self.processes, "io": self.threads}
+        self.slots = {kind: PriorityGate(max_pending, max_waiting) for kind in KINDS}
+        self.pending = collections.Counter()
+        self.waiting = collections.Counter()
+        self.peak = collections.Counter()
+        self.done = collections.Counter()
+
+    async def run(self, kind: str, func, *args):
+        self.waiting[kind] += 1
+        try:
+            await self.slots[kind].acquire(priority.get())
+        finally:
+            self.waiting[kind] -= 1
+        self.pending[kind] += 1
+        self.peak[kind] = max(self.peak[kind], self.pending[kind])
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executors[kind], func, *args
+            )
+        finally:
+            self.pending[kind] -= 1
+            self.done[kind] += 1
+            self.slots[kind].release()
+
+    async def cpu(self, func, *args):
+        # func and its arguments are pickled, so func has to be importable
+        return await self.run("cpu", func, *args)
+
+    async def io(self, func, *args):
+        return await self.run("io", func, *args)
+
+    def admit(self, kind: str, priority: int):
+        # For work that isn't run in a pool, but should queue with what is
+        return self.slots[kind].admit(priority)
+
+    def stats(self) -> dict:
+        return {
+            kind: {
+                "pending": self.pending[kind],
+                "waiting": self.waiting[kind],
+                "peak": self.peak[kind],
+                "done": self.done[kind],
+                "shed": {PRIORITIES[p]: n for p, n in self.slots[kind].shed.items()},
+            }
+            for kind in KINDS
+        }
+
+    def shutdown(self):
+        self.processes.shutdown(wait=False, cancel_futures=True)
+        self.threads.shutdown(wait=False, cancel_futures=True)
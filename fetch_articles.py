@@ -1,452 +1,1207 @@
+import argparse
+import collections
+import email.utils
+import glob
+import hashlib
+import importlib.util
 import json
+import os
+import random
 import re
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Callable
 
 import requests
-from bs4 import BeautifulSoup
-
-from utilities import int2roman
-
-
-def scrape_by_class(url: str, class_: str):
-    page = requests.get(url)
-    soup = BeautifulSoup(page.content, "html.parser")
+from bs4 import BeautifulSoup, SoupStrainer
+
+from utilities import (
+    CORPUS_MANIFEST_PATH,
+    CORPUS_PATH,
+    LIBRARY,
+    int2roman,
+    segment_library,
+)
+
+SOURCE_MANIFEST = "books/sources.json"
+# Raw pages of the last fetch, so later stages can be rerun offline
+PAGE_CACHE = "books/.cache"
+STAGES = ["fetch", "parse", "clean", "split", "merge", "write"]
+# Pages fetched at most this long ago are reused by --resume instead of fetched again
+RESUME_MAX_AGE = 24 * 3600
+# lxml builds trees several times faster than the stdlib parser, use it if it is installed
+PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+# (tag, class) selectors of the page furniture that is stripped before extracting text
+WS_HEADER = (
+    "div",
+    "ws-header wst-header-structure wst-unknown wst-header ws-header ws-noexport noprint dynlayout-exempt",
+)
+WS_LICENSE = ("div", "licenseContainer licenseBanner dynlayout-exempt")
+WS_REFERENCE = ("sup", "reference")
+WS_REFLIST = ("div", "reflist")
+WS_CENTER = ("div", "wst-center tiInherit wst-center-nomargin")
+
+TITLED_BOOKS = {
+    "letters",
+    "musonius",
+}  # Books whose chapters have their title at key "0"
+# Numbering gaps that are right, lecture 11 jumps from paragraph 21 to 23 in the source
+KNOWN_GAPS = {"musonius": {"11": {"22"}}}
+
+# Politeness towards the sites scraped. Every host starts at RATE requests per second
+# (at most BURST back to back), which speeds up to MAX_RATE while it answers quickly
+# and slows down to MIN_RATE when it answers slower than SLOW_RESPONSE or refuses.
+RATE = 2.0
+MIN_RATE = 0.2
+MAX_RATE = 8.0
+BURST = 4
+SLOW_RESPONSE = 2.0  # Seconds
+TIMEOUT = 30  # Seconds before a request is given up on
+RETRIES = 4  # Retries of a failed request before the page counts as failed
+BACKOFF = 1.0  # Longest random wait before the first retry, doubled with every retry
+MAX_BACKOFF = 60.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+USER_AGENT = (
+    "Librarian_of_Stoa scraper (+https://github.com/Jullan-M/Librarian_of_Stoa)"
+)
+
+
+class FetchError(Exception):
+    pass
+
+
+class HostLimiter:
+    # Token bucket for the requests to one host, whose rate adapts additively up and
+    # multiplicatively down: every quick response raises it a little, while slow
+    # responses, timeouts and 429/503 halve it (once per second at most, as the
+    # requests already out tend to fail together). A Retry-After holds back every
+    # request to the host until it has passed. Shared by the fetching threads.
+
+    def __init__(self, rate: float = RATE, burst: int = BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.not_before = 0.0  # Until when the host asked to be left alone
+        self.slowed = 0.0  # When the rate was last halved
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        # Blocks until a request may go out, and returns how long that took
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                delay = max(self.not_before - now, (1 - self.tokens) / self.rate)
+                if delay <= 0:
+                    self.tokens -= 1
+                    return waited
+            time.sleep(delay)
+            waited += delay
+
+    def slow_down(self):
+        now = time.monotonic()
+        if now - self.slowed >= 1:
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self.slowed = now
+
+    def responded(self, latency: float):
+        with self.lock:
+            if latency > SLOW_RESPONSE:
+                self.slow_down()
+            else:
+                self.rate = min(MAX_RATE, self.rate + 0.1)
+
+    def refused(self, retry_after: float = None):
+        with self.lock:
+            self.slow_down()
+            self.tokens = min(self.tokens, 0.0)
+            if retry_after:
+                self.not_before = max(self.not_before, time.monotonic() + retry_after)
+
+
+def retry_after(value: str):
+    # Seconds to wait from a Retry-After header, which is either seconds or a date
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class Fetcher:
+    # Fetches pages politely and persistently: rate limited per host, retrying
+    # timeouts, dropped connections, 429 and 5xx a few times with jittered exponential
+    # backoff. Counts what it did for the summary.
+
+    def __init__(self, retries: int = RETRIES):
+        self.retries = retries
+        self.limiters = {}  # host -> HostLimiter
+        self.local = threading.local()  # A session per thread keeps connections open
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+
+    def count(self, **amounts):
+        with self.lock:
+            self.stats.update(amounts)
+
+    def limiter(self, url: str) -> HostLimiter:
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = HostLimiter()
+            return self.limiters[host]
+
+    def session(self) -> requests.Session:
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+            self.local.session.headers["User-Agent"] = USER_AGENT
+        return self.local.session
+
+    def get(self, url: str) -> bytes:
+        limiter = self.limiter(url)
+        for attempt in range(self.retries + 1):
+            self.count(waited=limiter.acquire(), requests=1)
+            start = time.perf_counter()
+            wait = None
+            try:
+                response = self.session().get(url, timeout=TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = f"{type(e).__name__}: {e}"
+                limiter.refused()
+            else:
+                if response.ok:
+                    limiter.responded(time.perf_counter() - start)
+                    self.count(pages=1, bytes=len(response.content))
+                    return response.content
+                error = f"HTTP {response.status_code}"
+                if response.status_code not in RETRY_STATUSES:
+                    break
+                if response.status_code in [429, 503]:
+                    wait = retry_after(response.headers.get("Retry-After"))
+                    limiter.refused(wait)
+                    self.count(refused=1)
+                else:
+                    limiter.responded(time.perf_counter() - start)
+            if attempt < self.retries:
+                self.count(retries=1)
+                if wait is None:  # A Retry-After is waited out by the limiter
+                    time.sleep(
+                        random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2**attempt))
+                    )
+        self.count(failed=1)
+        raise FetchError(f"{error} after {attempt + 1} attempt(s)")
+
+
+class Refresh:
+    # Remembers the content hash of every scraped page together with the passages
+    # it produced, so that a rerun only re-parses the pages that changed upstream
+    # and only rewrites the books that actually differ.
+
+    def __init__(
+        self,
+        manifest_path: str = SOURCE_MANIFEST,
+        force: bool = False,
+        offline: bool = False,
+        resume: bool = False,
+    ):
+        self.manifest_path = manifest_path
+        self.force = force  # Re-parse every page regardless of its hash
+        self.offline = offline  # Read pages from PAGE_CACHE instead of fetching them
+        # Read pages fetched less than RESUME_MAX_AGE ago from PAGE_CACHE, e.g. to
+        # carry on with a run that was interrupted or had pages fail
+        self.resume = resume
+        self.fetcher = Fetcher()
+        self.cached = 0  # Pages read from PAGE_CACHE
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {"pages": {}, "changes": {}}
+        self.pages = {}  # url -> page content fetched during this run
+        self.hashes = {}  # url -> sha256 of the page content
+        self.books = {}  # name -> book as currently written to disk
+        self.changes = {}  # name -> references of passages that changed
+        self.invalid = {}  # name -> problems that kept the book from being written
+        # name -> {url: manifest entry} of the pages parsed, which only go into the
+        # manifest once their book was written (or found unchanged)
+        self.staged = {}
+
+    def get(self, url: str) -> bytes:
+        # Fetches a page once per run, keeps a copy in PAGE_CACHE and hashes its content
+        if url not in self.pages:
+            name = hashlib.sha1(url.encode()).hexdigest()
+            path = os.path.join(PAGE_CACHE, f"{name}.html")
+            if self.offline or self.resume and self.fresh(path):
+                with open(path, "rb") as f:
+                    content = f.read()
+                self.cached += 1
+            else:
+                content = self.fetcher.get(url)
+                os.makedirs(PAGE_CACHE, exist_ok=True)
+                # A run interrupted mid-write mustn't leave a truncated page to resume from
+                with open(f"{path}.tmp", "wb") as f:
+                    f.write(content)
+                os.replace(f"{path}.tmp", path)
+            self.pages[url] = content
+            self.hashes[url] = hashlib.sha256(content).hexdigest()
+        return self.pages[url]
+
+    @staticmethod
+    def fresh(path: str) -> bool:
+        try:
+            return time.time() - os.path.getmtime(path) < RESUME_MAX_AGE
+        except OSError:
+            return False
+
+    def previous(self, name: str) -> dict:
+        # The book as it was written by the last run (empty if there is none)
+        if name not in self.books:
+            try:
+                with open(f"books/{name}.json", "r", encoding="utf-8") as f:
+                    self.books[name] = json.load(f)
+            except FileNotFoundError:
+                self.books[name] = {}
+        return self.books[name]
+
+    def unchanged(self, url: str, name: str, ref: str = "") -> bool:
+        # True if the page is identical to the one seen by the last run and the
+        # passage it produced (or the whole book, if no reference is given) is still on disk
+        self.get(url)
+        entry = self.manifest["pages"].get(url)
+        if self.force or not entry or entry["hash"] != self.hashes[url]:
+            return False
+        node = self.previous(name)
+        for key in ref.split(":") if ref else []:
+            if not isinstance(node, dict) or key not in node:
+                return False
+            node = node[key]
+        return bool(node)
+
+    def reuse(self, name: str, ref: str):
+        # Returns the passage (or chapter) at ref from the previous run
+        node = self.previous(name)
+        for key in ref.split(":"):
+            node = node[key]
+        return node
+
+    def record(self, url: str, name: str, refs: list):
+        # Stores the hash of a freshly parsed page and the passages it produced
+        self.pages.pop(url, None)  # The content is not needed anymore
+        self.staged.setdefault(name, {})[url] = {
+            "hash": self.hashes[url],
+            "book": name,
+            "passages": [str(r) for r in refs],
+        }
+
+    def write(self, name: str, book: dict):
+        # Patches the changed passages into books/<name>.json. Books without
+        # any changes are left untouched on disk.
+        book = stringify_keys(book)
+        old = self.previous(name)
+        changed = []
+        for key in book.keys() | old.keys():
+            new_val, old_val = book.get(key), old.get(key)
+            if isinstance(new_val, dict) or isinstance(old_val, dict):
+                new_val, old_val = new_val or {}, old_val or {}
+                changed.extend(
+                    f"{key}:{k}"
+                    for k in new_val.keys() | old_val.keys()
+                    if new_val.get(k) != old_val.get(k)
+                )
+            elif new_val != old_val:
+                changed.append(key)
+
+        if not changed:
+            self.manifest["pages"].update(self.staged.pop(name, {}))
+            print(f"{name}: unchanged")
+            return
+
+        problems = validate_book(name, book)
+        if problems:
+            # Keep the last good version rather than shipping a broken book
+            self.invalid[name] = problems
+            print(f"{name}: not written, {len(problems)} problem(s) found")
+            return
+
+        self.changes[name] = sorted(changed, key=ref_sort_key)
+        write_json_atomic(f"books/{name}.json", book)
+        self.manifest["pages"].update(self.staged.pop(name, {}))
+        self.books[name] = book
+        print(f"{name}: {len(changed)} passage(s) changed")
+
+    def save(self):
+        # Writes the manifest along with the changes of this run. The bot uses
+        # "changes" to tell which books have to be reloaded.
+        self.manifest["changes"] = self.changes
+        write_json_atomic(self.manifest_path, self.manifest)
+
+        print("\n--- Refresh summary ---")
+        if not self.changes:
+            print("No passages changed.")
+        for name, refs in self.changes.items():
+            print(f"{name}: {', '.join(refs)}")
+        for name, problems in self.invalid.items():
+            print(f"{name} was not written:")
+            for problem in problems:
+                print(f"\t{problem}")
+
+
+class HashingWriter:
+    # File-like wrapper hashing and counting the bytes json.dump streams through it
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, s: str):
+        data = s.encode("utf-8")
+        self.sha256.update(data)
+        self.size += len(data)
+        self.f.write(data)
+
+
+def write_json_atomic(path: str, obj, compact: bool = False) -> HashingWriter:
+    # Streams obj to a temporary file next to path and renames it into place, so that
+    # an interrupted run never leaves a truncated file behind
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            writer = HashingWriter(f)
+            if compact:
+                json.dump(obj, writer, ensure_ascii=False, separators=(",", ":"))
+            else:
+                json.dump(obj, writer, ensure_ascii=False, indent="\t")
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)  # mkstemp only gives the owner access
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return writer
+
+
+def validate_book(name: str, book: dict) -> list:
+    # Returns the structural problems of a book: numbering that is not contiguous
+    # from 1, empty passages and missing titles
+    if not book:
+        return [f"{name} is empty"]
+
+    problems = []
+    nested = all(isinstance(v, dict) for v in book.values())
+    if nested:
+        problems += check_numbering(name, book.keys())
+    for key, chapter in book.items() if nested else [("", book)]:
+        where = f"{name} {key}".rstrip()
+        if name in TITLED_BOOKS:
+            chapter = chapter.copy()
+            if not str(chapter.pop("0", "")).strip():
+                problems.append(f'{where} has no title at key "0"')
+        gaps = KNOWN_GAPS.get(name, {}).get(key, set())
+        problems += check_numbering(where, chapter.keys(), gaps)
+        problems += [
+            f"{where}:{k} is empty"
+            for k, passage in chapter.items()
+            if not isinstance(passage, str) or not passage.strip()
+        ]
+    return problems
+
+
+def check_numbering(where: str, keys, gaps: set = set()) -> list:
+    if not keys:
+        return [f"{where} has no passages"]
+    if not all(k.isdigit() for k in keys):
+        return [f"{where} has non-numeric keys"]
+    numbers = {int(k) for k in keys}
+    expected = {n for n in range(1, max(numbers) + 1) if f"{n}" not in gaps}
+    missing = sorted(expected - numbers)
+    if missing or min(numbers) < 1:
+        return [f"{where} is not numbered 1-{max(numbers)}, missing {missing}"]
+    return []
+
+
+def build_corpus():
+    # Bundles every book into one compact artifact that the bot loads at startup, and
+    # writes a manifest with its hash so the bot can verify it instead of validating it
+    corpus = {}
+    for name in LIBRARY:
+        with open(f"books/{name}.json", "r", encoding="utf-8") as f:
+            corpus[name] = json.load(f)
+        problems = validate_book(name, corpus[name]) if name in SPECS else []
+        if problems:
+            raise ValueError(f"books/{name}.json is invalid: {'; '.join(problems)}")
+    # Where every sentence ends, so the bot can quote single sentences by slicing
+    corpus["sentences"] = segment_library(corpus)
+
+    writer = write_json_atomic(CORPUS_PATH, corpus, compact=True)
+    digest = writer.sha256.hexdigest()
+    manifest = {
+        "version": digest[:12],
+        "sha256": digest,
+        "size": writer.size,
+        "built": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "passages": {
+            name: count_passages(name, book)
+            for name, book in corpus.items()
+            if name in SPECS
+        },
+        "sentences": {
+            name: sum(len(ends) for ends in book.values())
+            for name, book in corpus["sentences"].items()
+        },
+    }
+    # The manifest goes last, a crash before this leaves the old manifest which won't match
+    write_json_atomic(CORPUS_MANIFEST_PATH, manifest)
+    print(f"Built {CORPUS_PATH} ({writer.size} bytes), version {manifest['version']}")
+
+
+def count_passages(name: str, book: dict) -> int:
+    titled = name in TITLED_BOOKS
+    return sum(len(v) - titled if isinstance(v, dict) else 1 for v in book.values())
+
+
+def stringify_keys(book: dict) -> dict:
+    # json turns int keys into strings; do the same so books can be compared with what is on disk
+    return {
+        str(k): stringify_keys(v) if isinstance(v, dict) else v for k, v in book.items()
+    }
+
+
+def ref_sort_key(ref: str):
+    return [int(k) if k.isdigit() else 0 for k in ref.split(":")]
+
+
+def class_matcher(class_: str):
+    # While parsing, the strainer sees the raw class attribute (e.g. "mw-content-ltr mw-parser-output"),
+    # so match on the classes it contains rather than on the whole string
+    wanted = set(class_.split())
+
+    def match(value):
+        if not value:
+            return False
+        return wanted <= set(value.split() if isinstance(value, str) else value)
+
+    return match
+
+
+def scrape_by_class(content: bytes, class_: str, parser: str = None):
+    # Only the divs of the given class are built into a tree, the rest of the page is skipped while parsing
+    strainer = SoupStrainer("div", class_=class_matcher(class_))
+    soup = BeautifulSoup(content, parser or PARSER, parse_only=strainer)
     return soup.find_all("div", class_=class_)
 
 
-def fetch_meditations():
-    book = {}
-
-    for i in range(1, 13):
-        print(f"Fetching Book {i} of 12", end="\r")
-        url = f"https://en.wikisource.org/wiki/The_Meditations_of_the_Emperor_Marcus_Antoninus/Book_{i}"
-        results = scrape_by_class(url, "prp-pages-output")
-        text = results[-1].text
-
-        chapter = {}
-        txt_split = re.split("\d+[\. ]", text)[1:]
-        for ps, t in enumerate(txt_split):
-            chapter[ps + 1] = re.sub(
-                "[\u200b\u200c\u200d\u2060]|\[\d+\]", "", t
-            ).strip()
-        book[i] = chapter
-
-    with open("books/meditations.json", "w") as f:
-        f.write(json.dumps(book, indent="\t"))
-
-
-def fetch_enchiridion():
-    book = {}
-
-    url = f"https://en.wikisource.org/wiki/Epictetus,_the_Discourses_as_reported_by_Arrian,_the_Manual,_and_Fragments/Manual"
-    results = scrape_by_class(url, "prp-pages-output")
-    references = results[-1].find_all("sup", class_="reference")
-    for r in references:
-        r.extract()
-    text = results[-1].text
-    text = re.sub("[\u200b\u200c\u200d\u2060]", "", text)
-
-    txt_split = re.split("\n\d+\.", text)[1:]
-    for ps, t in enumerate(txt_split):
-        book[ps + 1] = re.sub("(?<!\n)\n(?!\n)", "\n\n", t).strip()
-
-    with open("books/enchiridion.json", "w", encoding="utf-8") as f:
-        f.write(json.dumps(book, indent="\t", ensure_ascii=False))
-
-
-def fetch_letters():
-    book = {}
-
-    for i in range(1, 125):
-        print(f"Fetching Letter {i} of 124", end="\n")
-        url = f"https://en.wikisource.org/wiki/Moral_letters_to_Lucilius/Letter_{i}"
-        results = scrape_by_class(url, "mw-parser-output")
-
-        # Remove superfluous stuff
-        headerContainer = results[0].find_all(
-            "div",
-            class_="ws-header wst-header-structure wst-unknown wst-header ws-header ws-noexport noprint dynlayout-exempt",
+def strip_elements(root, *selectors):
+    # Removes every element matching one of the (tag, class) selectors in a single
+    # traversal. A class of None matches every element with that tag, and an element
+    # matches if it has all the classes of the selector.
+    wanted = {}
+    for name, class_ in selectors:
+        wanted.setdefault(name, []).append(frozenset(class_.split() if class_ else ()))
+
+    def match(tag):
+        rules = wanted.get(tag.name)
+        if rules is None:
+            return False
+        classes = set(tag.get("class") or ())
+        return any(rule <= classes for rule in rules)
+
+    for element in root.find_all(match):
+        element.extract()
+
+
+def benchmark_parsing(directory: str, class_: str, repeat: int = 3):
+    # Times parsing the saved pages (*.html) in directory, building the full tree
+    # like we used to versus building only the wanted container, for every installed parser
+    pages = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.htm*"))):
+        with open(path, "rb") as f:
+            pages.append(f.read())
+    if not pages:
+        print(f"No saved pages (*.html) found in {directory}")
+        return
+
+    parsers = ["html.parser"] + [p for p in ["lxml"] if importlib.util.find_spec(p)]
+    print(f"Parsing {len(pages)} page(s), best of {repeat}")
+    for parser in parsers:
+        for label, strainer in [
+            ("full tree", None),
+            ("strained", SoupStrainer("div", class_=class_matcher(class_))),
+        ]:
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for content in pages:
+                    soup = BeautifulSoup(content, parser, parse_only=strainer)
+                    soup.find_all("div", class_=class_)
+                best = min(best, time.perf_counter() - start)
+            print(f"{parser:<12}{label:<12}{best * 1000 / len(pages):8.2f} ms/page")
+
+
+class Normalizer:
+    # Applies the cleanups of scraped text with precompiled patterns and constant
+    # replacements, so every substitution runs entirely in the regex engine:
+    # - zero-width characters and footnote markers ("[12]") are deleted by one regex,
+    # - triple line breaks are collapsed and lone ones doubled by one regex.
+    # Gives the same result as running the rules one after another in that order.
+
+    def __init__(
+        self,
+        zero_width: bool = False,
+        footnotes: bool = False,
+        collapse: bool = False,
+        double: bool = False,
+    ):
+        removals = []
+        if zero_width:
+            removals.append("[\u200b\u200c\u200d\u2060]")
+        if footnotes:
+            removals.append(r"\[\d+\]")
+        self.removal = re.compile("|".join(removals)) if removals else None
+
+        breaks = []
+        if collapse:
+            breaks.append("\n\n")  # "\n\n\n" -> "\n\n"
+        if double:
+            breaks.append("(?<!\n\n)(?!\n)")  # A lone "\n" -> "\n\n"
+        # Both rules start with a line break, leading with it lets the engine skip ahead
+        self.breaks = re.compile(f"\n(?:{'|'.join(breaks)})") if breaks else None
+
+    def __call__(self, text: str) -> str:
+        if self.removal:
+            text = self.removal.sub("", text)
+        if self.breaks:
+            text = self.breaks.sub("\n\n", text)
+        return text
+
+
+drop_zero_width = Normalizer(zero_width=True)
+drop_footnotes = Normalizer(footnotes=True)
+drop_zero_width_and_footnotes = Normalizer(zero_width=True, footnotes=True)
+double_breaks = Normalizer(double=True)
+drop_footnotes_double_breaks = Normalizer(footnotes=True, double=True)
+collapse_breaks = Normalizer(collapse=True)
+collapse_double_breaks = Normalizer(collapse=True, double=True)
+
+MEDITATION_NUMBER = re.compile(r"\d+[\. ]")
+ENCHIRIDION_NUMBER = re.compile(r"\n\d+\.")
+LETTER_NUMBER = re.compile(r"\d+\.\s")
+LECTURE_PARAGRAPH = re.compile(r"(\d+) (.+)")
+LECTURE_PARAGRAPH_UNSPACED = re.compile(r"(\d+)(.+)")
+LECTURE_INLINE_PARAGRAPH = re.compile(r"(\d+)(\D+)")
+
+
+# What goes wrong with a single page: fetching it, reading it from the cache, or
+# finding the expected structure in it
+PAGE_ERRORS = (FetchError, OSError, ValueError, IndexError, KeyError, AttributeError)
+
+
+@dataclass
+class Page:
+    # One scraped page on its way through the pipeline
+    spec: "BookSpec"
+    key: str  # Reference of the chapter the page produces, e.g. "12" or "2:5"
+    url: str
+    root: object = None  # Container element holding the text
+    title: str = ""
+    value: object = None  # Passage(s) split out of the page
+
+    @property
+    def quirks(self) -> dict:
+        return self.spec.quirks.get(self.key, {})
+
+
+@dataclass
+class BookSpec:
+    # Declarative description of how a book is scraped. Pages flow through the
+    # stages fetch -> parse -> clean -> split -> merge -> write.
+    name: str
+    pages: list  # (key, url) of every page of the book
+    container: str  # Class of the div holding the text
+    split: Callable  # (page) -> chapter or passage produced by the page
+    pick: int = -1  # Which of the matching containers to use
+    strip: tuple = ()  # (tag, class) selectors removed before extracting text
+    title: Callable = None  # (page) -> title, runs before the container is cleaned
+    merge: Callable = None  # (book) -> book, joins pages that make up one chapter
+    # Whether every page maps to its own chapter, so unchanged pages can be reused one by one.
+    # Otherwise the whole book is re-parsed if any page changed.
+    per_page: bool = True
+    quirks: dict = field(default_factory=dict)  # Page key -> special cases for split
+
+
+class Pipeline:
+    # Runs book specs through the stages, processing pages concurrently as they are
+    # fetched and timing every stage
+
+    def __init__(self, refresh: Refresh, workers: int = 4, until: str = "write"):
+        self.refresh = refresh
+        self.workers = workers
+        self.until = STAGES.index(until)  # Last stage to run
+        self.timings = dict.fromkeys(STAGES, 0.0)
+        self.lock = threading.Lock()
+        self.failed = {}  # url -> (book, why the page failed)
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def timed(self, stage: str):
+        start = time.perf_counter()
+        yield
+        with self.lock:
+            self.timings[stage] += time.perf_counter() - start
+
+    def runs(self, stage: str) -> bool:
+        return STAGES.index(stage) <= self.until
+
+    def fetch(self, page: Page) -> bool:
+        # Returns whether the page is unchanged since the last run
+        with self.timed("fetch"):
+            ref = page.key if page.spec.per_page else ""
+            return self.refresh.unchanged(page.url, page.spec.name, ref)
+
+    def safely(self, stage: Callable, page: Page):
+        # Runs a stage on a page, noting the page as failed instead of ending the run
+        # if it couldn't be fetched or isn't structured as expected (e.g. empty)
+        try:
+            return stage(page)
+        except PAGE_ERRORS as e:
+            with self.lock:
+                self.failed[page.url] = page.spec.name, f"{type(e).__name__}: {e}"
+
+    def failures(self, spec: BookSpec) -> bool:
+        # Whether pages of a book failed, in which case it keeps its last version
+        failed = [url for url, (name, _) in self.failed.items() if name == spec.name]
+        if failed:
+            print(f"{spec.name}: not written, {len(failed)} page(s) failed")
+        return bool(failed)
+
+    def process(self, page: Page) -> Page:
+        # Streams a single page through fetch, parse, clean and split
+        spec = page.spec
+        if self.fetch(page) and spec.per_page:
+            page.value = self.refresh.reuse(spec.name, page.key)
+            return page
+        if not self.runs("parse"):
+            return page
+
+        with self.timed("parse"):
+            content = self.refresh.get(page.url)
+            results = scrape_by_class(content, spec.container)
+            if not results:
+                raise ValueError(f"No '{spec.container}' container in {page.url}")
+            page.root = results[spec.pick]
+            if spec.title:
+                page.title = spec.title(page)
+        if not self.runs("clean"):
+            return page
+
+        with self.timed("clean"):
+            if spec.strip:
+                strip_elements(page.root, *spec.strip)
+        if not self.runs("split"):
+            return page
+
+        with self.timed("split"):
+            page.value = spec.split(page)
+        refs = [page.key] if page.key else list(page.value)
+        self.refresh.record(page.url, spec.name, refs)
+        page.root = None  # Let the tree go
+        return page
+
+    def run(self, spec: BookSpec):
+        pages = [Page(spec, key, url) for key, url in spec.pages]
+        with ThreadPoolExecutor(self.workers) as pool:
+            if not spec.per_page:
+                # All pages have to be checked before deciding whether to re-parse the book
+                unchanged = list(pool.map(lambda p: self.safely(self.fetch, p), pages))
+                if self.failures(spec):
+                    return
+                if all(unchanged):
+                    print(f"{spec.name}: unchanged")
+                    return
+            done = 0
+            for _ in pool.map(lambda p: self.safely(self.process, p), pages):
+                done += 1
+                print(f"{spec.name}: {done} of {len(pages)} pages", end="\r")
+        print()
+        if self.failures(spec) or not self.runs("merge"):
+            return
+
+        with self.timed("merge"):
+            book = {}
+            for page in pages:
+                if not page.key:
+                    book.update(page.value)  # The page is the whole book
+                    continue
+                chapter = book
+                *outer, inner = page.key.split(":")
+                for k in outer:
+                    chapter = chapter.setdefault(k, {})
+                chapter[inner] = page.value
+            if spec.merge:
+                book = spec.merge(book)
+        if not self.runs("write"):
+            return
+
+        with self.timed("write"):
+            self.refresh.write(spec.name, book)
+
+    def report(self):
+        print("\n--- Stage timings ---")
+        for stage in STAGES[: self.until + 1]:
+            print(f"{stage:<8}{self.timings[stage]:8.2f} s")
+
+        stats = self.refresh.fetcher.stats
+        elapsed = time.perf_counter() - self.started
+        print("\n--- Fetch summary ---")
+        print(
+            f"{stats['pages']} page(s) fetched ({stats['bytes'] / 1e6:.1f} MB) in "
+            f"{elapsed:.1f} s, {stats['pages'] / elapsed:.2f} pages/s, "
+            f"{self.refresh.cached} read from the cache"
         )
-
-        headerContainer[0].extract()
-
-        titleContainer = results[0].find_all(
-            "div",
-            class_="wst-center tiInherit wst-center-nomargin",
+        print(
+            f"{stats['requests']} request(s), {stats['retries']} retried, "
+            f"{stats['refused']} refused (429/503), {stats['waited']:.1f} s held back"
         )
+        for host, limiter in self.refresh.fetcher.limiters.items():
+            print(f"{host}: ended at {limiter.rate:.2f} requests/s")
+        if self.failed:
+            print(f"{len(self.failed)} page(s) failed, rerun with --resume:")
+            for url, (name, why) in self.failed.items():
+                print(f"\t{name} {url}: {why}")
 
-        title = titleContainer[1].text if i == 1 else titleContainer[0].text
-
-        title = title.split(". ", maxsplit=1)[-1].replace("[1]", "").strip()
-        for t in titleContainer:
-            t.extract()
-
-        references = results[0].find_all("div", class_="reflist")
-        if references:
-            references[0].extract()
-
-        text = results[0].text.strip()
 
-        chapter = {}
-        # Chapter 0 is the title of the letter
-        chapter[0] = title
+def unchapter(text: str, chapter: str) -> str:
+    # Drops the footnotes and everything up to the chapter numbering ("IV.", "4.", ...)
+    text = text.split("Footnotes", maxsplit=1)[0]
+    return text.split(f"{chapter}.", maxsplit=1)[-1]
 
-        txt_split = re.split("\d+\.\s", text)
-        for ps, t in enumerate(txt_split):
-            passage = re.sub("\[\d+\]", "", t.lstrip())
-            # Replace single linebreaks with double using regex negative lookbehind and lookahead
-            passage = re.sub("(?<!\n)\n(?!\n)", "\n\n", passage)
-            if passage and ps > 0:
-                chapter[ps] = passage
-        book[i] = chapter
 
-    with open("books/letters.json", "w", encoding="utf-8") as f:
-        f.write(json.dumps(book, indent="\t", ensure_ascii=False))
-
-
-def fetch_happylife():
-    book = {}
-
-    for i in range(1, 29):
-        print(f'Fetching "Of a Happy Life" {i} of 28', end="\r")
-        url = f"https://en.wikisource.org/wiki/Of_a_Happy_Life/Book_{int2roman(i)}"
-        results = scrape_by_class(url, "mw-parser-output")
-
-        # Remove superfluous stuff
-        headerContainer = results[0].find_all(
-            "div",
-            class_="ws-header wst-header-structure wst-unknown wst-header ws-header ws-noexport noprint dynlayout-exempt",
-        )
-        headerContainer[0].extract()
-        licenseContainer = results[0].find_all(
-            "div", class_="licenseContainer licenseBanner dynlayout-exempt"
-        )
-        licenseContainer[0].extract()
-        references = results[0].find_all("sup", class_="reference")
-        for r in references:
-            r.extract()
-
-        text = results[-1].text
-        text = text.split("Footnotes", maxsplit=1)[0]
-        text = text.split(f"{int2roman(i)}.", maxsplit=1)[-1]
-        # Replace single lineshifts with double (only if there is single lineshift).
-        book[i] = re.sub("\n\n\n", "\n\n", text).strip()
-
-    with open("books/happylife.json", "w", encoding="utf-8") as f:
-        f.write(json.dumps(book, indent="\t", ensure_ascii=False))
+def split_meditations(page: Page) -> dict:
+    chapter = {}
+    txt_split = MEDITATION_NUMBER.split(page.root.text)[1:]
+    for ps, t in enumerate(txt_split):
+        chapter[ps + 1] = drop_zero_width_and_footnotes(t).strip()
+    return chapter
 
 
-def fetch_shortness():
+def split_enchiridion(page: Page) -> dict:
     book = {}
+    text = drop_zero_width(page.root.text)
+    txt_split = ENCHIRIDION_NUMBER.split(text)[1:]
+    for ps, t in enumerate(txt_split):
+        book[ps + 1] = double_breaks(t).strip()
+    return book
 
-    for i in range(1, 21):
-        print(f'Fetching "On the shortness of life" {i} of 20', end="\r")
-        url = f"https://en.wikisource.org/wiki/On_the_shortness_of_life/Chapter_{int2roman(i)}"
-        results = scrape_by_class(url, "mw-parser-output")
-
-        # Remove superfluous stuff
-        headerContainer = results[0].find_all(
-            "div",
-            class_="ws-header wst-header-structure wst-unknown wst-header ws-header ws-noexport noprint dynlayout-exempt",
-        )
-
-        headerContainer[0].extract()
-        references = results[0].find_all("sup", class_="reference")
-
-        for r in references:
-            r.extract()
 
-        text = results[-1].text
-        text = text.split("Footnotes", maxsplit=1)[0]
-        text = text.split(f"{i}.", maxsplit=1)[-1]
-        # Replace single lineshifts with double (only if there is single lineshift).
-        book[i] = re.sub("(?<!\n)\n(?!\n)", "\n\n", text).strip()
+def letter_title(page: Page) -> str:
+    # The title sits in the centered frontmatter, which is stripped afterwards
+    title_container = page.root.find_all(
+        "div", class_="wst-center tiInherit wst-center-nomargin"
+    )
+    title = title_container[1].text if page.key == "1" else title_container[0].text
+    return title.split(". ", maxsplit=1)[-1].replace("[1]", "").strip()
 
-    with open("books/shortness.json", "w", encoding="utf-8") as f:
-        f.write(json.dumps(book, indent="\t", ensure_ascii=False))
 
+def split_letter(page: Page) -> dict:
+    # Chapter 0 is the title of the letter
+    chapter = {0: page.title}
+    txt_split = LETTER_NUMBER.split(page.root.text.strip())
+    for ps, t in enumerate(txt_split):
+        # Drop footnote markers and replace single linebreaks with double
+        passage = drop_footnotes_double_breaks(t.lstrip())
+        if passage and ps > 0:
+            chapter[ps] = passage
+    return chapter
 
-def fetch_discourses():
-    books = {}
-    chapters = [30, 26, 26, 13]
 
-    for i, chaps in enumerate(chapters):
-        books[i + 1] = {}
-        for j in range(chaps):
-            print(
-                f'Fetching "Discourses" Book {i+1} Chapter {j+1}\tof {chaps}', end="\r"
-            )
-            url = f"https://en.wikisource.org/wiki/Epictetus,_the_Discourses_as_reported_by_Arrian,_the_Manual,_and_Fragments/Book_{i+1}/Chapter_{j+1}"
-            results = scrape_by_class(url, "prp-pages-output")
-
-            # Remove superfluous stuff
-            references = results[-1].find_all("sup", class_="reference")
-            for r in references:
-                r.extract()
-            for s in results[-1].select("sup"):
-                s.extract()  # Remove green superscripted numbers
-            text = results[-1].text
-            text = re.sub("[\u200b\u200c\u200d\u2060]", "", text)
-            text = re.sub(f"CHAPTER {int2roman(j+1)}\D", "", text)
-            text = re.sub(f"\n\n\n", "\n\n", text)
-            # Replace single linebreaks with double using regex negative lookbehind and lookahead
-            text = re.sub("(?<!\n)\n(?!\n)", "\n\n", text)
-            # txt_split = re.split("\n\d+\.", text)[1:]
-            books[i + 1][j + 1] = text.strip()
-        print()
+def split_happylife(page: Page) -> str:
+    text = unchapter(page.root.text, int2roman(int(page.key)))
+    return collapse_breaks(text).strip()
 
-    with open("books/discourses.json", "w", encoding="utf-8") as f:
-        f.write(json.dumps(books, indent="\t", ensure_ascii=False))
 
+def split_shortness(page: Page) -> str:
+    text = unchapter(page.root.text, page.key)
+    # Replace single lineshifts with double (only if there is single lineshift).
+    return double_breaks(text).strip()
 
-def fetch_anger():
-    books = {}
-    chapters = [21, 36, 43]
 
-    for i, chaps in enumerate(chapters):
-        print(f'Fetching "On Anger" Book {i+1}', end="\r")
-        url = f"https://en.wikisource.org/wiki/Of_Anger/Book_{int2roman(i+1)}"
-        results = scrape_by_class(url, "mw-content-ltr mw-parser-output")[0]
+def split_discourse(page: Page) -> str:
+    chapter = int(page.key.split(":")[1])
+    text = drop_zero_width(page.root.text)
+    text = re.sub(f"CHAPTER {int2roman(chapter)}\\D", "", text)
+    # Collapse triple linebreaks and replace single linebreaks with double
+    return collapse_double_breaks(text).strip()
 
-        # Remove superfluous stuff
-        results.find(
-            "div",
-            class_="ws-header wst-header-structure wst-unknown wst-header ws-header ws-noexport noprint dynlayout-exempt",
-        ).extract()  # Shave off book info
 
-        front = results.find_all(
-            "div", class_="wst-center tiInherit wst-center-nomargin"
-        )
-        edits = results.find_all("span", class_="mw-editsection")
-        references = results.find_all("sup", class_="reference")
-        for f in front:
-            f.extract()  # Shave off frontmatter
-        for e in edits:
-            e.extract()  # Shave off "edit" prompts
-        for r in references:
-            r.extract()  # Shave off reference numbering
-        results.find(
-            "table", class_="wst-small-toc wst-small-toc-center"
-        ).extract()  # Shave off small toc
-        results.find("div", class_="reflist").extract()  # Shave off Footnotes
-        results.find(
-            "div", class_="licenseContainer licenseBanner dynlayout-exempt"
-        ).extract()
-        results = results.find_all(
-            ["h2", "p", "dd"]
-        )  # Headers, paragraphs and centered quotes
-
-        # Shave off some extra fluff (including footnotes headers)
-        results = results[:-1] if i + 1 != 2 else results[:-2]
-
-        # Fill book
-        book = {}
-        headindex = 0
-        text = ""
-        for soup in results:
-            if soup.name == "h2":
-                if headindex > 0:
-                    book[headindex] = re.sub("(?<!\n)\n(?!\n)", "\n\n", text.strip())
-                text = ""
-                headindex += 1
-            elif soup.name == "p":
-                # Replace single linebreaks with double using regex negative lookbehind and lookahead
-                text += soup.text
-            elif soup.name == "dd" and soup.find_parent("dd"):
-                # We have to do this otherwise it duplicates. the dd-dl tree coming from the findall above is nested
-                if not soup.text in text:
-                    text += soup.text + "\n"
-        book[headindex] = text.strip()  # Last page
-        books[i + 1] = book
-
-    with open("books/anger.json", "w", encoding="utf-8") as f:
-        f.write(json.dumps(books, indent="\t", ensure_ascii=False))
-
-
-def fetch_musonius():
-    # Musonius Rufus' discourses
-
-    def scrape_page(url: str):
-        page = requests.get(url)
-        soup = BeautifulSoup(page.content, "html.parser")
-        return soup.find_all("div", class_="tyJCtd mGzaTb Depvyb baZpAe")[0].find_all(
-            "p"
-        )
+def split_anger(page: Page) -> dict:
+    # Headers, paragraphs and centered quotes
+    results = page.root.find_all(["h2", "p", "dd"])
+    # Shave off some extra fluff (including footnotes headers)
+    results = results[: -page.quirks.get("trailing", 1)]
 
     book = {}
-    for i in range(1, 10):
-        print(f"Fetching Musonius Rufus' - Lectures {i} of 21", end="\r")
-        # Lecture i in book
-        book[f"{i}"] = {}
-        url = f"https://sites.google.com/site/thestoiclife/the_teachers/musonius-rufus/lectures/{i:02}"
-
-        # Scrape the page
-        results = scrape_page(url)
-
-        title = f"Lecture {int2roman(i)} - {results[1].find("em").text}"
-        book[f"{i}"]["0"] = title
-
-        last_index = "1"
-        for j in range(2, len(results)):
-            if any(char in results[j].text for char in ["◄", "►"]):
-                book[f"{i}"][f"{last_index}"] = book[f"{i}"][f"{last_index}"].rstrip()
-                break
-
-            text = re.sub("\[\d+\]", "", results[j].text)
-
-            # Special case handling for lecture 7, 3rd paragraph
-            m = (
-                re.fullmatch(r"(\d+) (.+)", text)
-                if not (i == 7 and j - 1 == 3)
-                else re.fullmatch(r"(\d+)(.+)", text)
+    headindex = 0
+    text = ""
+    for soup in results:
+        if soup.name == "h2":
+            if headindex > 0:
+                book[headindex] = double_breaks(text.strip())
+            text = ""
+            headindex += 1
+        elif soup.name == "p":
+            text += soup.text
+        elif soup.name == "dd" and soup.find_parent("dd"):
+            # We have to do this otherwise it duplicates. the dd-dl tree coming from the findall above is nested
+            if not soup.text in text:
+                text += soup.text + "\n"
+    book[headindex] = text.strip()  # Last page
+    return book
+
+
+def split_musonius(page: Page) -> dict:
+    # The lectures and fragments are laid out in four different ways
+    number = int(page.key[:2])
+    results = page.root.find_all("p")
+    if number <= 9:
+        return split_numbered_lecture(page, results)
+    if number <= 14:
+        return split_inline_lecture(page, results)
+    if number <= 21:
+        return split_plain_lecture(page, results)
+    return split_fragment(page, results)
+
+
+def split_numbered_lecture(page: Page, results: list) -> dict:
+    # Lectures where every paragraph starts with its number
+    chapter = {
+        "0": f"Lecture {int2roman(int(page.key))} - {results[1].find("em").text}"
+    }
+    last_index = "1"
+    for j in range(2, len(results)):
+        if any(char in results[j].text for char in ["◄", "►"]):
+            chapter[last_index] = chapter[last_index].rstrip()
+            break
+
+        text = drop_footnotes(results[j].text)
+        unspaced = j - 1 in page.quirks.get("unspaced", ())
+        pattern = LECTURE_PARAGRAPH_UNSPACED if unspaced else LECTURE_PARAGRAPH
+        m = pattern.fullmatch(text)
+        if m:
+            if int(m[1]) > int(last_index):
+                chapter[last_index] = chapter[last_index] + "\n"
+            last_index = m[1]
+            chapter[m[1]] = m[2] + "\n"
+        else:
+            chapter[last_index] = chapter[last_index].lstrip() + text + "\n"
+    return chapter
+
+
+def split_inline_lecture(page: Page, results: list) -> dict:
+    # Lectures where the paragraph numbers are inlined in the text
+    chapter = {
+        "0": f"Lecture {int2roman(int(page.key[:2]))} - {results[1].find("em").text}"
+    }
+    last_element = page.quirks.get("last_element", len(results))
+    renumber = page.quirks.get("renumber", {})
+    last_index = "1"
+    for j in range(2, len(results)):
+        if any(char in results[j].text for char in ["◄", "►"]) or j >= last_element:
+            chapter[last_index] = chapter[last_index].rstrip()
+            break
+
+        text = drop_footnotes(results[j].text)
+        matches = LECTURE_INLINE_PARAGRAPH.findall(text)
+        if matches:
+            if int(matches[0][0]) > int(last_index):
+                chapter[last_index] = chapter[last_index] + "\n"
+            for number, passage in matches:
+                last_index = renumber.get((j, number), number)
+                chapter[last_index] = passage
+        else:
+            chapter[last_index] = chapter[last_index] + text
+        # Add lineshift
+        chapter[last_index] = chapter[last_index].rstrip() + "\n"
+    return chapter
+
+
+def split_plain_lecture(page: Page, results: list) -> dict:
+    # Lectures with one unnumbered paragraph per element
+    chapter = {
+        "0": f"Lecture {int2roman(int(page.key[:2]))} - {results[1].find("em").text}",
+        "1": "",
+    }
+    last_index = 1
+    for j in range(2, len(results)):
+        if any(char in results[j].text for char in ["◄", "►"]):
+            break
+        text = drop_footnotes(results[j].text)
+        chapter[f"{j - 1}"] = text.rstrip() + "\n\n"
+        last_index = j - 1
+    chapter[f"{last_index}"] = chapter[f"{last_index}"].rstrip()
+    return chapter
+
+
+def split_fragment(page: Page, results: list) -> dict:
+    number = int(page.key)
+    chapter = {
+        "0": (
+            f"Fragment {int2roman(number)} - {results[1].find("em").text}"
+            if results[1].find("em")
+            else f"Fragment {int2roman(number)}"
+        ),
+        "1": "",
+    }
+    # Most fragments have their title in the first element, some start right away
+    first_element = page.quirks.get("first_element", 2)
+    last_index = 1
+    for j in range(first_element, len(results)):
+        if any(char in results[j].text for char in ["◄", "►"]):
+            break
+        index = j - first_element + 1
+        text = drop_footnotes(results[j].text)
+        chapter[f"{index}"] = text.rstrip() + "\n"
+        last_index = index
+    chapter[f"{last_index}"] = chapter[f"{last_index}"].rstrip()
+    return chapter
+
+
+def merge_musonius(book: dict) -> dict:
+    # Lectures 13 and 18 survive as two fragmented pages each, join them into one lecture
+    separators = {
+        "13": "\n\n[... TIME DEVOURS ALL—THE WRITER, THE READER, THE PAGES. BUT FOR NOW, THE FOLLOWING SURVIVES. FOR NOW, SO DO YOU ...]\n\n",
+        "18": "\n\n[... LIKE THE WORDS OF WISDOM ONCE WRITTEN HERE, YOU TOO WILL ONE DAY BE FRAGMENTED—MAKE GOOD USE OF WHAT REMAINS ...]\n\n",
+    }
+    merged = {}
+    for key, chapter in book.items():
+        if key.endswith("-1"):
+            continue
+        if key.endswith("-0"):
+            lecture = key[:-2]
+            chapter = chapter.copy()
+            max_key = list(chapter.keys())[-1]
+            chapter[max_key] = chapter[max_key] + separators[lecture]
+            for k, v in book[f"{lecture}-1"].items():
+                if k != "0":
+                    chapter[f"{int(max_key) + int(k)}"] = v
+            key = lecture
+        merged[key] = chapter
+    return merged
+
+
+WIKISOURCE = "https://en.wikisource.org/wiki"
+EPICTETUS = f"{WIKISOURCE}/Epictetus,_the_Discourses_as_reported_by_Arrian,_the_Manual,_and_Fragments"
+MUSONIUS = "https://sites.google.com/site/thestoiclife/the_teachers/musonius-rufus"
+
+SPECS = {
+    "meditations": BookSpec(
+        name="meditations",
+        pages=[
+            (
+                f"{i}",
+                f"{WIKISOURCE}/The_Meditations_of_the_Emperor_Marcus_Antoninus/Book_{i}",
             )
-            if m:
-                if int(m[1]) > int(last_index):
-                    book[f"{i}"][f"{last_index}"] = book[f"{i}"][f"{last_index}"] + "\n"
-
-                last_index = m[1]
+            for i in range(1, 13)
+        ],
+        container="prp-pages-output",
+        split=split_meditations,
+    ),
+    "enchiridion": BookSpec(
+        name="enchiridion",
+        pages=[("", f"{EPICTETUS}/Manual")],
+        container="prp-pages-output",
+        strip=(WS_REFERENCE,),
+        split=split_enchiridion,
+        per_page=False,
+    ),
+    "letters": BookSpec(
+        name="letters",
+        pages=[
+            (f"{i}", f"{WIKISOURCE}/Moral_letters_to_Lucilius/Letter_{i}")
+            for i in range(1, 125)
+        ],
+        container="mw-parser-output",
+        pick=0,
+        strip=(WS_HEADER, WS_CENTER, WS_REFLIST),
+        title=letter_title,
+        split=split_letter,
+    ),
+    "happylife": BookSpec(
+        name="happylife",
+        pages=[
+            (f"{i}", f"{WIKISOURCE}/Of_a_Happy_Life/Book_{int2roman(i)}")
+            for i in range(1, 29)
+        ],
+        container="mw-parser-output",
+        pick=0,
+        strip=(WS_HEADER, WS_LICENSE, WS_REFERENCE),
+        split=split_happylife,
+    ),
+    "shortness": BookSpec(
+        name="shortness",
+        pages=[
+            (f"{i}", f"{WIKISOURCE}/On_the_shortness_of_life/Chapter_{int2roman(i)}")
+            for i in range(1, 21)
+        ],
+        container="mw-parser-output",
+        pick=0,
+        strip=(WS_HEADER, WS_REFERENCE),
+        split=split_shortness,
+    ),
+    "discourses": BookSpec(
+        name="discourses",
+        pages=[
+            (f"{i}:{j}", f"{EPICTETUS}/Book_{i}/Chapter_{j}")
+            for i, chapters in enumerate([30, 26, 26, 13], start=1)
+            for j in range(1, chapters + 1)
+        ],
+        container="prp-pages-output",
+        # References and green superscripted numbers
+        strip=(("sup", None),),
+        split=split_discourse,
+    ),
+    "anger": BookSpec(
+        name="anger",
+        pages=[
+            (f"{i}", f"{WIKISOURCE}/Of_Anger/Book_{int2roman(i)}") for i in range(1, 4)
+        ],
+        container="mw-content-ltr mw-parser-output",
+        pick=0,
+        # Book info, frontmatter, "edit" prompts, reference numbering, small toc, Footnotes and license
+        strip=(
+            WS_HEADER,
+            WS_CENTER,
+            ("span", "mw-editsection"),
+            WS_REFERENCE,
+            ("table", "wst-small-toc wst-small-toc-center"),
+            WS_REFLIST,
+            WS_LICENSE,
+        ),
+        split=split_anger,
+        quirks={"2": {"trailing": 2}},
+    ),
+    "musonius": BookSpec(
+        name="musonius",
+        pages=[(f"{i}", f"{MUSONIUS}/lectures/{i:02}") for i in range(1, 10)]
+        + [
+            (i, f"{MUSONIUS}/lectures/{i}")
+            for i in ["10", "11", "12", "13-0", "13-1", "14"]
+            + ["15", "16", "17", "18-0", "18-1", "19", "20", "21"]
+        ]
+        + [(f"{i}", f"{MUSONIUS}/fragments/{i}") for i in range(22, 54)],
+        container="tyJCtd mGzaTb Depvyb baZpAe",
+        pick=0,
+        split=split_musonius,
+        merge=merge_musonius,
+        # Lectures 13 and 18 are merged from two pages each
+        per_page=False,
+        quirks={
+            "7": {"unspaced": [3]},  # Paragraph 3 has no space after its number
+            "11": {"last_element": 8, "renumber": {(3, "2"): "23"}},
+            **{
+                f"{i}": {"first_element": 1}
+                for i in [36, 37, 43, 44, 45, 46, 47, 48, 50, 52, 53]
+            },
+        },
+    ),
+}
 
-                book[f"{i}"][m[1]] = m[2] + "\n"
-            else:
-                book[f"{i}"][f"{last_index}"] = (
-                    book[f"{i}"][f"{last_index}"].lstrip() + text + "\n"
-                )
 
-    for i in ["10", "11", "12", "13-0", "13-1", "14"]:
-        print(f"Fetching Musonius Rufus' - Lectures {i} of 21", end="\r")
-        # Lecture i in book
-        book[i] = {}
-        url = f"https://sites.google.com/site/thestoiclife/the_teachers/musonius-rufus/lectures/{i}"
-
-        # Scrape the page
-        results = scrape_page(url)
-
-        title = f"Lecture {int2roman(int(i[:2]))} - {results[1].find("em").text}"
-        book[f"{i}"]["0"] = title
-
-        last_index = "1"
-        for j in range(2, len(results)):
-            if any(char in results[j].text for char in ["◄", "►"]) or (
-                i == "11" and j >= 8
-            ):
-                book[i][f"{last_index}"] = book[i][f"{last_index}"].rstrip()
-                break
-
-            text = re.sub("\[\d+\]", "", results[j].text)
-            matches = re.findall(r"(\d+)(\D+)", text)
-            if matches:
-                if int(matches[0][0]) > int(last_index):
-                    book[f"{i}"][f"{last_index}"] = book[f"{i}"][f"{last_index}"] + "\n"
-                for m in matches:
-                    # Exception for lecture 11, paragragh 2, sentence 22
-                    if i == "11" and j == 3 and m[0] == "2":
-                        last_index = "23"
-                        book[i]["23"] = m[1]
-                        continue
-                    last_index = m[0]
-                    book[i][m[0]] = m[1]
+if __name__ == "__main__":
+    # This wikisource primary text of the Meditations combines two chapter's into one paragraph
+    default_books = [name for name in SPECS if name != "meditations"]
 
-            else:
-                book[i][f"{last_index}"] = book[i][f"{last_index}"] + text
-            # Add lineshift
-            book[i][last_index] = book[i][last_index].rstrip() + "\n"
-
-    # Merge entry 13-0 and 13-1 into one entry, remove their individual entries
-    print("Merging 13-0 and 13-1")
-    book["13"] = book["13-0"].copy()
-    max_key = list(book["13"].keys())[-1]
-    book["13"][f"{max_key}"] = (
-        book["13"][f"{max_key}"]
-        + "\n\n[... TIME DEVOURS ALL—THE WRITER, THE READER, THE PAGES. BUT FOR NOW, THE FOLLOWING SURVIVES. FOR NOW, SO DO YOU ...]\n\n"
+    parser = argparse.ArgumentParser(
+        description="Scrapes the books and patches the passages that changed since the last run."
     )
-
-    for key, value in book["13-1"].items():
-        if key == "0":
-            continue
-        book["13"][f"{int(max_key) + int(key)}"] = value
-    del book["13-0"]
-    del book["13-1"]
-
-    for i in ["15", "16", "17", "18-0", "18-1", "19", "20", "21"]:
-        print(f"Fetching Musonius Rufus' - Lectures {i} of 21", end="\r")
-        # Lecture i in book
-        book[f"{i}"] = {}
-        url = f"https://sites.google.com/site/thestoiclife/the_teachers/musonius-rufus/lectures/{i}"
-
-        # Scrape the page
-        results = scrape_page(url)
-
-        title = f"Lecture {int2roman(int(i[:2]))} - {results[1].find("em").text}"
-        book[f"{i}"]["0"] = title
-        book[f"{i}"]["1"] = ""
-        last_index = 1
-        for j in range(2, len(results)):
-            index = j - 1
-            if any(char in results[j].text for char in ["◄", "►"]):
-                break
-            text = re.sub("\[\d+\]", "", results[j].text)
-            book[f"{i}"][f"{index}"] = text.rstrip() + "\n\n"
-            last_index = index
-        book[f"{i}"][f"{last_index}"] = book[f"{i}"][f"{last_index}"].rstrip()
-
-    # Merge entry 18-0 and 18-1 into one entry, remove their individual entries
-    print("Merging 18-0 and 18-1")
-    book["18"] = book["18-0"].copy()
-    max_key = list(book["18"].keys())[-1]
-    book["18"][f"{max_key}"] = (
-        book["18"][f"{max_key}"]
-        + "\n\n[... LIKE THE WORDS OF WISDOM ONCE WRITTEN HERE, YOU TOO WILL ONE DAY BE FRAGMENTED—MAKE GOOD USE OF WHAT REMAINS ...]\n\n"
+    parser.add_argument(
+        "books",
+        nargs="*",
+        help=f"Books to refresh (default: {' '.join(default_books)})",
     )
-
-    for key, value in book["18-1"].items():
-        if key == "0":
-            continue
-        book["18"][f"{int(max_key) + int(key)}"] = value
-    del book["18-0"]
-    del book["18-1"]
-
-    for i in range(22, 54):
-        print(f"Fetching Musonius Rufus' - Fragments {i} of 53", end="\r")
-        # Lecture i in book
-        book[f"{i}"] = {}
-        url = f"https://sites.google.com/site/thestoiclife/the_teachers/musonius-rufus/fragments/{i}"
-
-        # Scrape the page
-        results = scrape_page(url)
-
-        title = (
-            f"Fragment {int2roman(i)} - {results[1].find("em").text}"
-            if results[1].find("em")
-            else f"Fragment {int2roman(i)}"
-        )
-        book[f"{i}"]["0"] = title
-        book[f"{i}"]["1"] = ""
-        last_index = 1
-        start_index = 1 if i in [36, 37, 43, 44, 45, 46, 47, 48, 50, 52, 53] else 2
-        for j in range(start_index, len(results)):
-            index = j if i in [36, 37, 43, 44, 45, 46, 47, 48, 50, 52, 53] else j - 1
-            if any(char in results[j].text for char in ["◄", "►"]):
-                break
-
-            text = re.sub("\[\d+\]", "", results[j].text)
-            book[f"{i}"][f"{index}"] = text.rstrip() + "\n"
-            last_index = index
-        book[f"{i}"][f"{last_index}"] = book[f"{i}"][f"{last_index}"].rstrip()
-
-    with open("books/musonius.json", "w", encoding="utf-8") as f:
-        json.dump(book, f, indent="\t", ensure_ascii=False)
-
-
-if __name__ == "__main__":
-    to_fetch = [
-        # fetch_meditations, # This wikisource primary text combines two chapter's into one paragraph.
-        fetch_enchiridion,
-        fetch_letters,
-        fetch_happylife,
-        fetch_shortness,
-        fetch_discourses,
-        fetch_anger,
-        fetch_musonius,
-    ]
-
-    for f in to_fetch:
-        f()
+    parser.add_argument(
+        "--until",
+        choices=STAGES,
+        default="write",
+        help="Last stage to run, e.g. 'fetch' only fills the page cache",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Use the cached pages instead of fetching them",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Pages processed concurrently (default: 4)",
+    )
+    parser.add_argument(
+        "--parser",
+        default=PARSER,
+        help=f"BeautifulSoup parser backend (default: {PARSER})",
+    )
+    parser.add_argument(
+        "--bench",
+        metavar="DIR",
+        help="Benchmark parsing the saved pages in DIR instead of fetching",
+    )
+    parser.add_argument(
+        "--container",
+        default="mw-parser-output",
+        help="Class of the container div parsed by --bench (default: mw-parser-output)",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Re-parse every page, even unchanged ones"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Reuse pages fetched in the last 24 hours, fetch only the others",
+    )
+    parser.add_argument(
+        "--build",
+        action="store_true",
+        help=f"Only build {CORPUS_PATH} from the books on disk",
+    )
+    args = parser.parse_args()
+    unknown = set(args.books) - SPECS.keys()
+    if unknown:
+        parser.error(f"unknown book(s): {', '.join(sorted(unknown))}")
+
+    if args.bench:
+        benchmark_parsing(args.bench, args.container)
+        raise SystemExit
+
+    if args.build:
+        build_corpus()
+        raise SystemExit
+
+    PARSER = args.parser
+    refresh = Refresh(force=args.force, offline=args.offline, resume=args.resume)
+    pipeline = Pipeline(refresh, workers=args.workers, until=args.until)
+    for name in args.books or default_books:
+        pipeline.run(SPECS[name])
+    if pipeline.runs("write"):
+        refresh.save()
+        build_corpus()
+    pipeline.report()
+    if pipeline.failed:
+        raise SystemExit(1)
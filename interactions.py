@@ -0,0 +1,247 @@
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import time
+
+import aiohttp
+import discord
+from aiohttp import web
+from discord.webhook.async_ import async_context
+from nacl.exceptions import BadSignatureError
+from nacl.signing import SigningKey, VerifyKey
+
+from metrics import METRICS
+from scheduler import (
+    ANSWER_WITHIN,
+    CHOICES,
+    DEFERRED,
+    INTERACTION,
+    DeferringAdapter,
+    callback_response,
+    priority,
+)
+
+HOST = os.getenv("INTERACTIONS_HOST", "0.0.0.0")
+PORT = int(os.getenv("INTERACTIONS_PORT", "8080"))
+# The application's public key, from the Developer Portal
+PUBLIC_KEY = os.getenv("DISCORD_PUBLIC_KEY", "")
+MAX_AGE = 300  # Oldest request timestamp accepted, in seconds, so replays fail
+DEADLINE = 3  # Seconds Discord waits for the answer to an interaction
+
+# Interaction and interaction response types
+PING = 1
+AUTOCOMPLETE = 4
+PONG = 1
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseAdapter(DeferringAdapter):
+    # Puts the first response to an interaction into the answer to the HTTP request
+    # that delivered it, instead of posting it to Discord's callback endpoint. If
+    # that request had to be answered with a deferral (the command was slow, or its
+    # reply has files, which don't fit in JSON), the response edits the deferred
+    # message instead. Follow-ups and edits go to Discord as usual.
+
+    def __init__(self, application_id: int):
+        super().__init__(application_id)
+        self.answer = asyncio.get_running_loop().create_future()
+        self.answered = asyncio.Event()  # The answer has been sent
+
+    def defer(self):
+        if not self.answer.done():
+            self.answer.set_result({"type": DEFERRED})
+
+    async def create_interaction_response(
+        self, interaction_id, token, *, session, type, data=None, files=None, **kwargs
+    ):
+        if not files and not self.answer.done():
+            self.answer.set_result({"type": type} | ({"data": data} if data else {}))
+            # Until Discord has it, the reply can't be fetched or followed up
+            await self.answered.wait()
+            return callback_response(type, data)
+
+        self.defer()
+        await self.answered.wait()
+        return await self.edit_deferred(
+            token, session=session, type=type, data=data, files=files, **kwargs
+        )
+
+
+class InteractionServer:
+    # Serves the bot's application commands from the HTTP requests Discord posts to
+    # an interactions endpoint, in place of the gateway connection. It keeps nothing
+    # between requests but caches, so any number of these can run behind a load
+    # balancer, each with its own copy of the corpus.
+
+    def __init__(self, bot, public_key: str = PUBLIC_KEY):
+        self.bot = bot
+        self.key = VerifyKey(bytes.fromhex(public_key))
+        self.tasks = set()  # Commands still running, after their request was answered
+        self.app = web.Application()
+        self.app.router.add_post("/interactions", self.handle)
+
+    def verified(self, request, body: bytes) -> bool:
+        signature = request.headers.get("X-Signature-Ed25519", "")
+        timestamp = request.headers.get("X-Signature-Timestamp", "")
+        try:
+            self.key.verify(timestamp.encode() + body, bytes.fromhex(signature))
+        except (BadSignatureError, ValueError):
+            return False
+        return timestamp.isdigit() and abs(time.time() - int(timestamp)) <= MAX_AGE
+
+    async def handle(self, request):
+        received = time.monotonic()
+        body = await request.read()
+        if not self.verified(request, body):
+            return web.Response(status=401, text="invalid request signature")
+        payload = json.loads(body)
+        if payload["type"] == PING:
+            return web.json_response({"type": PONG})
+
+        # The command runs in its own task, which sees only its own adapter
+        adapter = ResponseAdapter(int(payload["application_id"]))
+        context = contextvars.copy_context()
+        context.run(async_context.set, adapter)
+        task = asyncio.create_task(self.dispatch(payload), context=context)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(adapter.answer), ANSWER_WITHIN)
+        except asyncio.TimeoutError:
+            if payload["type"] == AUTOCOMPLETE:
+                adapter.answer.set_result({"type": CHOICES, "data": {"choices": []}})
+            elif task.done():  # Failed, or found no command, without replying
+                adapter.answer.set_result(
+                    {
+                        "type": 4,
+                        "data": {"content": "Something went wrong.", "flags": 64},
+                    }
+                )
+            else:
+                adapter.defer()
+        if adapter.answer.result()["type"] == DEFERRED:
+            METRICS.counters["interactions_deferred"] += 1
+
+        response = web.json_response(adapter.answer.result())
+        await response.prepare(request)
+        await response.write_eof()
+        adapter.answered.set()
+        if time.monotonic() - received > DEADLINE:
+            METRICS.counters["interactions_expired"] += 1
+        return response
+
+    async def dispatch(self, payload: dict):
+        priority.set(INTERACTION)
+        await self.cache_guild(payload.get("guild_id"))
+        interaction = discord.Interaction(data=payload, state=self.bot._connection)
+        # Commands are registered by the gateway bot, or looked up by name here
+        await self.bot.process_application_commands(interaction, auto_sync=False)
+
+    async def cache_guild(self, guild_id):
+        # Commands look at their server, e.g. for its settings. Without a gateway the
+        # cache starts out empty, so every worker fetches a server the first time.
+        if guild_id is None or self.bot.get_guild(int(guild_id)):
+            return
+        try:
+            guild = await self.bot.fetch_guild(int(guild_id))
+        except discord.HTTPException as e:
+            logger.warning(f"Couldn't fetch guild {guild_id}: {e}")
+            return
+        self.bot._connection._add_guild(guild)
+
+
+def serve(bot, token: str = None, on_start=None, host: str = HOST, port: int = PORT):
+    # Runs the bot as an interactions endpoint until interrupted, in place of
+    # bot.run(). Without a token only replies in the answer to a request work,
+    # which is enough to try it out with send_fake().
+    async def main():
+        if token:
+            await bot.login(token)
+        if on_start:
+            await on_start()
+        runner = web.AppRunner(InteractionServer(bot).app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Serving interactions on http://{host}:{port}/interactions")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            await bot.close()
+
+    try:
+        bot.loop.run_until_complete(main())
+    except KeyboardInterrupt:
+        pass
+
+
+async def send_fake(url: str, seed: str, name: str, options: dict = None) -> dict:
+    # Posts a slash command interaction signed like Discord would, for trying out an
+    # endpoint whose DISCORD_PUBLIC_KEY is the one printed by --keygen
+    payload = {
+        "id": str(discord.utils.time_snowflake(discord.utils.utcnow())),
+        "application_id": "1",
+        "type": 2,
+        "token": "fake",
+        "version": 1,
+        "channel_id": "1",
+        "user": {"id": "1", "username": "tester", "discriminator": "0", "avatar": None},
+        "data": {
+            "id": "1",
+            "name": name,
+            "type": 1,
+            "options": [
+                {"name": k, "type": 3, "value": v} for k, v in (options or {}).items()
+            ],
+        },
+    }
+    body = json.dumps(payload).encode()
+    timestamp = str(int(time.time()))
+    signature = SigningKey(bytes.fromhex(seed)).sign(timestamp.encode() + body)
+    headers = {
+        "Content-Type": "application/json",
+        "X-Signature-Ed25519": signature.signature.hex(),
+        "X-Signature-Timestamp": timestamp,
+    }
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, data=body, headers=headers) as response:
+            return {"status": response.status, "body": await response.text()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Sends fake signed interactions to a local endpoint"
+    )
+    parser.add_argument("command", nargs="?", help="Slash command to send")
+    parser.add_argument("options", nargs="*", help="Its options, as name=value")
+    parser.add_argument(
+        "--url", default=f"http://localhost:{PORT}/interactions", help="Endpoint"
+    )
+    parser.add_argument(
+        "--seed",
+        default=os.getenv("FAKE_SIGNING_SEED", ""),
+        help="Hex seed of the signing key (default: $FAKE_SIGNING_SEED)",
+    )
+    parser.add_argument(
+        "--keygen",
+        action="store_true",
+        help="Print a new signing seed and its public key",
+    )
+    args = parser.parse_args()
+
+    if args.keygen:
+        key = SigningKey.generate()
+        print(f"FAKE_SIGNING_SEED={bytes(key).hex()}")
+        print(f"DISCORD_PUBLIC_KEY={bytes(key.verify_key).hex()}")
+        raise SystemExit
+    if not args.command or not args.seed:
+        parser.error("a command and a signing seed are needed, see --keygen")
+
+    options = dict(o.split("=", maxsplit=1) for o in args.options)
+    result = asyncio.run(send_fake(args.url, args.seed, args.command, options))
+    print(result["status"], result["body"])
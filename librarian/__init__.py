@@ -0,0 +1,12 @@
+from librarian.library import (
+    BOOKS,
+    MIN_QUOTE_LENGTH,
+    PAGE_LENGTH,
+    UNITS,
+    WORKS,
+    Library,
+    LibraryError,
+    NotFound,
+    Passage,
+    paginate,
+)
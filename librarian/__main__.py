@@ -0,0 +1,144 @@
+import argparse
+import random
+import sys
+import time
+
+from librarian import BOOKS, Library, LibraryError, NotFound, paginate
+from utilities import SHORT_QUOTE_LENGTH, iter_references
+
+
+def show(passage, page: int = None):
+    pages = paginate(passage.text, passage.book)
+    print(f"{passage.title}\n{passage.url}\n")
+    if page is None:
+        print(passage.text.strip())
+    elif not 1 <= page <= len(pages):
+        raise LibraryError(f"{passage.title} has pages 1 to {len(pages)}.")
+    else:
+        print(pages[page - 1].strip())
+        print(f"\nPage {page} of {len(pages)}")
+
+
+def timed(label: str, f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    print(f"{label}: {(time.perf_counter() - start) * 1000:.2f} ms", file=sys.stderr)
+    return result
+
+
+def benchmark(library: Library, count: int):
+    # Times the lookups the commands make, on references drawn from every book
+    references = [
+        (book, ref) for book in BOOKS for ref in iter_references(library.lib[book])
+    ]
+    sample = random.choices(references, k=count)
+    resolved = [(book, library.resolve(book, ref)) for book, ref in sample]
+    passages = [library.passage(book, ref) for book, ref in resolved]
+    # Books without a passage that short can't be drawn from
+    short = [b for b in BOOKS if library.lengths.count(SHORT_QUOTE_LENGTH, b)]
+    short_sample = random.choices(short, k=count)
+    cases = [
+        ("resolve", lambda: [library.resolve(b, r) for b, r in sample]),
+        ("resolve random", lambda: [library.resolve(b) for b, _ in sample]),
+        ("resolve short", lambda: [library.resolve(b, "short") for b in short_sample]),
+        ("passage", lambda: [library.passage(b, r) for b, r in resolved]),
+        ("paginate", lambda: [paginate(p.text, p.book) for p in passages]),
+        ("random sentence", lambda: [library.random_sentence() for _ in sample]),
+    ]
+    print(f"{count} lookups each, best of 3")
+    for label, run in cases:
+        best = float("inf")
+        for _ in range(3):
+            start = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - start)
+        print(f"{label:<18}{best * 1e6 / count:10.2f} µs/lookup")
+    start = time.perf_counter()
+    library.search("virtue")
+    print(f"{'search':<18}{(time.perf_counter() - start) * 1000:10.2f} ms/query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="python -m librarian",
+        description="Looks up, draws and searches passages of the books without the bot",
+    )
+    parser.add_argument(
+        "--time", action="store_true", help="Print how long loading and the query took"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    get = subparsers.add_parser("get", help="A passage, like its book's command")
+    get.add_argument("book", choices=BOOKS)
+    get.add_argument(
+        "reference",
+        nargs="*",
+        help="E.g. 19:3-6, or short 300. Default: a random chapter",
+    )
+    get.add_argument("--page", type=int, help="Only this page of a long passage")
+
+    rand = subparsers.add_parser("random", help="A random passage of any book")
+    rand.add_argument("--short", type=int, metavar="N", help="Of at most N characters")
+
+    quote = subparsers.add_parser("quote", help="A random sentence, or the one given")
+    quote.add_argument("book", nargs="?", choices=BOOKS)
+    quote.add_argument("reference", nargs="?", help="Passage and sentence, e.g. 19:3#2")
+    quote.add_argument(
+        "--max-length",
+        type=int,
+        default=SHORT_QUOTE_LENGTH,
+        help=f"Longest random quote (default: {SHORT_QUOTE_LENGTH})",
+    )
+
+    search = subparsers.add_parser("search", help="Sentences containing every word")
+    search.add_argument("query", nargs="+")
+    search.add_argument("--book", choices=BOOKS, action="append", help="Repeatable")
+    search.add_argument("--limit", type=int, default=10)
+
+    bench = subparsers.add_parser("bench", help="Time the lookups the commands make")
+    bench.add_argument("--count", type=int, default=10000, help="Lookups per case")
+
+    args = parser.parse_args()
+    library = timed("load", Library) if args.time else Library()
+
+    def run(f, *values):
+        return timed(args.command, f, *values) if args.time else f(*values)
+
+    try:
+        if args.command == "get":
+            passage = run(library.get, args.book, " ".join(args.reference))
+            show(passage, args.page)
+        elif args.command == "random":
+            book = random.choice(BOOKS)
+            text = f"short {args.short}" if args.short else ""
+            show(run(library.get, book, text))
+        elif args.command == "quote":
+            if args.reference:
+                found = run(library.resolve_sentence, args.book, args.reference)
+                book, (reference, n) = args.book, found
+            else:
+                books = [args.book] if args.book else None
+                found = run(library.random_sentence, args.max_length, books)
+                if found is None:
+                    raise LibraryError(
+                        f"there is no quote of at most {args.max_length} characters."
+                    )
+                book, reference = found
+                reference, n = reference.split("#")
+            print(library.sentence(book, reference, int(n)))
+            print(f"\n– {book} {reference}#{n}")
+        elif args.command == "search":
+            found = run(library.search, " ".join(args.query), args.book, args.limit)
+            for book, reference, text in found:
+                print(f"{book} {reference}: {text}")
+            if not found:
+                print("Nothing found.")
+        elif args.command == "bench":
+            benchmark(library, args.count)
+    except LibraryError as e:
+        message = str(e)
+        if isinstance(e, NotFound) and args.command == "get":
+            refs = library.suggest(args.book, " ".join(args.reference))
+            if refs:
+                message += f" Did you mean {' or '.join(refs)}?"
+        parser.exit(1, f"{message[0].upper()}{message[1:]}\n")
@@ -0,0 +1,291 @@
+import dataclasses
+import random
+import re
+
+from utilities import (
+    LIBRARY,
+    NOT_BOOKS,
+    SHORT_QUOTE_LENGTH,
+    LengthIndex,
+    NGramIndex,
+    int2roman,
+    iter_references,
+    iter_sentences,
+    load_library,
+    reading_order,
+    sentence,
+    split_within,
+)
+
+BOOKS = [b for b in LIBRARY if b not in NOT_BOOKS]  # Books with a command
+WORKS = {
+    "meditations": "Meditations",
+    "enchiridion": "Enchiridion",
+    "letters": "Moral letters to Lucilius",
+    "happylife": "Of a Happy Life",
+    "shortness": "On the shortness of life",
+    "discourses": "The Discourses",
+    "anger": "Of Anger",
+    "musonius": "Lectures and Fragments",
+}
+# What the parts of a reference are called, e.g. "19:3" is letter 19, paragraph 3
+UNITS = {
+    "meditations": ("Book", "chapter"),
+    "enchiridion": ("chapter", None),
+    "letters": ("letter", "paragraph"),
+    "happylife": ("chapter", None),
+    "shortness": ("chapter", None),
+    "discourses": ("Book", "chapter"),
+    "anger": ("Book", "chapter"),
+    "musonius": ("lecture", "paragraph"),
+}
+AUTHORS = {  # Keys of the authors in the library's media
+    "meditations": "aurelius",
+    "enchiridion": "epictetus",
+    "letters": "seneca",
+    "happylife": "seneca",
+    "shortness": "seneca",
+    "discourses": "epictetus",
+    "anger": "seneca",
+    "musonius": "musonius",
+}
+# Shortest sentence drawn as a random quote, shorter ones ("Alas!") say little alone
+MIN_QUOTE_LENGTH = 40
+PAGE_LENGTH = 4096  # Most characters on a page, what an embed's description holds
+# Where passages are split into pages, by preference. The essays have few line breaks.
+PAGE_BREAKS = {"happylife": [". "], "shortness": [". "]}
+NUMBER_DOT = re.compile(r"^(\d+)\.")  # "5.23" is accepted like "5:23"
+# Length bounds accepted in place of a reference: "short", "short 300" or "<300"
+LENGTH_BOUND = re.compile(r"^(?:short|<)\s*(\d+)?$", re.IGNORECASE)
+
+
+class LibraryError(Exception):
+    # A reference or query the library can't answer. Its message says why, in words
+    # fit to show whoever asked.
+    pass
+
+
+class NotFound(LibraryError):
+    # Names a passage the library doesn't have, so similar ones can be suggested
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class Passage:
+    book: str
+    reference: str  # Normalized, e.g. "19:3-6"
+    title: str
+    text: str
+    url: str
+    author: str  # Key of the author in the library's media
+    translations: str = ""  # Where other translations of it can be compared
+
+
+def paginate(text: str, book: str = None, length: int = PAGE_LENGTH) -> list:
+    # Splits a passage into pages of at most length characters, between paragraphs
+    # or else sentences
+    breaks = PAGE_BREAKS.get(book, ["\n", ". "])
+    return split_within(text, length, breaks, keep_delim=True)
+
+
+class Library:
+    # Looks up, renders as text and draws passages of the books, without anything of
+    # Discord. The bot's corpus builds on it, and `python -m librarian` queries and
+    # times it offline. Lookups raise LibraryError when there's nothing to answer.
+
+    def __init__(self, lib: dict = None, manifest: dict = None):
+        if lib is None:
+            # The corpus artifact is verified against its manifest once here, so
+            # lookups can trust its structure
+            lib, manifest = load_library()
+        self.lib, self.manifest = lib, manifest
+        self.references = self.build_references()
+        self.lengths = LengthIndex(self.lib, BOOKS)
+        self.sentence_lengths = LengthIndex(self.lib, BOOKS, self.quotable_sentences)
+        self.orders = {}  # book -> (references in reading order, their indices)
+        # (book, reference) -> Passage, of every reference but ranges, which are too
+        # many to keep. The others are at most as many as the corpus has passages.
+        self.passages = {}
+
+    def build_references(self) -> dict:
+        # N-gram indexes over the references of every book, to suggest the closest
+        # ones to a reference that doesn't exist
+        references = {}
+        for book in BOOKS:
+            references[book] = NGramIndex()
+            for ref in iter_references(self.lib[book]):
+                references[book].insert(ref)
+        return references
+
+    def quotable_sentences(self, book: str):
+        for ref, text in iter_sentences(self.lib, book):
+            if len(text) >= MIN_QUOTE_LENGTH:
+                yield ref, text
+
+    def order(self, book: str):
+        if book not in self.orders:
+            order = reading_order(self.lib[book])
+            self.orders[book] = order, {ref: i for i, ref in enumerate(order)}
+        return self.orders[book]
+
+    def suggest(self, book: str, text: str, limit: int = 3) -> list:
+        # The existing references closest to one that doesn't exist
+        return self.references[book].search(NUMBER_DOT.sub(r"\1:", text.strip()), limit)
+
+    def resolve(self, book: str, text: str = "") -> str:
+        # The reference a user's text stands for: "5.23" is "5:23", "" a random
+        # chapter (or letter, or lecture), and "short 300" a random passage of at
+        # most 300 characters
+        text = text.strip()
+        bound = LENGTH_BOUND.match(text)
+        if bound:
+            reference = self.lengths.choice(int(bound[1] or SHORT_QUOTE_LENGTH), book)
+            if reference is None:
+                raise LibraryError(f"there is no passage that short in {WORKS[book]}.")
+            return reference
+        if not text:
+            return random.choice(self.order(book)[0])
+
+        key, colon, part = NUMBER_DOT.sub(r"\1:", text).partition(":")
+        unit, subunit = UNITS[book]
+        content = self.lib[book]
+        if subunit is None:
+            if colon or key not in content:
+                raise NotFound(f"there is no {unit} `{text}` in {WORKS[book]}.")
+            return key
+        if key not in content:
+            raise NotFound(f"there is no {unit} `{key}` in {WORKS[book]}.")
+
+        chapter = content[key]
+        if not part:
+            if "0" in chapter:  # A whole letter or lecture
+                return key
+            raise LibraryError(
+                f"invalid formatting. The correct syntax is `<{unit.upper()}>:<{subunit.upper()}>`, e.g., `{self.order(book)[0][0]}`."
+            )
+        if "-" in part and "0" in chapter:  # A range of paragraphs
+            first, last = part.split("-", maxsplit=1)
+            if not (
+                first.isdigit()
+                and last.isdigit()
+                and 0 < int(first) < int(last)
+                and first in chapter
+                and last in chapter
+            ):
+                raise LibraryError(f"`{part}` is not a valid range.")
+            return f"{key}:{first}-{last}"
+        if part == "0" or part not in chapter:
+            raise NotFound(
+                f"there is no {subunit} `{part}` in {unit} `{key}` of {WORKS[book]}."
+            )
+        return f"{key}:{part}"
+
+    def passage(self, book: str, reference: str) -> Passage:
+        # The text of a reference returned by resolve(), with its title and source
+        passage = self.passages.get((book, reference))
+        if passage is None:
+            passage = self.build_passage(book, reference)
+            if "-" not in reference:
+                self.passages[book, reference] = passage
+        return passage
+
+    def build_passage(self, book: str, reference: str) -> Passage:
+        key, _, part = reference.partition(":")
+        chapter = self.lib[book][key]
+        if not isinstance(chapter, dict):
+            text = chapter
+        elif not part:  # Every paragraph, after the title at "0"
+            text = "".join(list(chapter.values())[1:])
+        elif "-" in part:
+            first, last = part.split("-", maxsplit=1)
+            text = " ".join(
+                chapter[str(k)] for k in range(int(first), int(last) + 1)
+            ).rstrip()
+        else:
+            text = chapter[part].rstrip()
+
+        author = AUTHORS[book]
+        media = self.lib["media"][author]
+        translations = ""
+        if book == "meditations":
+            title = f"Meditations {key}.{part}"
+            url = f"{media['meditations']}/Book_{key}"
+            translations = f"https://www.stoicsource.com/aurelius/meditations/{key}.{int(part):02d}/haines"
+        elif book == "enchiridion":
+            title = f"Enchiridion {key}"
+            text = text.rstrip()
+            url = media["enchiridion"]
+            translations = f"https://enchiridion.tasuki.org/display:Code:ec,twh,pem,sw/section:{key}"
+        elif book == "letters":
+            title = f"Moral letters to Lucilius: Letter {key}"
+            title += f", §{part}" if part else f"\n{chapter['0']}"
+            url = f"{media['letters']}/Letter_{key}"
+        elif book == "happylife":
+            title = f"Of a Happy Life: Book {int2roman(int(key))}"
+            url = f"{media['happylife']}/Book_{int2roman(int(key))}"
+        elif book == "shortness":
+            title = f"On the shortness of life: Chapter {int2roman(int(key))}"
+            url = f"{media['shortness']}/Chapter_{int2roman(int(key))}"
+        elif book == "discourses":
+            heading, text = text.split("\n", maxsplit=1)
+            text = text.lstrip()
+            title = f"The Discourses – Book {int2roman(int(key))}, Chapter {part}\n{heading}"
+            url = f"{media['discourses']}/Book_{key}/Chapter_{part}"
+        elif book == "anger":
+            title = f"Of Anger: Book {int2roman(int(key))} Chapter {part}"
+            url = f"{media['anger']}/Book_{int2roman(int(key))}#{int2roman(int(part))}."
+        elif book == "musonius":
+            title = chapter["0"] + (f"\n§{part}" if part else "")
+            kind = "lectures" if int(key) <= 21 else "fragments"
+            url = f"{media['url']}/{kind}/{int(key):02}"
+            if key in ["13", "18"]:  # Fragmented texts
+                url += "-0"
+        return Passage(book, reference, title, text, url, author, translations)
+
+    def get(self, book: str, text: str = "") -> Passage:
+        return self.passage(book, self.resolve(book, text))
+
+    def random_sentence(self, max_length: int = SHORT_QUOTE_LENGTH, books: list = None):
+        # A random (book, "<reference>#<n>") of a quotable sentence of at most
+        # max_length characters, or None if there is none. Every such sentence is
+        # equally likely, whichever book it is from.
+        if books is None or books == BOOKS:
+            return self.sentence_lengths.choice(max_length)
+        # Draw the book first, weighted by how many sentences it has that fit
+        weights = [self.sentence_lengths.count(max_length, b) for b in books]
+        if not any(weights):
+            return None
+        book = random.choices(books, weights)[0]
+        return book, self.sentence_lengths.choice(max_length, book)
+
+    def resolve_sentence(self, book: str, text: str):
+        # The (reference, n) of sentence n of a passage given as "<reference>#<n>",
+        # or of a random one of its sentences if there's no n
+        reference, _, n = NUMBER_DOT.sub(r"\1:", text.strip()).partition("#")
+        ends = self.lib["sentences"][book].get(reference)
+        if ends is None:
+            raise NotFound(f"there is no passage `{reference}` in {WORKS[book]}.")
+        if not n:
+            return reference, random.randrange(len(ends)) + 1
+        if not n.isdigit() or not 1 <= int(n) <= len(ends):
+            raise LibraryError(
+                f"`{reference}` of {WORKS[book]} has sentences 1 to {len(ends)}, e.g. `{reference}#1`."
+            )
+        return reference, int(n)
+
+    def sentence(self, book: str, reference: str, n: int) -> str:
+        return sentence(self.lib, book, reference, n)
+
+    def search(self, query: str, books: list = None, limit: int = 10) -> list:
+        # The first sentences, in reading order, containing every word of a query
+        # (ignoring case), as (book, "<reference>#<n>", sentence)
+        words = query.lower().split()
+        found = []
+        for book in books or BOOKS:
+            for reference, text in iter_sentences(self.lib, book):
+                lowered = text.lower()
+                if all(word in lowered for word in words):
+                    found.append((book, reference, text))
+                    if len(found) == limit:
+                        return found
+        return found
@@ -0,0 +1,151 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+import discord
+from discord.ext import commands
+
+from scheduler import Overloaded
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Share of the records of high-volume events that are written, e.g.
+# LOG_SAMPLE="page_flip=0.05,reaction=0.1". Every record of any other event is.
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "page_flip=0.05")
+# Extra fields written when a record has them
+FIELDS = [
+    "event",
+    "command",
+    "guild",
+    "user",
+    "latency",
+    "outcome",
+    "sample_rate",
+    "stack",
+]
+
+
+def parse_rates(spec: str) -> dict:
+    rates = {}
+    for item in filter(None, spec.split(",")):
+        event, rate = item.split("=")
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line
+
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SampleFilter(logging.Filter):
+    # Lets through only a share of the records of the events given a rate, and notes
+    # that rate on them so totals can be estimated from what's written
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, "event", None))
+        if rate is None:
+            return True
+        if random.random() >= rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Puts records on the queue as they are, so that formatting them (and the JSON)
+    # happens on the listener thread too
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level: str = LOG_LEVEL, sample: str = LOG_SAMPLE, stream=sys.stdout):
+    # Whoever logs only puts the record on a queue. A listener thread formats and
+    # writes them, so the event loop never waits for stdout.
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter())
+    queue_handler = DeferredQueueHandler(records)
+    queue_handler.addFilter(SampleFilter(parse_rates(sample)))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers[:] = [queue_handler]
+    logging.getLogger("discord").setLevel(max(root.level, logging.INFO))
+
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+# Errors that are the user's doing rather than the bot's
+REFUSALS = (
+    commands.CommandNotFound,
+    commands.UserInputError,
+    commands.CheckFailure,
+    discord.CheckFailure,
+)
+
+
+def command_fields(ctx, outcome: str) -> dict:
+    # When the command was sent, from the message or the interaction's ID
+    interaction = getattr(ctx, "interaction", None)
+    if interaction:
+        sent = discord.utils.snowflake_time(interaction.id)
+    else:
+        sent = ctx.message.created_at
+    return {
+        "event": "command",
+        "command": ctx.command.qualified_name if ctx.command else None,
+        "guild": ctx.guild.id if ctx.guild else None,
+        "user": ctx.author.id,
+        "latency": round((discord.utils.utcnow() - sent).total_seconds(), 3),
+        "outcome": outcome,
+    }
+
+
+def log_commands(bot):
+    # Logs every command, prefixed or slash, once it's done. The latency is from when
+    # it was sent to when it finished, which for paged replies includes the paging.
+    logger = logging.getLogger("commands")
+
+    async def completed(ctx):
+        logger.info("command completed", extra=command_fields(ctx, "ok"))
+
+    async def failed(ctx, error):
+        fields = command_fields(ctx, type(error).__name__)
+        if isinstance(error, REFUSALS) or isinstance(
+            getattr(error, "original", None), Overloaded
+        ):
+            logger.info(f"command refused: {error}", extra=fields)
+        else:
+            # Listening for errors silences the library's own traceback printing
+            logger.error(f"command failed: {error}", extra=fields, exc_info=error)
+
+    bot.add_listener(completed, "on_command_completion")
+    bot.add_listener(completed, "on_application_command_completion")
+    bot.add_listener(failed, "on_command_error")
+    bot.add_listener(failed, "on_application_command_error")
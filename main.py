@@ -1,4 +1,5 @@
 import asyncio
+import logging
 import os
 
 import discord
@@ -7,17 +8,45 @@ from dotenv import load_dotenv
 
 from cogs.Help import Help
 from cogs.Librarian import Librarian
+from cogs.Reader import Reader
+from cogs.Settings import Settings
+from corpus import shared_corpus
+from log import log_commands, setup_logging
+from metrics import METRICS
+from monitor import LoopMonitor, rss
+from prefilter import PrefixFilter
+from scheduler import Deadlines, reply_when_shed
+from store import guild_config
 
 load_dotenv(dotenv_path=".env")
 TOKEN = os.getenv("DISCORD_TOKEN")
+# "gateway" connects to Discord, "http" serves slash commands from an interactions
+# endpoint (see interactions.py) so that several workers can share the traffic
+MODE = os.getenv("BOT_MODE", "gateway")
 
 # Configure intents
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = bridge.Bot(command_prefix=".", intents=intents)
+
+def get_prefix(bot, message):
+    # Looked up for every message, from the guild settings held in memory
+    return guild_config(bot, message.guild)["prefix"]
+
+
+bot = bridge.Bot(command_prefix=get_prefix, intents=intents)
 bot.add_cog(Librarian(bot))
+bot.add_cog(Reader(bot))
+bot.add_cog(Settings(bot))
 bot.add_cog(Help(bot))
+monitor = LoopMonitor(bot)
+deadlines = Deadlines(bot)
+prefix_filter = PrefixFilter(bot)
+reply_when_shed(bot)
+# Only now, so that the offload workers were forked before the log thread started
+setup_logging()
+log_commands(bot)
+logger = logging.getLogger("main")
 
 
 def is_guild_owner():
@@ -38,7 +67,7 @@ async def add_cog(ctx, cog_name: str):
     except discord.ExtensionAlreadyLoaded:
         await ctx.respond(f"`{cog_name}` is already loaded.")
         return
-    print(f"Loaded cog: {cog_name}")
+    logger.info(f"Loaded cog: {cog_name}")
     await ctx.respond(f"Added cog `{cog_name}`.")
 
 
@@ -49,13 +78,189 @@ async def remove_cog(ctx, cog_name: str):
     if not cog:
         await ctx.respond(f"No cog loaded with the name: `{cog_name}`")
         return
-    print(f"Removed cog: {cog.qualified_name}")
+    logger.info(f"Removed cog: {cog.qualified_name}")
     await ctx.respond(f"Removed cog `{cog.qualified_name}`.")
 
 
+def hit_rate(hits: int, total: int) -> str:
+    return f"{hits / total:.0%}" if total else "–"
+
+
+def diagnostics() -> discord.Embed:
+    # What the bot holds and how it's doing, from what the cogs and monitor keep
+    librarian = bot.get_cog("Librarian")
+    reader = bot.get_cog("Reader")
+    settings = bot.get_cog("Settings")
+    embed = discord.Embed(title="Diagnostics", color=discord.Color.orange())
+
+    embed.add_field(
+        name="Process",
+        value="\n".join(
+            [
+                f"RSS: {rss() / 2**20:.1f} MiB",
+                f"Mode: {MODE}",
+                (
+                    f"Gateway latency: {bot.latency * 1000:.0f} ms"
+                    if bot.ws
+                    else "Gateway: not connected"
+                ),
+            ]
+        ),
+    )
+
+    corpus = shared_corpus()
+    if corpus.manifest:
+        snapshot = f"Snapshot {corpus.manifest['version']}, {corpus.manifest['size'] / 2**20:.1f} MiB"
+    else:
+        snapshot = "Book files, no snapshot"
+    embed.add_field(
+        name="Corpus",
+        value=f"{snapshot}\n{len(corpus.lengths.lengths[None])} passages, "
+        f"{len(corpus.sentence_lengths.lengths[None])} quotable sentences",
+    )
+
+    caches = [
+        f"Reading orders: {len(corpus.orders)} books",
+        f"Passages: {len(corpus.passages)}",
+    ]
+    for kind, stats in corpus.offload.stats().items():
+        shed = ", ".join(f"{n} {p}" for p, n in stats["shed"].items()) or "none"
+        caches.append(
+            f"Offload {kind}: {stats['pending']} running, {stats['waiting']} waiting, "
+            f"{stats['done']} done, peak {stats['peak']}, shed {shed}"
+        )
+    if reader:
+        caches.append(
+            f"Reading positions: {len(reader.store.positions)} users, {len(reader.store.pending)} unwritten"
+        )
+    if settings:
+        caches.append(
+            f"Server settings: {len(settings.store.configs)} servers, {len(settings.store.pending)} unwritten"
+        )
+    if librarian:
+        made = sum(librarian.flights.started.values())
+        shared = sum(librarian.flights.coalesced.values())
+        caches.append(
+            f"Renders: {made} made, {hit_rate(shared, made + shared)} shared in flight"
+        )
+        renders = librarian.renders
+        caches.append(
+            f"Rendered passages: {len(renders)} of {renders.capacity}, "
+            f"{hit_rate(renders.hits, renders.hits + renders.misses)} hits"
+        )
+        caches.append(f"Command index: {len(librarian.command_names or [])} names")
+    embed.add_field(name="Caches", value="\n".join(caches), inline=False)
+
+    if librarian:
+        embed.add_field(
+            name="Open menus",
+            value=f"Paged: {librarian.menus['pages']}\nDeletable: {librarian.menus['deletables']}",
+        )
+        popular = librarian.popularity.popular()
+        embed.add_field(
+            name=f"Popular passages (top {len(popular)})",
+            value=", ".join(f"`{book} {ref}` ×{n}" for (book, ref), n in popular[:15])
+            or "None yet",
+            inline=False,
+        )
+
+    lag = METRICS.histogram("loop_lag", []).snapshot()
+    embed.add_field(
+        name="Event loop lag",
+        value=f"p50 {lag['p50'] * 1000:.0f} ms, p99 {lag['p99'] * 1000:.0f} ms\n"
+        f"Max {lag['max'] * 1000:.0f} ms, {METRICS.counters['loop_stalls']} stalls",
+    )
+
+    latencies = [
+        (name.split(":", 1)[1], h.snapshot())
+        for name, h in METRICS.histograms.items()
+        if name.startswith("command_latency:")
+    ]
+    latencies.sort(key=lambda c: -c[1]["count"])
+    embed.add_field(
+        name="Commands (p50 / p99, API requests each)",
+        value="\n".join(
+            f"`{name}` ×{s['count']}: {s['p50'] * 1000:.0f} / {s['p99'] * 1000:.0f} ms, "
+            f"{METRICS.counters[f'api_requests:{name}'] / s['count']:.1f}"
+            for name, s in latencies[:15]
+        )
+        or "None yet",
+        inline=False,
+    )
+
+    messages = METRICS.counters["messages"]
+    dropped = METRICS.counters["messages_dropped"]
+    embed.add_field(
+        name="Messages",
+        value=f"{messages} seen, {dropped} dropped unparsed ({hit_rate(dropped, messages)})\n"
+        f"Not prefixed: {METRICS.counters['messages_dropped:not_prefixed']}, "
+        f"no command: {METRICS.counters['messages_dropped:no_command']}, "
+        f"from bots: {METRICS.counters['messages_dropped:bot']}\n"
+        f"Unknown commands parsed: {METRICS.counters['messages_unknown_command']}",
+        inline=False,
+    )
+
+    waits = [
+        (key.split(":", 1)[1], count)
+        for key, count in METRICS.counters.items()
+        if key.startswith("rate_limit_waits:")
+    ]
+    embed.add_field(
+        name="Discord API",
+        value="\n".join(
+            [
+                f"{METRICS.counters['api_requests']} requests",
+                f"{METRICS.counters['interactions_deferred']} interactions deferred, "
+                f"{METRICS.counters['interactions_expired']} expired",
+                f"{METRICS.counters['rate_limit_waits']} rate limit waits, "
+                f"{METRICS.counters['rate_limit_seconds']:.1f} s in total",
+                *(
+                    f"`{name}`: {count} waits, {METRICS.counters[f'rate_limit_seconds:{name}']:.1f} s"
+                    for name, count in sorted(waits, key=lambda w: -w[1])[:10]
+                ),
+            ]
+        ),
+        inline=False,
+    )
+    return embed
+
+
+@bot.bridge_command(name="diag", hidden=True)
+@commands.check_any(commands.is_owner(), is_guild_owner())
+async def diag(ctx):
+    await ctx.respond(embed=diagnostics())
+
+
+@bot.event
+async def on_interaction(interaction):
+    await deadlines.process(interaction)
+
+
+@bot.event
+async def on_message(message):
+    # Nearly all messages aren't commands, and are dropped before a context is
+    # built for them
+    if prefix_filter.wanted(message):
+        await bot.process_commands(message)
+
+
 @bot.event
 async def on_ready():
-    print(f"--- {bot.user.name} ready ---")
+    monitor.start()
+    logger.info(f"--- {bot.user.name} ready ---")
+
+
+async def on_start():
+    # In place of on_ready, which never comes without a gateway connection. The
+    # quote of the day is left to the gateway bot.
+    monitor.start()
+    await bot.get_cog("Settings").store.open()
+    await bot.get_cog("Librarian").warm_up()
+
 
+if MODE == "http":
+    from interactions import serve
 
-bot.run(TOKEN)
+    serve(bot, TOKEN, on_start)
+else:
+    bot.run(TOKEN)
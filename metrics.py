@@ -0,0 +1,64 @@
+import bisect
+import collections
+
+
+class Histogram:
+    # Counts observations into buckets with fixed upper bounds, and keeps their
+    # count, sum and maximum. Observing is a bisect and a few additions.
+
+    def __init__(self, bounds: list):
+        self.bounds = sorted(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # The last bucket is unbounded
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket the q-quantile falls in, or the maximum if that's
+        # lower (or the bucket is the unbounded one)
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+class Registry:
+    # Named counters and histograms of the whole bot, for diagnostics
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.histograms = {}
+
+    def histogram(self, name: str, bounds: list) -> Histogram:
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(bounds)
+        return self.histograms[name]
+
+    def snapshot(self) -> dict:
+        return {
+            "counters": dict(self.counters),
+            "histograms": {n: h.snapshot() for n, h in self.histograms.items()},
+        }
+
+
+METRICS = Registry()
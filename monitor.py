@@ -0,0 +1,176 @@
+import asyncio
+import collections
+import contextvars
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import traceback
+
+import aiohttp
+
+from metrics import METRICS
+
+LAG_INTERVAL = 0.25  # Seconds between two measurements of the event loop's lag
+LAG_THRESHOLD = 0.2  # Seconds of lag that count as a stall
+# Upper bounds of the lag histogram's buckets, in seconds
+LAG_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+STACK_DEPTH = 12  # Innermost frames kept of a stalled loop's stack
+# Upper bounds of the buckets of the commands' latency histograms, in seconds
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+logger = logging.getLogger(__name__)
+# The command being run, also seen by the tasks it starts (e.g. with gather)
+current_command = contextvars.ContextVar("current_command", default=None)
+
+
+class LoopMonitor:
+    # Measures how late the event loop wakes up a task sleeping for LAG_INTERVAL, into
+    # the "loop_lag" histogram. A watchdog thread checks the heartbeat the task leaves,
+    # and if the loop hasn't come round for LAG_THRESHOLD it captures what's blocking
+    # it while it still is: the loop thread's stack, the running task and the command
+    # that task runs. While all is well this is a sleep and a thread wake-up per
+    # interval.
+
+    def __init__(self, bot, interval: float = LAG_INTERVAL, threshold=LAG_THRESHOLD):
+        self.bot = bot
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = METRICS.histogram("loop_lag", LAG_BUCKETS)
+        self.stalls = collections.deque(maxlen=10)  # The latest stalls, newest last
+        self.commands = {}  # Task -> name of the command it's running
+        self.started = {}  # Task -> when its command started
+        self.stall = None  # The stall in progress, as caught by the watchdog
+        self.heartbeat = time.monotonic()
+        self.task = None
+        self.tracing = aiohttp.TraceConfig()
+        self.tracing.on_request_start.append(self.requested)
+        self.tracing.freeze()
+
+        bot.before_invoke(self.command_started)
+        bot.after_invoke(self.command_finished)
+        logging.getLogger("discord.http").addFilter(self.rate_limited)
+
+    async def command_started(self, ctx):
+        task = asyncio.current_task()
+        self.commands[task] = ctx.command.qualified_name
+        self.started[task] = time.perf_counter()
+        current_command.set(ctx.command.qualified_name)
+
+    async def command_finished(self, ctx):
+        # Into the command's "command_latency:<name>" histogram. Paged replies keep
+        # their command running until the reactions time out, so for them it's the
+        # time until they replied, which they note on the context.
+        task = asyncio.current_task()
+        name = self.commands.pop(task, None)
+        started = self.started.pop(task, None)
+        current_command.set(None)
+        if started is None:
+            return
+        finished = getattr(ctx, "replied", None) or time.perf_counter()
+        METRICS.histogram(f"command_latency:{name}", LATENCY_BUCKETS).observe(
+            finished - started
+        )
+
+    def rate_limited(self, record) -> bool:
+        # Filter on the library's HTTP logger that counts the waits it announces when
+        # Discord rate limits a request, in total and per command that made it. A
+        # global limit is announced twice, this is the first of the two.
+        message = record.msg if isinstance(record.msg, str) else ""
+        if message.startswith("We are being rate limited"):
+            command = current_command.get()
+            wait = float(record.args[0]) if record.args else 0.0
+            for key in ["", f":{command}"] if command else [""]:
+                METRICS.counters[f"rate_limit_waits{key}"] += 1
+                METRICS.counters[f"rate_limit_seconds{key}"] += wait
+        return True
+
+    async def requested(self, session, context, params):
+        # Counts the requests made to Discord's API, in total and per command
+        command = current_command.get()
+        for key in ["", f":{command}"] if command else [""]:
+            METRICS.counters[f"api_requests{key}"] += 1
+
+    def start(self):
+        # Safe to call on every on_ready
+        self.trace_requests()
+        if self.task is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        # Beats from now on, not from when the monitor was made before the loop ran
+        self.heartbeat = time.monotonic()
+        self.task = self.loop.create_task(self.measure())
+        threading.Thread(target=self.watch, name="watchdog", daemon=True).start()
+
+    def trace_requests(self):
+        # The bot's HTTP client makes its requests, and its interactions their
+        # responses, through one session, which exists once the bot logged in
+        session = getattr(self.bot.http, "_HTTPClient__session", None)
+        if isinstance(session, aiohttp.ClientSession):
+            if self.tracing not in session.trace_configs:
+                session.trace_configs.append(self.tracing)
+
+    async def measure(self):
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(self.interval)
+            lag = self.loop.time() - start - self.interval
+            beat, self.heartbeat = self.heartbeat, time.monotonic()
+            self.lag.observe(lag)
+            if lag > self.threshold:
+                self.report(lag, beat)
+
+    def report(self, lag: float, beat: float):
+        METRICS.counters["loop_stalls"] += 1
+        stall = self.stall
+        if stall is None or stall["heartbeat"] != beat:
+            # Too short for the watchdog to catch it in the act
+            stall = {"task": None, "command": None, "stack": []}
+        stall = {k: v for k, v in stall.items() if k != "heartbeat"}
+        stall["lag"] = lag
+        stall["at"] = time.time()
+        self.stalls.append(stall)
+        logger.warning(
+            f"Event loop stalled for {lag:.3f}s in task {stall['task']}",
+            extra={
+                "event": "loop_stall",
+                "command": stall["command"],
+                "latency": round(lag, 3),
+                "stack": "".join(stall["stack"]),
+            },
+        )
+
+    def watch(self):
+        # Runs on its own thread
+        while True:
+            time.sleep(self.interval)
+            beat = self.heartbeat
+            late = time.monotonic() - beat - self.interval
+            if late > self.threshold and (
+                self.stall is None or self.stall["heartbeat"] != beat
+            ):
+                self.stall = self.capture(beat)
+
+    def capture(self, beat: float) -> dict:
+        # Caught once per stall, which is told apart by the heartbeat before it
+        frame = sys._current_frames().get(self.thread_id)
+        task = asyncio.current_task(self.loop)
+        return {
+            "heartbeat": beat,
+            "task": task.get_name() if task else None,
+            "command": self.commands.get(task),
+            "stack": traceback.format_stack(frame, limit=STACK_DEPTH) if frame else [],
+        }
+
+
+def rss() -> int:
+    # The process' resident set size in bytes, or its peak where /proc is missing
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
@@ -0,0 +1,37 @@
+from metrics import METRICS
+from store import guild_config
+
+
+class PrefixFilter:
+    # Tells from a message's text alone whether it may be a prefix command, so that
+    # the bot only builds a context (and parses, and looks up) for those. The names
+    # and aliases are the bot's own map of them, which py-cord updates as cogs and
+    # commands are added and removed, so it's never out of date. Words after the
+    # prefix that aren't commands still go through when they could be a mistyped
+    # one, which gets the closest commands suggested.
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def wanted(self, message) -> bool:
+        METRICS.counters["messages"] += 1
+        if message.author.bot:
+            return self.drop("bot")
+        content = message.content
+        prefix = guild_config(self.bot, message.guild)["prefix"]
+        if not content.startswith(prefix):
+            return self.drop("not_prefixed")
+        # The command's name is the word right after the prefix, as py-cord reads it
+        rest = content[len(prefix) : len(prefix) + 64]
+        name = rest.split(maxsplit=1)[0] if rest and not rest[0].isspace() else ""
+        if name in self.bot.all_commands:
+            return True
+        if name.isalpha():
+            METRICS.counters["messages_unknown_command"] += 1
+            return True
+        return self.drop("no_command")  # "...", ". hi", ".5"
+
+    def drop(self, reason: str) -> bool:
+        METRICS.counters["messages_dropped"] += 1
+        METRICS.counters[f"messages_dropped:{reason}"] += 1
+        return False
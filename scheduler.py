@@ -0,0 +1,285 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+
+import discord
+from discord.webhook.async_ import AsyncWebhookAdapter, async_context
+
+from metrics import METRICS
+
+# Discord gives up on an interaction that isn't answered within 3 seconds. One that
+# hasn't been by then is answered with a deferral, and its reply edited in later.
+ANSWER_WITHIN = 2.5
+# Observations of a command's latency needed before it's trusted to predict whether
+# the command will answer in time
+MIN_SAMPLES = 20
+UNKNOWN_INTERACTION = 10062  # Discord's error code for an expired interaction
+
+# Interaction response types
+DEFERRED = 5  # "Bot is thinking..."
+CHOICES = 8
+EPHEMERAL = 1 << 6  # Message flag
+
+# Priorities of the work done for commands, most urgent first. Interactions have a
+# deadline, prefix commands don't, and page flips are only cosmetic.
+INTERACTION, COMMAND, PAGE_FLIP = 0, 1, 2
+PRIORITIES = {INTERACTION: "interaction", COMMAND: "command", PAGE_FLIP: "page_flip"}
+# The priority of the command being run, also seen by the tasks it starts
+priority = contextvars.ContextVar("priority", default=COMMAND)
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    # Work that was shed because too much more urgent work was waiting
+    pass
+
+
+class PriorityGate:
+    # Lets up to `capacity` jobs run at once, and the rest in by priority, then in
+    # order of arrival. When `max_waiting` jobs wait, a job that comes in sheds the
+    # least urgent one waiting if it's more urgent itself, or is shed. Shed jobs
+    # raise Overloaded.
+
+    def __init__(self, capacity: int, max_waiting: int):
+        self.capacity = capacity
+        self.max_waiting = max_waiting
+        self.running = 0
+        self.waiters = []  # Heap of (priority, arrival, future)
+        self.arrivals = itertools.count()
+        self.shed = collections.Counter()  # Priority -> jobs shed
+
+    def saturated(self) -> bool:
+        return len(self.waiters) >= self.max_waiting
+
+    @contextlib.asynccontextmanager
+    async def admit(self, priority: int):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority: int):
+        if self.running < self.capacity and not self.waiters:
+            self.running += 1
+            return
+        if self.saturated():
+            least = max(self.waiters)
+            if least[0] <= priority:
+                self.shed[priority] += 1
+                raise Overloaded()
+            self.waiters.remove(least)
+            heapq.heapify(self.waiters)
+            self.shed[least[0]] += 1
+            least[2].set_exception(Overloaded())
+
+        entry = (
+            priority,
+            next(self.arrivals),
+            asyncio.get_running_loop().create_future(),
+        )
+        heapq.heappush(self.waiters, entry)
+        try:
+            await entry[2]  # Its slot is handed over by release()
+        except asyncio.CancelledError:
+            if entry in self.waiters:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+            elif entry[2].done() and not entry[2].cancelled():
+                self.release()  # Handed a slot just before giving up
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+
+class DeferringAdapter(AsyncWebhookAdapter):
+    # Base of the adapters that may answer an interaction with a deferral before its
+    # command replied. The reply then edits the deferred message.
+
+    def __init__(self, application_id: int):
+        super().__init__()
+        self.application_id = application_id
+
+    async def edit_deferred(
+        self, token, *, session, type, data=None, files=None, **kwargs
+    ):
+        if type in [DEFERRED, CHOICES]:  # Nothing to edit in, or too late for it
+            return callback_response(type)
+        payload = data or {}
+        files = files or []
+        form = None
+        if files:
+            attachments = [
+                {"id": i, "filename": f.filename, "description": f.description}
+                for i, f in enumerate(files)
+            ]
+            form = [
+                {
+                    "name": "payload_json",
+                    "value": discord.utils._to_json(
+                        payload | {"attachments": attachments}
+                    ),
+                }
+            ]
+            form += [
+                {
+                    "name": f"files[{i}]",
+                    "value": f.fp,
+                    "filename": f.filename,
+                    "content_type": "application/octet-stream",
+                }
+                for i, f in enumerate(files)
+            ]
+        await self.edit_original_interaction_response(
+            self.application_id,
+            token,
+            session=session,
+            payload=None if files else payload,
+            multipart=form,
+            files=files or None,
+            **kwargs,
+        )
+        return callback_response(type)
+
+
+class DeadlineAdapter(DeferringAdapter):
+    # Defers an interaction received over the gateway whose command hasn't replied
+    # when defer() is called. Its own lock orders that against the command's reply,
+    # which edits the deferral in if it lost the race.
+
+    def __init__(self, interaction: discord.Interaction):
+        super().__init__(interaction.application_id)
+        self.interaction = interaction
+        self.lock = asyncio.Lock()
+        self.answered = False
+        self.deferred = False
+
+    async def create_interaction_response(
+        self, interaction_id, token, *, session, type, data=None, files=None, **kwargs
+    ):
+        async with self.lock:
+            if not self.deferred:
+                response = await expiring(
+                    super().create_interaction_response(
+                        interaction_id,
+                        token,
+                        session=session,
+                        type=type,
+                        data=data,
+                        files=files,
+                        **kwargs,
+                    )
+                )
+                self.answered = True
+                return response
+        return await self.edit_deferred(
+            token, session=session, type=type, data=data, files=files, **kwargs
+        )
+
+    async def defer(self):
+        interaction = self.interaction
+        async with self.lock:
+            if self.answered or self.deferred or interaction.response.is_done():
+                return
+            await expiring(
+                super().create_interaction_response(
+                    interaction.id,
+                    interaction.token,
+                    session=interaction._session,
+                    type=DEFERRED,
+                )
+            )
+            self.deferred = True
+            # Replies still to come are follow-ups, which replace the deferral
+            interaction.response._responded = True
+        METRICS.counters["interactions_deferred"] += 1
+
+
+def callback_response(type: int, data: dict = None) -> dict:
+    # Stands in for what Discord answers a response to an interaction with, for the
+    # responses that didn't go to its callback endpoint. py-cord reads it since 2.7.
+    flags = (data or {}).get("flags", 0)
+    return {
+        "interaction": {
+            "response_message_loading": type == DEFERRED,
+            "response_message_ephemeral": bool(flags & EPHEMERAL),
+        },
+        "resource": {"type": type},
+    }
+
+
+async def expiring(response):
+    # Counts the responses that came too late for their interaction
+    try:
+        return await response
+    except discord.NotFound as e:
+        if e.code == UNKNOWN_INTERACTION:
+            METRICS.counters["interactions_expired"] += 1
+        raise
+
+
+class Deadlines:
+    # Runs the bot's slash commands (in place of on_interaction) against their
+    # interaction's deadline. An interaction is deferred if its command hasn't
+    # replied ANSWER_WITHIN seconds after it was sent, or right away if the command
+    # usually takes longer than the time left. Its work gets the interaction
+    # priority.
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def time_left(self, interaction: discord.Interaction) -> float:
+        sent = discord.utils.snowflake_time(interaction.id).timestamp()
+        left = min(sent + ANSWER_WITHIN - time.time(), ANSWER_WITHIN)
+        command = METRICS.histograms.get(
+            f"command_latency:{interaction.data.get('name')}"
+        )
+        if command and command.count >= MIN_SAMPLES and command.quantile(0.99) > left:
+            return 0.0  # Might overrun
+        return max(left, 0.0)
+
+    async def process(self, interaction: discord.Interaction):
+        if interaction.type != discord.InteractionType.application_command:
+            return await self.bot.process_application_commands(interaction)
+
+        adapter = DeadlineAdapter(interaction)
+        async_context.set(adapter)
+        priority.set(INTERACTION)
+        deferral = asyncio.create_task(
+            self.defer_after(adapter, self.time_left(interaction))
+        )
+        try:
+            await self.bot.process_application_commands(interaction)
+        finally:
+            deferral.cancel()
+
+    async def defer_after(self, adapter: DeadlineAdapter, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            await adapter.defer()
+        except discord.HTTPException as e:
+            logger.warning(f"Couldn't defer an interaction: {e}")
+
+
+def reply_when_shed(bot):
+    # Tells whoever's command was shed to try again, prefixed or slash
+    async def shed(ctx, error):
+        if isinstance(getattr(error, "original", error), Overloaded):
+            await ctx.respond(
+                f"{ctx.author.mention}, I'm swamped right now. Please try again in a moment."
+            )
+
+    bot.add_listener(shed, "on_command_error")
+    bot.add_listener(shed, "on_application_command_error")
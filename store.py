@@ -0,0 +1,374 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utilities import CountMinSketch, TopK
+
+STORE_PATH = "reading.db"
+CONFIG_PATH = "guilds.db"
+POPULARITY_PATH = "popularity.db"
+FLUSH_INTERVAL = 5  # Seconds pending changes may wait before they're written
+FLUSH_BATCH = 100  # Number of pending changes that triggers an early write
+POPULARITY_INTERVAL = 300  # Seconds between writes of the most requested passages
+TOP_K = int(os.getenv("POPULAR_PASSAGES", "50"))  # How many of those are kept
+
+READING_SCHEMA = """
+CREATE TABLE IF NOT EXISTS positions (
+    user_id INTEGER NOT NULL,
+    book TEXT NOT NULL,
+    reference TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (user_id, book)
+);
+CREATE TABLE IF NOT EXISTS bookmarks (
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    book TEXT NOT NULL,
+    reference TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (user_id, name)
+);
+"""
+CONFIG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id INTEGER PRIMARY KEY,
+    config TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+POPULARITY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS popular (
+    book TEXT NOT NULL,
+    reference TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    PRIMARY KEY (book, reference)
+);
+"""
+# Settings of guilds that haven't changed any, and of DMs
+DEFAULT_CONFIG = {
+    "prefix": ".",
+    "disabled": [],  # Books whose commands are turned off
+    "timeout": 900,  # Seconds a paged reply can be flipped through with reacts
+    "qotd_channel": None,  # Channel the quote of the day is posted in
+}
+
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStore:
+    # A SQLite database that lives on a single worker thread, so no query ever runs
+    # on the event loop and the connection is never shared between threads.
+    # Subclasses keep their data in memory and write it behind in sync(), which runs
+    # every FLUSH_INTERVAL seconds: a burst of changes is one transaction (and one
+    # fsync), not one each.
+
+    schema = ""
+
+    def __init__(self, path: str, flush_interval: float = FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+        self.db = None
+        self.opening = None  # Connects and loads, once, however many callers wait
+        self.syncer = None
+        self.flushing = None  # A write started early, see sync_soon()
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args
+        )
+
+    def _open(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only syncs at checkpoints and is still safe against corruption
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.schema)
+
+    async def open(self):
+        # Safe to call before every use, it only connects once. Callers that come
+        # while it's connecting wait for it, instead of finding it half open.
+        if self.opening is None:
+            self.opening = asyncio.create_task(self._connect())
+        await asyncio.shield(self.opening)
+
+    async def _connect(self):
+        try:
+            await self.run(self._open)
+            await self.load()
+        except BaseException:
+            self.opening = None  # The next caller tries again
+            raise
+        self.syncer = asyncio.create_task(self.sync_periodically())
+
+    async def load(self):
+        # Reads what subclasses keep in memory, once connected
+        pass
+
+    async def close(self):
+        if self.opening:  # Lets a connection under way finish first
+            await asyncio.gather(self.opening, return_exceptions=True)
+        if self.db is None:  # Never opened
+            return
+        if self.syncer:
+            self.syncer.cancel()
+        if self.flushing:
+            await asyncio.gather(self.flushing, return_exceptions=True)
+        await self.sync()
+        await self.run(self.db.close)
+        self.executor.shutdown()
+
+    async def sync_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.sync()
+
+    async def sync(self):
+        pass
+
+    def sync_soon(self):
+        # Writes what's pending now instead of at the next interval, unless a write
+        # is under way already. The task is kept, so that it isn't collected in
+        # the middle of a write, and a failed write is logged rather than lost.
+        if self.flushing is None or self.flushing.done():
+            self.flushing = asyncio.create_task(self.sync())
+            self.flushing.add_done_callback(self._synced)
+
+    def _synced(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                f"Couldn't write to {self.path}, will retry: {task.exception()!r}"
+            )
+
+
+class ReadingStore(SQLiteStore):
+    # Reading positions and bookmarks of every user. Positions are served from memory
+    # and written behind, so a burst of `.next` doesn't cost a commit each.
+
+    schema = READING_SCHEMA
+
+    def __init__(self, path: str = STORE_PATH, flush_interval: float = FLUSH_INTERVAL):
+        super().__init__(path, flush_interval)
+        self.positions = {}  # user -> {book: (reference, updated)}, loaded per user
+        self.pending = {}  # (user, book) -> (reference, updated) not yet written
+
+    async def sync(self):
+        await self.flush()
+
+    def _write_positions(self, rows):
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO positions VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user_id, book) DO UPDATE "
+                "SET reference = excluded.reference, updated = excluded.updated",
+                rows,
+            )
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        rows = [(user, book, ref, t) for (user, book), (ref, t) in pending.items()]
+        try:
+            await self.run(self._write_positions, rows)
+        except sqlite3.Error:
+            # Keep them for the next flush, unless they've been overwritten since
+            for key, value in pending.items():
+                self.pending.setdefault(key, value)
+            raise
+
+    def _read_positions(self, user: int):
+        rows = self.db.execute(
+            "SELECT book, reference, updated FROM positions WHERE user_id = ?", (user,)
+        )
+        return {book: (ref, t) for book, ref, t in rows}
+
+    async def user_positions(self, user: int) -> dict:
+        if user not in self.positions:
+            positions = await self.run(self._read_positions, user)
+            # Anything set while the query ran is newer than the database
+            self.positions[user] = positions | self.positions.get(user, {})
+        return self.positions[user]
+
+    async def position(self, user: int, book: str = None):
+        # The reference a user is at in a book, or (book, reference) for the book
+        # they read last if no book is given. None if they haven't started.
+        positions = await self.user_positions(user)
+        if book is not None:
+            return positions[book][0] if book in positions else None
+        if not positions:
+            return None
+        book = max(positions, key=lambda b: positions[b][1])
+        return book, positions[book][0]
+
+    def set_position(self, user: int, book: str, reference: str):
+        entry = (reference, time.time())
+        self.positions.setdefault(user, {})[book] = entry
+        self.pending[(user, book)] = entry
+        if len(self.pending) >= FLUSH_BATCH:
+            self.sync_soon()
+
+    def _write_bookmark(self, user, name, book, reference):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO bookmarks VALUES (?, ?, ?, ?, ?)",
+                (user, name, book, reference, time.time()),
+            )
+
+    async def add_bookmark(self, user: int, name: str, book: str, reference: str):
+        # Bookmarks are rare and precious, so they're written through
+        await self.run(self._write_bookmark, user, name, book, reference)
+
+    def _read_bookmarks(self, user):
+        rows = self.db.execute(
+            "SELECT name, book, reference FROM bookmarks WHERE user_id = ? ORDER BY created",
+            (user,),
+        )
+        return {name: (book, ref) for name, book, ref in rows}
+
+    async def bookmarks(self, user: int) -> dict:
+        return await self.run(self._read_bookmarks, user)
+
+    def _delete_bookmark(self, user, name):
+        with self.db:
+            cur = self.db.execute(
+                "DELETE FROM bookmarks WHERE user_id = ? AND name = ?", (user, name)
+            )
+        return cur.rowcount > 0
+
+    async def delete_bookmark(self, user: int, name: str) -> bool:
+        return await self.run(self._delete_bookmark, user, name)
+
+
+class GuildConfigStore(SQLiteStore):
+    # Settings of every guild, all held in memory: looking one up (like the prefix
+    # for every message) is a dict access. Changes are written behind in batches.
+    # Changes that other processes commit to the database are picked up on the next
+    # sync, by watching SQLite's data_version.
+
+    schema = CONFIG_SCHEMA
+
+    def __init__(self, path: str = CONFIG_PATH, flush_interval: float = FLUSH_INTERVAL):
+        super().__init__(path, flush_interval)
+        self.configs = {}  # guild -> complete config
+        self.pending = set()  # Guilds whose config hasn't been written yet
+        self.data_version = None
+
+    async def load(self):
+        await self.reload()
+
+    def _read_configs(self):
+        version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        rows = self.db.execute("SELECT guild_id, config FROM guilds")
+        return version, {guild: json.loads(config) for guild, config in rows}
+
+    async def reload(self):
+        version, configs = await self.run(self._read_configs)
+        configs = {g: DEFAULT_CONFIG | c for g, c in configs.items()}
+        # Changes that haven't been written yet are newer than the database
+        for guild in self.pending:
+            configs[guild] = self.configs[guild]
+        self.configs, self.data_version = configs, version
+
+    def get(self, guild: int) -> dict:
+        return self.configs.get(guild, DEFAULT_CONFIG)
+
+    def set(self, guild: int, key: str, value):
+        self.configs[guild] = self.get(guild) | {key: value}
+        self.pending.add(guild)
+        if len(self.pending) >= FLUSH_BATCH:
+            self.sync_soon()
+
+    def _write_configs(self, rows):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO guilds VALUES (?, ?, ?)",
+                rows,
+            )
+
+    def _data_version(self):
+        # Only changes when another connection has committed
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    async def sync(self):
+        if self.pending:
+            pending, self.pending = self.pending, set()
+            now = time.time()
+            rows = [(g, json.dumps(self.configs[g]), now) for g in pending]
+            try:
+                await self.run(self._write_configs, rows)
+            except sqlite3.Error:
+                self.pending |= pending
+                raise
+        if await self.run(self._data_version) != self.data_version:
+            await self.reload()
+
+
+class PopularityStore(SQLiteStore):
+    # How often every passage was requested, estimated in fixed memory by a
+    # count-min sketch, and the TOP_K passages requested most. Only those are
+    # written, in place of the last ones, so the next start knows what's popular.
+    # With several processes, the last to write wins.
+
+    schema = POPULARITY_SCHEMA
+
+    def __init__(
+        self,
+        path: str = POPULARITY_PATH,
+        flush_interval: float = POPULARITY_INTERVAL,
+        k: int = TOP_K,
+    ):
+        super().__init__(path, flush_interval)
+        self.sketch = CountMinSketch()
+        self.top = TopK(k)
+        self.changed = False
+
+    async def load(self):
+        # Counted again from where they were, along with what came in meanwhile
+        for book, reference, requests in await self.run(self._read_top):
+            self.top.offer(
+                (book, reference), self.sketch.add((book, reference), requests)
+            )
+
+    def _read_top(self):
+        return self.db.execute(
+            "SELECT book, reference, requests FROM popular"
+        ).fetchall()
+
+    def record(self, book: str, reference: str):
+        key = (book, reference)
+        self.top.offer(key, self.sketch.add(key))
+        self.changed = True
+
+    def popular(self) -> list:
+        # ((book, reference), estimated requests) of the top passages, most first
+        return self.top.most_common()
+
+    def _write_top(self, rows):
+        with self.db:
+            self.db.execute("DELETE FROM popular")
+            self.db.executemany("INSERT INTO popular VALUES (?, ?, ?)", rows)
+
+    async def sync(self):
+        if not self.changed:
+            return
+        self.changed = False
+        rows = [(book, ref, n) for (book, ref), n in self.popular()]
+        try:
+            await self.run(self._write_top, rows)
+        except sqlite3.Error:
+            self.changed = True
+            raise
+
+
+def guild_config(bot, guild) -> dict:
+    # A guild's settings, or the defaults in DMs and without the Settings cog
+    settings = bot.get_cog("Settings")
+    if settings is None or guild is None:
+        return DEFAULT_CONFIG
+    return settings.store.get(guild.id)
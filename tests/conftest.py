@@ -0,0 +1,21 @@
+import json
+import os
+
+import pytest
+
+from librarian import BOOKS, Library
+from utilities import segment_library
+
+BOOKS_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "books")
+
+
+@pytest.fixture(scope="session")
+def library() -> Library:
+    # The books this repository ships with (the Meditations, Musonius), and a
+    # chapter of everything else, which is scraped instead
+    lib = {book: {"1": "A chapter."} for book in BOOKS}
+    for name in ["meditations", "musonius", "media"]:
+        with open(os.path.join(BOOKS_DIR, f"{name}.json"), encoding="utf-8") as f:
+            lib[name] = json.load(f)
+    lib["sentences"] = segment_library(lib)
+    return Library(lib)
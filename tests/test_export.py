@@ -0,0 +1,102 @@
+import asyncio
+import tempfile
+import types
+
+import pytest
+
+pytest.importorskip("discord")
+
+from cogs.Librarian import Librarian  # noqa: E402
+from utilities import SingleFlight  # noqa: E402
+
+TEXT = "# Enchiridion\n\nSome things are in our control and others not.\n"
+
+
+class Offload:
+    # Writes the export right away, after letting every request for it come in
+    def __init__(self):
+        self.jobs = 0
+        self.keys = []  # Of every export written
+
+    async def cpu(self, func, book, keys, title):
+        self.jobs += 1
+        self.keys.append(keys)
+        await asyncio.sleep(0.01)
+        with tempfile.NamedTemporaryFile("w", suffix=".md", delete=False) as f:
+            f.write(TEXT)
+        return f.name
+
+
+class Context:
+    def __init__(self, name: str):
+        self.author = types.SimpleNamespace(mention=f"@{name}")
+        self.guild = None
+        self.files = []
+        self.replies = []
+
+    async def respond(self, content, file=None):
+        self.replies.append(content)
+        if file is None:
+            return
+        try:
+            await asyncio.sleep(0)  # The upload
+            self.files.append((file.filename, file.fp.read()))
+            self.fp = file.fp
+        finally:
+            file.close()  # As py-cord does once it's sent, which leaves fp open
+
+
+def make_cog(lib: dict):
+    cog = types.SimpleNamespace(
+        bot=types.SimpleNamespace(get_cog=lambda name: None),
+        lib=lib,
+        flights=SingleFlight(),
+        offload=Offload(),
+    )
+    cog.enabled_books = Librarian.enabled_books.__get__(cog)
+    cog.build_export = Librarian.build_export.__get__(cog)
+    return cog
+
+
+export = Librarian.export.slash_variant.callback
+
+
+def test_concurrent_exports_share_the_file_and_close_it():
+    cog = make_cog({"enchiridion": {"1": "", "2": ""}})
+
+    async def main():
+        contexts = [Context("a"), Context("b")]
+        await asyncio.gather(*(export(cog, ctx, "enchiridion") for ctx in contexts))
+        return contexts
+
+    contexts = asyncio.run(main())
+    assert cog.offload.jobs == 1
+    assert cog.flights.coalesced["export"] == 1
+    for ctx in contexts:
+        assert ctx.files == [("enchiridion.md", TEXT.encode())]
+    assert contexts[0].fp is contexts[1].fp
+    assert contexts[0].fp.closed
+
+
+@pytest.mark.parametrize(
+    "part, keys",
+    [
+        ("12-14", ["12", "13", "14"]),  # Stored as 12, 14, 13
+        ("17-19", ["17", "18", "19"]),  # 18 is stored after 21
+        ("", [str(n) for n in range(1, 54)]),
+    ],
+)
+def test_exports_ranges_in_numeric_order(library, part, keys):
+    cog = make_cog(library.lib)
+    ctx = Context("a")
+    asyncio.run(export(cog, ctx, "musonius", part))
+    assert cog.offload.keys == [keys]
+    assert ctx.fp.closed
+
+
+def test_rejects_a_reversed_range(library):
+    cog = make_cog(library.lib)
+    ctx = Context("a")
+    asyncio.run(export(cog, ctx, "musonius", "14-13"))
+    assert cog.offload.jobs == 0
+    assert ctx.replies == ["@a, `14-13` is not a valid range."]
@@ -0,0 +1,26 @@
+import asyncio
+import time
+import types
+
+from monitor import LoopMonitor
+
+
+def make_bot():
+    return types.SimpleNamespace(
+        before_invoke=lambda hook: hook,
+        after_invoke=lambda hook: hook,
+        http=types.SimpleNamespace(),
+    )
+
+
+def test_no_stall_when_the_loop_starts_late():
+    monitor = LoopMonitor(make_bot(), interval=0.02, threshold=0.05)
+    time.sleep(0.2)  # Made long before the loop runs, as the bot does
+
+    async def main():
+        monitor.start()
+        await asyncio.sleep(0.1)
+        monitor.task.cancel()
+
+    asyncio.run(main())
+    assert monitor.stall is None
@@ -0,0 +1,100 @@
+import itertools
+import json
+import os
+import re
+
+import pytest
+
+import fetch_articles
+
+BOOKS = os.path.join(os.path.dirname(__file__), os.pardir, "books")
+ZERO_WIDTH = "\u200b\u200c\u200d\u2060"
+
+
+# The substitutions the split functions chained before Normalizer, verbatim
+def old_drop_zero_width(text):
+    return re.sub("[\u200b\u200c\u200d\u2060]", "", text)
+
+
+def old_drop_footnotes(text):
+    return re.sub(r"\[\d+\]", "", text)
+
+
+def old_drop_zero_width_and_footnotes(text):
+    return re.sub(r"[\u200b\u200c\u200d\u2060]|\[\d+\]", "", text)
+
+
+def old_double_breaks(text):
+    return re.sub("(?<!\n)\n(?!\n)", "\n\n", text)
+
+
+def old_drop_footnotes_double_breaks(text):
+    return old_double_breaks(old_drop_footnotes(text))
+
+
+def old_collapse_breaks(text):
+    return re.sub("\n\n\n", "\n\n", text)
+
+
+def old_collapse_double_breaks(text):
+    return old_double_breaks(old_collapse_breaks(text))
+
+
+RULES = {
+    "drop_zero_width": old_drop_zero_width,
+    "drop_footnotes": old_drop_footnotes,
+    "drop_zero_width_and_footnotes": old_drop_zero_width_and_footnotes,
+    "double_breaks": old_double_breaks,
+    "drop_footnotes_double_breaks": old_drop_footnotes_double_breaks,
+    "collapse_breaks": old_collapse_breaks,
+    "collapse_double_breaks": old_collapse_double_breaks,
+}
+
+
+def scrape(paragraphs: list, n: int) -> str:
+    # Dirties the paragraphs of a real chapter like a scraped page: line breaks
+    # of 1 to 4 between them, footnote markers after sentences and next to the
+    # breaks, and zero-width characters after commas and at the start of lines
+    marks = itertools.count(1)
+    zero_width = itertools.cycle(ZERO_WIDTH)
+    text = ""
+    for i, paragraph in enumerate(paragraphs):
+        paragraph = re.sub(r"\. ", lambda m: f".[{next(marks)}] ", paragraph)
+        paragraph = re.sub(", ", lambda m: f",{next(zero_width)} ", paragraph)
+        breaks = "\n" * ((i + n) % 4 + 1)
+        if i % 3 == 0:
+            breaks = f"[{next(marks)}]{breaks}{next(zero_width)}"
+        elif i % 3 == 1:
+            breaks = breaks[:1] + f"[{next(marks)}]" + breaks[1:]
+        text += paragraph + breaks
+    return text
+
+
+@pytest.fixture(scope="module")
+def scraped() -> list:
+    # Every chapter of the Meditations and every lecture of Musonius, as scraped
+    # text, and as the clean text they were stored as
+    texts = []
+    for name in ["meditations", "musonius"]:
+        with open(os.path.join(BOOKS, f"{name}.json"), encoding="utf-8") as f:
+            book = json.load(f)
+        for n, (key, chapter) in enumerate(book.items()):
+            paragraphs = [p.strip() for p in chapter.values() if p.strip()]
+            texts.append(scrape(paragraphs, n))
+            texts.append("\n".join(paragraphs))
+            texts.append("\n\n".join(paragraphs))
+    return texts
+
+
+@pytest.mark.parametrize("rule", RULES)
+def test_normalizer_matches_the_old_chain(scraped, rule):
+    old, new = RULES[rule], getattr(fetch_articles, rule)
+    for text in scraped:
+        assert new(text) == old(text)
+
+
+def test_scraped_text_is_dirty(scraped):
+    # Otherwise the rules above would have nothing to do
+    dirty = "".join(scraped)
+    assert re.search(r"\[\d+\]\n", dirty) and re.search(f"\n[{ZERO_WIDTH}]", dirty)
+    assert "\n\n\n\n" in dirty
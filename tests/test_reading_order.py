@@ -0,0 +1,42 @@
+import types
+
+import pytest
+
+from librarian import LibraryError
+from utilities import reading_order
+
+discord = pytest.importorskip("discord")
+
+from cogs.Reader import Reader  # noqa: E402
+
+
+@pytest.fixture
+def reader(library):
+    reader = types.SimpleNamespace(corpus=library)
+    reader.resolve = Reader.resolve.__get__(reader)
+    reader.following = Reader.following.__get__(reader)
+    return reader
+
+
+def test_lectures_are_read_in_numeric_order(library):
+    # The scraped lectures of Musonius come as ..., 12, 14, 13, 15, ..., 21, 18, 22
+    keys = list(library.lib["musonius"])
+    assert keys.index("14") < keys.index("13")
+    order = reading_order(library.lib["musonius"])
+    assert order == sorted(order, key=int)
+    assert order[11:14] == ["12", "13", "14"]
+
+
+def test_next_follows_the_numbers(reader):
+    read = ["12"]
+    while len(read) < 11:
+        read.append(reader.following("musonius", read[-1]))
+    assert read == [str(n) for n in range(12, 23)]
+
+
+def test_start_from_a_reference_like_the_book_command(reader):
+    assert reader.resolve("musonius", "13.2") == "13"
+    assert reader.resolve("musonius", "18:1-2") == "18"
+    assert reader.resolve("meditations", "5.23") == "5:23"
+    with pytest.raises(LibraryError):
+        reader.resolve("musonius", "99")
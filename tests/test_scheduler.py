@@ -0,0 +1,135 @@
+import asyncio
+import types
+
+import pytest
+
+discord = pytest.importorskip("discord")
+
+from discord.webhook.async_ import AsyncWebhookAdapter, async_context  # noqa: E402
+
+from scheduler import (  # noqa: E402
+    COMMAND,
+    DEFERRED,
+    INTERACTION,
+    PAGE_FLIP,
+    Deadlines,
+    Overloaded,
+    PriorityGate,
+)
+
+MESSAGE = 4  # Interaction response type of a reply
+
+
+async def queue(gate: PriorityGate, priorities: list) -> tuple:
+    # Runs a job of every priority through a gate whose only slot is taken, and
+    # returns the names of those let in, in order, and the jobs
+    admitted = []
+
+    async def job(name, priority):
+        async with gate.admit(priority):
+            admitted.append(name)
+
+    await gate.acquire(INTERACTION)
+    jobs = [asyncio.create_task(job(*p)) for p in priorities]
+    await asyncio.sleep(0)  # All of them are waiting
+    gate.release()
+    await asyncio.gather(*jobs, return_exceptions=True)
+    return admitted, jobs
+
+
+def test_gate_lets_the_most_urgent_in_first():
+    gate = PriorityGate(capacity=1, max_waiting=10)
+    priorities = [
+        ("flip", PAGE_FLIP),
+        ("first command", COMMAND),
+        ("interaction", INTERACTION),
+        ("second command", COMMAND),
+    ]
+    admitted, _ = asyncio.run(queue(gate, priorities))
+    assert admitted == ["interaction", "first command", "second command", "flip"]
+    assert gate.running == 0
+
+
+def test_full_gate_sheds_the_least_urgent():
+    gate = PriorityGate(capacity=1, max_waiting=2)
+    priorities = [
+        ("command", COMMAND),
+        ("flip", PAGE_FLIP),
+        ("interaction", INTERACTION),  # Sheds the flip waiting
+        ("late flip", PAGE_FLIP),  # Is shed itself
+    ]
+    admitted, jobs = asyncio.run(queue(gate, priorities))
+    assert admitted == ["interaction", "command"]
+    assert [type(job.exception()) for job in jobs] == [
+        type(None),
+        Overloaded,
+        type(None),
+        Overloaded,
+    ]
+    assert gate.shed == {PAGE_FLIP: 2}
+
+
+class Interaction:
+    type = discord.InteractionType.application_command
+    id = application_id = 1
+    token = "token"
+    _session = None
+    data = {"name": "slow"}
+
+    def __init__(self):
+        self.response = types.SimpleNamespace(is_done=lambda: False, _responded=False)
+
+
+class Bot:
+    # Runs a command that replies after `latency` seconds
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.replies = []
+
+    async def process_application_commands(self, interaction):
+        await asyncio.sleep(self.latency)
+        adapter = async_context.get()
+        self.replies.append(
+            await adapter.create_interaction_response(
+                interaction.id,
+                interaction.token,
+                session=None,
+                type=MESSAGE,
+                data={"content": "Here"},
+            )
+        )
+
+
+def run_command(monkeypatch, latency: float, time_left: float) -> tuple:
+    calls = []
+
+    async def respond(self, interaction_id, token, *, session, type, **kwargs):
+        calls.append(("respond", type))
+        return {"interaction": {}}
+
+    async def edit(self, application_id, token, *, session, **kwargs):
+        calls.append(("edit", kwargs["payload"]))
+
+    monkeypatch.setattr(AsyncWebhookAdapter, "create_interaction_response", respond)
+    monkeypatch.setattr(AsyncWebhookAdapter, "edit_original_interaction_response", edit)
+    bot = Bot(latency)
+    deadlines = Deadlines(bot)
+    monkeypatch.setattr(deadlines, "time_left", lambda interaction: time_left)
+
+    async def main():
+        await deadlines.process(Interaction())
+
+    asyncio.run(main())
+    return calls, bot.replies
+
+
+def test_slow_command_is_deferred_once(monkeypatch):
+    calls, replies = run_command(monkeypatch, latency=0.05, time_left=0.01)
+    assert calls == [("respond", DEFERRED), ("edit", {"content": "Here"})]
+    assert replies[0]["interaction"]["response_message_loading"] is False
+
+
+def test_fast_command_is_not_deferred(monkeypatch):
+    calls, replies = run_command(monkeypatch, latency=0, time_left=0.05)
+    assert calls == [("respond", MESSAGE)]
+    assert replies == [{"interaction": {}}]
@@ -0,0 +1,20 @@
+from utilities import is_abbreviation, sentence_ends
+
+
+def sentences(text: str) -> list:
+    ends = sentence_ends(text)
+    return [text[start:end].strip() for start, end in zip([0] + ends, ends)]
+
+
+def test_pronoun_i_ends_a_sentence():
+    assert not is_abbreviation("wiser than I")
+    assert sentences("He is wiser than I. But he is not richer.") == [
+        "He is wiser than I.",
+        "But he is not richer.",
+    ]
+
+
+def test_initials_and_abbreviations_do_not():
+    assert is_abbreviation("Ask M")
+    assert is_abbreviation("see e.g")
+    assert sentences("Ask M. Aurelius. He knows.") == ["Ask M. Aurelius.", "He knows."]
@@ -0,0 +1,97 @@
+import asyncio
+
+from store import FLUSH_BATCH, GuildConfigStore, PopularityStore, ReadingStore
+
+
+async def write_popular(path, requests):
+    store = PopularityStore(str(path))
+    await store.open()
+    for (book, reference), n in requests.items():
+        for _ in range(n):
+            store.record(book, reference)
+    await store.close()
+
+
+def test_concurrent_opens_all_see_the_loaded_store(tmp_path):
+    path = tmp_path / "popularity.db"
+    requests = {("letters", "19:3"): 3, ("meditations", "5:23"): 2}
+    asyncio.run(write_popular(path, requests))
+
+    async def main():
+        store = PopularityStore(str(path))
+        seen = []
+
+        async def use():
+            await store.open()
+            # Whichever caller came second must not find it half open
+            seen.append((store.db is not None, store.popular()))
+
+        await asyncio.gather(use(), use(), use())
+        await store.close()
+        return seen
+
+    seen = asyncio.run(main())
+    expected = (True, [(("letters", "19:3"), 3), (("meditations", "5:23"), 2)])
+    assert seen == [expected] * 3
+
+
+def test_close_without_open(tmp_path):
+    store = PopularityStore(str(tmp_path / "popularity.db"))
+    asyncio.run(store.close())
+    assert store.db is None
+
+
+def test_early_write_is_kept_and_awaited_on_close(tmp_path):
+    path = str(tmp_path / "reading.db")
+
+    async def main():
+        store = ReadingStore(path)
+        await store.open()
+        for user in range(FLUSH_BATCH):
+            store.set_position(user, "letters", "19")
+        assert store.flushing is not None
+        await store.close()
+
+        store = ReadingStore(path)
+        await store.open()
+        positions = [await store.position(user, "letters") for user in range(3)]
+        await store.close()
+        return positions
+
+    assert asyncio.run(main()) == ["19"] * 3
+
+
+def test_failed_early_write_is_logged_and_kept(tmp_path, caplog):
+    async def main():
+        store = ReadingStore(str(tmp_path / "reading.db"))
+        await store.open()
+        await store.run(store.db.execute, "DROP TABLE positions")
+        for user in range(FLUSH_BATCH):
+            store.set_position(user, "letters", "19")
+        await asyncio.gather(store.flushing, return_exceptions=True)
+        return store
+
+    store = asyncio.run(main())
+    assert "Couldn't write to" in caplog.text
+    assert len(store.pending) == FLUSH_BATCH
+
+
+def test_early_config_write_is_kept_and_awaited_on_close(tmp_path):
+    path = str(tmp_path / "guilds.db")
+
+    async def main():
+        store = GuildConfigStore(path)
+        await store.open()
+        for guild in range(FLUSH_BATCH):
+            store.set(guild, "prefix", "!")
+        flushing = store.flushing
+        await store.close()
+
+        store = GuildConfigStore(path)
+        await store.open()
+        await store.close()
+        return flushing, store.get(0)["prefix"]
+
+    flushing, prefix = asyncio.run(main())
+    assert flushing is not None and flushing.done()
+    assert prefix == "!"
@@ -0,0 +1,33 @@
+import asyncio
+import types
+
+import pytest
+
+pytest.importorskip("discord")
+
+from cogs.Reader import Reader  # noqa: E402
+from cogs.Settings import Settings  # noqa: E402
+
+BOT = types.SimpleNamespace(get_cog=lambda name: None)  # Librarian was removed
+
+
+def test_next_replies_without_the_library():
+    replies = []
+    store = types.SimpleNamespace(set_position=lambda *args: replies.append(args))
+    reader = types.SimpleNamespace(bot=BOT, store=store)
+    ctx = types.SimpleNamespace(author=types.SimpleNamespace(id=1, mention="@a"))
+
+    async def respond(content):
+        replies.append(content)
+
+    ctx.respond = respond
+    asyncio.run(Reader.post(reader, ctx, "letters", "19"))
+    assert replies == [
+        "@a, the books are unavailable right now. Please try again later."
+    ]
+
+
+def test_quote_of_the_day_skips_without_the_library():
+    store = types.SimpleNamespace(configs={1: {"qotd_channel": 2, "disabled": []}})
+    settings = types.SimpleNamespace(bot=BOT, store=store)
+    asyncio.run(Settings.quote_of_the_day.coro(settings))
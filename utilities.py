@@ -1,4 +1,65 @@
+import asyncio
+import bisect
+import collections
+import hashlib
+import json
 import random
+import re
+
+LIBRARY = [
+    "meditations",  # Meditations
+    "enchiridion",  # Enchiridion
+    "letters",  # Letters
+    "happylife",  # Happy Life
+    "shortness",  # Shortness of life
+    "discourses",  # The Discourses
+    "anger",  # Of Anger
+    "musonius",  # Lectures, Fragments by Musonius Rufus
+    "media",  # Author information and wikisource links
+    "toc",  # Table of Contents for some books
+]
+# Every book bundled by fetch_articles.py, and the manifest holding its hash
+CORPUS_PATH = "books/corpus.json"
+CORPUS_MANIFEST_PATH = "books/corpus.manifest.json"
+SHORT_QUOTE_LENGTH = 400  # Longest passage (in characters) that counts as a short quote
+NOT_BOOKS = ["media", "toc"]  # Parts of the library that aren't books
+
+# Where a sentence may end: after . ! ? (and closing quotes or brackets) when the next
+# one starts with a capital, possibly after opening quotes. "composition? how long",
+# "'What!' he said" and "Ep. xc. 5" don't end a sentence, and neither do the line
+# breaks within quoted verse.
+SENTENCE_END = re.compile(r"""[.!?…]+["'”’)\]]*(?=\s+["'“‘(\[]*[A-Z])""")
+# Words the translations abbreviate, which don't end a sentence with their period:
+# references ("cf. Ep. xc.", "i.e.", "Frag. 8"), titles, and Roman first names (besides
+# single letters like "M. Cato")
+ABBREVIATIONS = {
+    "app",
+    "cf",
+    "ch",
+    "chap",
+    "cn",
+    "e.g",
+    "ep",
+    "epp",
+    "fr",
+    "frag",
+    "ibid",
+    "i.e",
+    "lit",
+    "mr",
+    "no",
+    "p",
+    "pp",
+    "sc",
+    "ser",
+    "sex",
+    "sp",
+    "st",
+    "ti",
+    "viz",
+    "vol",
+    "vs",
+}
 
 ROMAN_INTS = (
     (1000, "M"),
@@ -79,3 +140,431 @@ def uniform_random_choice_from_dict(books: dict):
     chapters = list(books[bk].keys())
     cha = str(random.choice(chapters))
     return bk, cha
+
+
+def load_json(filename: str):
+    with open(filename, "r", encoding="utf-8") as f:
+        js = json.load(f)
+    return js
+
+
+def load_library(books: list = LIBRARY):
+    # Loads the corpus artifact after checking it against its manifest. Returns the
+    # library and the manifest, or falls back to the separate book files (and no
+    # manifest) if the artifact hasn't been built.
+    try:
+        manifest = load_json(CORPUS_MANIFEST_PATH)
+    except FileNotFoundError:
+        lib = {b: load_json(f"books/{b}.json") for b in books}
+        lib["sentences"] = segment_library(lib)
+        return lib, None
+
+    with open(CORPUS_PATH, "rb") as f:
+        data = f.read()
+    if hashlib.sha256(data).hexdigest() != manifest["sha256"]:
+        raise RuntimeError(
+            f"{CORPUS_PATH} doesn't match {CORPUS_MANIFEST_PATH}, rebuild it with `python fetch_articles.py --build`"
+        )
+    corpus = json.loads(data)
+    missing = [b for b in books if b not in corpus]
+    if missing:
+        raise RuntimeError(f"{CORPUS_PATH} is missing {', '.join(missing)}")
+    lib = {b: corpus[b] for b in books}
+    # Artifacts built before sentences were indexed get them segmented here, once
+    lib["sentences"] = corpus.get("sentences") or segment_library(lib)
+    return lib, manifest
+
+
+class PrefixTrie:
+    # Case-insensitive prefix index for autocompletion. Every node keeps the first
+    # `limit` values inserted below it, so a lookup is a single walk down the trie
+    # and never has to traverse a subtree.
+
+    __slots__ = ("limit", "root")
+
+    def __init__(self, limit: int = 25):
+        self.limit = limit  # Discord accepts at most 25 autocomplete choices
+        self.root = _TrieNode()
+
+    def insert(self, key: str, value):
+        node = self.root
+        node.add(value, self.limit)
+        for ch in key.lower():
+            node = node.children.setdefault(ch, _TrieNode())
+            node.add(value, self.limit)
+
+    def search(self, prefix: str) -> list:
+        node = self.root
+        for ch in prefix.lower():
+            node = node.children.get(ch)
+            if node is None:
+                return []
+        return node.values
+
+
+class _TrieNode:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+    def add(self, value, limit: int):
+        if len(self.values) < limit and value not in self.values:
+            self.values.append(value)
+
+
+class NGramIndex:
+    # Case-insensitive fuzzy index for "did you mean" suggestions. Keys are split into
+    # overlapping character trigrams (padded, so that beginnings weigh more) and every
+    # trigram lists the keys it occurs in. A lookup only visits the keys sharing a
+    # trigram with the query, and ranks them by the Dice coefficient of the two sets.
+
+    def __init__(self, n: int = 3, threshold: float = 0.3):
+        self.n = n
+        self.threshold = threshold  # Least similarity worth suggesting
+        self.keys = []  # (key, value, number of its n-grams)
+        self.postings = collections.defaultdict(list)  # n-gram -> indices of keys
+
+    def grams(self, key: str) -> set:
+        padded = " " * (self.n - 1) + key.lower() + " "
+        return {padded[i : i + self.n] for i in range(len(padded) - self.n + 1)}
+
+    def insert(self, key: str, value=None):
+        grams = self.grams(key)
+        i = len(self.keys)
+        self.keys.append((key, key if value is None else value, len(grams)))
+        for gram in grams:
+            self.postings[gram].append(i)
+
+    def search(self, query: str, limit: int = 3) -> list:
+        # The values of the closest keys, most similar first, each value once
+        grams = self.grams(query)
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+
+        ranked = []
+        for i, common in shared.items():
+            key, value, size = self.keys[i]
+            score = 2 * common / (len(grams) + size)
+            if score >= self.threshold:
+                ranked.append((-score, i))
+        ranked.sort()
+
+        values = []
+        for _, i in ranked:
+            value = self.keys[i][1]
+            if value not in values:
+                values.append(value)
+                if len(values) == limit:
+                    break
+        return values
+
+
+def numbered(keys) -> list:
+    # The keys of a book, or of one of its chapters, in numeric order. The books
+    # keep them in the order they were scraped in, which isn't always that: the
+    # lectures of Musonius have "14" before "13", and "18" after "21".
+    return sorted(keys, key=int)
+
+
+def iter_references(book: dict):
+    # Yields every reference a book command accepts, in reading order:
+    # "12" for flat books, "2:5" for books of chapters, and additionally "12" for
+    # whole chapters that have a title at key "0" (letters, lectures)
+    for key in numbered(book):
+        chapter = book[key]
+        if not isinstance(chapter, dict):
+            yield key
+            continue
+        if "0" in chapter:
+            yield key
+        for k in numbered(chapter):
+            if k != "0":
+                yield f"{key}:{k}"
+
+
+def reading_order(book: dict) -> list:
+    # The references of a book in the units it is read in from start to finish:
+    # whole letters and lectures, and single chapters of everything else
+    return [
+        ref
+        for ref in iter_references(book)
+        if ":" not in ref or "0" not in book[ref.split(":")[0]]
+    ]
+
+
+def iter_passages(book: dict):
+    # Yields (reference, text) for the smallest passages of a book that a command can
+    # post on their own, leaving out chapter titles
+    for key in numbered(book):
+        chapter = book[key]
+        if not isinstance(chapter, dict):
+            yield key, chapter
+            continue
+        for k in numbered(chapter):
+            if k != "0":
+                yield f"{key}:{k}", chapter[k]
+
+
+def sentence_ends(text: str) -> list:
+    # Offsets in a passage at which its sentences end, the last one at its end.
+    # Sentence n is then the slice between the (n-1)th and nth offset.
+    ends = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        if match[0][0] == "." and is_abbreviation(text[start : match.start()]):
+            continue
+        if text[start : match.end()].strip():
+            ends.append(match.end())
+            start = match.end()
+    if text[start:].strip():
+        ends.append(len(text))
+    return ends
+
+
+def is_abbreviation(text: str) -> bool:
+    # Whether the word text ends with is an abbreviation or an initial. "I" is
+    # taken for the pronoun, as in "…than I. But…", which ends a sentence.
+    words = text.split()
+    if not words:
+        return False
+    word = words[-1].lstrip("\"'“‘([")
+    return (
+        word.lower() in ABBREVIATIONS
+        or (len(word) == 1 and word.isupper() and word != "I")
+        or re.fullmatch(r"(?:[A-Za-z]\.)+[A-Za-z]", word) is not None
+    )
+
+
+def segment_library(lib: dict) -> dict:
+    # The sentence end offsets of every passage of every book, by reference
+    return {
+        book: {ref: sentence_ends(passage) for ref, passage in iter_passages(lib[book])}
+        for book in lib
+        if book not in NOT_BOOKS + ["sentences"]
+    }
+
+
+def sentence(lib: dict, book: str, ref: str, n: int) -> str:
+    # Sentence n (counting from 1) of a passage, sliced straight from the passage
+    ends = lib["sentences"][book][ref]
+    text = passage_text(lib[book], ref)
+    return text[ends[n - 2] if n > 1 else 0 : ends[n - 1]].strip()
+
+
+def passage_text(book: dict, ref: str) -> str:
+    # The text of a reference yielded by iter_passages
+    key, _, k = ref.partition(":")
+    return book[key][k] if k else book[key]
+
+
+def iter_sentences(lib: dict, book: str):
+    # Yields ("<reference>#<n>", sentence) for every sentence of a book
+    for ref, passage in iter_passages(lib[book]):
+        start = 0
+        for n, end in enumerate(lib["sentences"][book][ref], start=1):
+            yield f"{ref}#{n}", passage[start:end].strip()
+            start = end
+
+
+class LengthIndex:
+    # Passage lengths of every book, and of the whole library, in sorted arrays. The
+    # passages of at most N characters are then a prefix of the array, so one bisect
+    # gives a uniform draw among them without scanning or redrawing. Indexes other
+    # units of text instead if given a function yielding (reference, text) for a book.
+
+    def __init__(self, lib: dict, books: list, units=None):
+        units = units or (lambda book: iter_passages(lib[book]))
+        self.lengths, self.refs = {}, {}
+        everything = []
+        for book in books:
+            entries = sorted((len(text.strip()), ref) for ref, text in units(book))
+            self.lengths[book] = [n for n, _ in entries]
+            self.refs[book] = [ref for _, ref in entries]
+            everything += [(n, book, ref) for n, ref in entries]
+        everything.sort()
+        self.lengths[None] = [n for n, _, _ in everything]
+        self.refs[None] = [(book, ref) for _, book, ref in everything]
+
+    def count(self, max_length: int, book: str = None) -> int:
+        return bisect.bisect_right(self.lengths[book], max_length)
+
+    def choice(self, max_length: int, book: str = None):
+        # A uniformly random reference of at most max_length characters from a book,
+        # or a (book, reference) pair from the whole library if no book is given.
+        # None if nothing is that short.
+        n = self.count(max_length, book)
+        if not n:
+            return None
+        return self.refs[book][random.randrange(n)]
+
+
+def iter_markdown(lib: dict, book: str, keys: list, title: str):
+    # Yields a book, or some of its letters, lectures or books, as markdown
+    # piece by piece straight from the corpus
+    media = lib["media"]
+    author = next(a for a, data in media.items() if book in data or a == book)
+    yield f"# {title}\n\n*{media[author]['name']}*\n\n"
+    for key in keys:
+        chapter = lib[book][key]
+        if not isinstance(chapter, dict):
+            yield f"## {key}\n\n{chapter.strip()}\n\n"
+            continue
+        if "0" in chapter:  # Letters and lectures, numbered by paragraph
+            yield f"## {key}. {chapter['0']}\n\n"
+            for k in numbered(chapter):
+                if k != "0":
+                    yield f"**§{k}** {chapter[k].strip()}\n\n"
+            continue
+        yield f"## {key}\n\n"
+        for k in numbered(chapter):
+            yield f"**{key}:{k}** {chapter[k].strip()}\n\n"
+
+
+class SingleFlight:
+    # Coalesces identical concurrent requests. While a computation for a key is in
+    # progress, everyone asking for the same key awaits that computation and shares
+    # its result (or exception) instead of starting their own. Counts per kind of
+    # request (the first element of the key) how many were started and coalesced.
+
+    def __init__(self):
+        self.flights = {}
+        self.started = collections.Counter()
+        self.coalesced = collections.Counter()
+
+    async def do(self, key: tuple, func, *args):
+        future = self.flights.get(key)
+        if future is None:
+            self.started[key[0]] += 1
+            future = asyncio.ensure_future(func(*args))
+            self.flights[key] = future
+            future.add_done_callback(lambda f: self._land(key, f))
+        else:
+            self.coalesced[key[0]] += 1
+        # One caller giving up must not cancel the computation for the others
+        return await asyncio.shield(future)
+
+    def _land(self, key, future):
+        del self.flights[key]
+        if not future.cancelled():
+            future.exception()  # Retrieved here in case every caller gave up
+
+
+class SharedFile:
+    # An open file that everyone sharing a flight sends, one at a time and each from
+    # its start. Whoever is done with it last closes it.
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+    async def __aenter__(self):
+        self.users += 1
+        try:
+            await self.lock.acquire()
+        except BaseException:
+            self._leave()
+            raise
+        self.fp.seek(0)
+        return self.fp
+
+    async def __aexit__(self, *exc_info):
+        self.lock.release()
+        self._leave()
+
+    def _leave(self):
+        self.users -= 1
+        if not self.users:
+            self.fp.close()
+
+
+class LRUCache:
+    # Keeps the values of the `capacity` keys used most recently, and counts how
+    # often a key was found
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.values = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self.values
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def get(self, key):
+        # The value of a key, which is then the most recently used, or None
+        value = self.values.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.values.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.values[key] = value
+        self.values.move_to_end(key)
+        if len(self.values) > self.capacity:
+            self.values.popitem(last=False)
+
+
+class CountMinSketch:
+    # Estimates how often every key was counted in fixed memory, however many keys
+    # there are. Each of `depth` rows of counters is indexed by its own hash of the
+    # key, so a key's counters overcount by the keys colliding with it, and the
+    # smallest of them is the estimate. It never undercounts.
+
+    def __init__(self, width: int = 2048, depth: int = 4):
+        self.width = width
+        self.rows = [[0] * width for _ in range(depth)]
+
+    def indices(self, key):
+        # Row i uses h1 + i * h2, which is as good as independent hashes
+        h = hash(key)
+        i, step = h & 0xFFFFFFFF, (h >> 32) | 1
+        for _ in self.rows:
+            yield i % self.width
+            i += step
+
+    def add(self, key, count: int = 1) -> int:
+        # Counts a key, and returns its new estimate
+        estimate = None
+        for row, i in zip(self.rows, self.indices(key)):
+            row[i] += count
+            if estimate is None or row[i] < estimate:
+                estimate = row[i]
+        return estimate
+
+    def estimate(self, key) -> int:
+        return min(row[i] for row, i in zip(self.rows, self.indices(key)))
+
+
+class TopK:
+    # The k keys with the highest counts offered, e.g. estimates of a CountMinSketch.
+    # A key only displaces the lowest of them when its count is higher, which is
+    # rarely, so most offers are one comparison.
+
+    def __init__(self, k: int):
+        self.k = k
+        self.counts = {}
+        self.floor = 0  # Lowest count kept, once there are k keys
+
+    def offer(self, key, count: int):
+        old = self.counts.get(key)
+        if old is None and len(self.counts) == self.k:
+            if count <= self.floor:
+                return
+            del self.counts[min(self.counts, key=self.counts.get)]
+        self.counts[key] = count
+        # Counts only grow, so the floor only moves when a key at it moves
+        if len(self.counts) == self.k and (old is None or old == self.floor):
+            self.floor = min(self.counts.values())
+
+    def most_common(self) -> list:
+        return sorted(self.counts.items(), key=lambda item: -item[1])